@@ -0,0 +1,417 @@
+import argparse
+import gc
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from lxml.html import fromstring
+from dataset_construction.bs4.src.bs4_classes import OverviewScraper, ReviewScraper, parse_review_content
+from dataset_construction.bs4.src.utils import get_product_info
+from dataset_construction.common.src.records import encode
+from dataset_construction.macys_scraper.src.scrape_product_urls import scrape_urls
+from dataset_construction.macys_scraper.src.scrape_products_simple import get_product_data, _get_review_data
+from dataset_construction.macys_scraper.src.xapi_schema import decode_product, decode_reviews
+from dataset_construction.benchmarks.src.synthetic_fixtures import write_synthetic_fixtures
+
+# kinds of recorded pages and the extension they're saved with
+FIXTURE_KINDS = {
+    'bestbuy_product': '.html',
+    'bestbuy_reviews': '.html',
+    'macys_listing': '.html',
+    'macys_product': '.json',
+    'macys_reviews': '.json'
+}
+
+
+# function to turn a html fixture into the arguments of an extractor
+def _html_args(content):
+    return (fromstring(content),)
+
+# function to turn a json fixture into the arguments of an extractor
+def _json_args(content):
+    return (json.loads(content),)
+
+# function to get a review page plus its headers, which get_review_images needs
+def _review_images_args(content):
+    doc = fromstring(content)
+    return (doc, REVIEW_SCRAPER.get_headers(doc)[1])
+
+# function to keep the raw bytes, for timing the parsers themselves
+def _raw_args(content):
+    return (content,)
+
+
+# a review scraper that hasn't fetched anything, so its page methods can be timed on their own
+REVIEW_SCRAPER = ReviewScraper.__new__(ReviewScraper)
+REVIEW_SCRAPER.url = 'fixture'
+
+# name -> (fixture kind, function that prepares the arguments, extractor that's timed)
+BENCHMARKS = {
+    'fromstring': ('bestbuy_product', _raw_args, fromstring),
+    'json.loads': ('macys_product', _raw_args, json.loads),
+    'decode_product': ('macys_product', _raw_args, decode_product),
+    'decode_reviews': ('macys_reviews', _raw_args, decode_reviews),
+    'OverviewScraper': ('bestbuy_product', _html_args, lambda doc: OverviewScraper(url='fixture', doc=doc, headers={})),
+    'get_product_info': ('bestbuy_product', _html_args, get_product_info),
+    'ReviewScraper.parse_review_page': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.parse_review_page),
+    'ReviewScraper.get_headers': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.get_headers),
+    'ReviewScraper.get_user_info': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.get_user_info),
+    'ReviewScraper.get_recommendations': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.get_recommendations),
+    'ReviewScraper.get_feedback': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.get_feedback),
+    'ReviewScraper.get_bodies': ('bestbuy_reviews', _html_args, REVIEW_SCRAPER.get_bodies),
+    'ReviewScraper.get_review_images': ('bestbuy_reviews', _review_images_args, REVIEW_SCRAPER.get_review_images),
+    'get_product_data': ('macys_product', _json_args,
+                         lambda prod_dict: get_product_data(prod_dict, url='fixture', headers={}, fetch_reviews=False)),
+    '_get_review_data': ('macys_reviews', _json_args, lambda rev_req: _get_review_data(rev_req['review']['reviews'])),
+    'scrape_urls': ('macys_listing', _html_args, lambda doc: scrape_urls(doc, 'fixture', os.devnull))
+}
+
+# review fixture kind -> extractor that turns a page into review records
+REVIEW_EXTRACTORS = {
+    'macys_reviews': lambda content: _get_review_data(decode_reviews(content)),
+    'bestbuy_reviews': lambda content: parse_review_content(content, 'fixture')[1]
+}
+
+
+# get the fixture files of a kind
+def fixture_paths(fixture_dir, kind):
+
+    # case when nothing was recorded for this kind
+    kind_dir = os.path.join(fixture_dir, kind)
+    if not os.path.isdir(kind_dir):
+        return []
+
+    # sorted so every run sees the pages in the same order, the index of the recorded urls isn't a page
+    return sorted(os.path.join(kind_dir, name) for name in os.listdir(kind_dir)
+                  if name.endswith(FIXTURE_KINDS[kind]) and name != 'index.json')
+
+# get the peak resident memory of this process in megabytes
+def peak_rss_mb():
+
+    # linux reports kilobytes, macos reports bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+# get a percentile of sorted latencies
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+# time a single benchmark, meant to run in a fresh process so its peak memory is its own
+def run_benchmark(name, fixture_dir, repeat=5):
+
+    # get the fixtures
+    kind, prepare, extractor = BENCHMARKS[name]
+    paths = fixture_paths(fixture_dir, kind)
+    if len(paths) == 0:
+        return None
+
+    # parse the fixtures up front, so only the extractor is timed
+    inputs = []
+    for path in paths:
+        with open(path, 'rb') as fp:
+            inputs.append(prepare(fp.read()))
+
+    # one untimed pass so lazy setup doesn't count against the first page
+    for args in inputs:
+        extractor(*args)
+
+    # time every call
+    latencies = []
+    for _ in range(repeat):
+        for args in inputs:
+            start = time.perf_counter()
+            extractor(*args)
+            latencies.append(time.perf_counter() - start)
+
+    # summarize the calls
+    latencies.sort()
+    return {'pages': len(latencies),
+            'pages_per_sec': len(latencies) / sum(latencies),
+            'p50_ms': 1000 * percentile(latencies, 0.5),
+            'p90_ms': 1000 * percentile(latencies, 0.9),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'peak_rss_mb': peak_rss_mb()}
+
+# run every benchmark, each in its own process
+def run_benchmarks(fixture_dir, names, repeat=5):
+
+    # name -> summary
+    report = {}
+
+    # spawn so the workers don't inherit the memory of this process
+    mp_context = multiprocessing.get_context('spawn')
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+
+            # a broken extractor shouldn't stop the other benchmarks
+            try:
+                result = executor.submit(run_benchmark, name, fixture_dir, repeat).result()
+            except Exception as e:
+                logging.warning(f'Benchmark {name} failed: {e!r}')
+                continue
+
+        # case when nothing was recorded for it
+        if result is None:
+            logging.warning(f'No fixtures for benchmark {name}, skipping')
+            continue
+
+        report[name] = result
+
+    # return the report
+    return report
+
+# get the bytes still allocated by what a function returns
+def traced_bytes(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        held = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del held
+    return current
+
+# compare the memory of holding reviews as records against holding them as plain dicts
+def record_memory(fixture_dir, kind, num_reviews=10000):
+
+    # read the fixtures up front, so only the reviews are traced
+    contents = []
+    for path in fixture_paths(fixture_dir, kind):
+        with open(path, 'rb') as fp:
+            contents.append(fp.read())
+    if len(contents) == 0:
+        return None
+
+    # extract the pages over and over until there are enough reviews, every pass makes new strings
+    def build_records():
+        reviews = []
+        while len(reviews) < num_reviews:
+            for content in contents:
+                reviews.extend(REVIEW_EXTRACTORS[kind](content))
+        del reviews[num_reviews:]
+        return reviews
+
+    # the same reviews the way they used to be held, the records are freed before the snapshot
+    def build_dicts():
+        return [json.loads(encode(review)) for review in build_records()]
+
+    # trace both
+    record_bytes = traced_bytes(build_records)
+    dict_bytes = traced_bytes(build_dicts)
+
+    # return the bytes per 10k reviews
+    scale = 10000 / num_reviews
+    return {'dict_bytes_per_10k': dict_bytes * scale,
+            'record_bytes_per_10k': record_bytes * scale,
+            'reduction': 1 - record_bytes / dict_bytes}
+
+# get what a baseline depends on, timings from another machine or python aren't comparable
+def host_info():
+    return {'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'system': platform.system(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation()}
+
+# compare a report against a saved baseline, returns the regressions
+def compare(report, baseline, tolerance=0.2, min_ms=0.5):
+
+    # list of regressions
+    regressions = []
+
+    # benchmarks that aren't in the baseline can't regress
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+
+        # memory is compared whatever the timings
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak_rss_mb {result['peak_rss_mb']:.2f}, baseline {base['peak_rss_mb']:.2f}")
+
+        # calls this short are mostly timer and scheduler noise
+        if base['p50_ms'] < min_ms:
+            continue
+
+        # slower throughput, or more latency, than the tolerance allows
+        if result['pages_per_sec'] < base['pages_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['pages_per_sec']:.1f} pages/sec, "
+                               f"baseline {base['pages_per_sec']:.1f}")
+        for metric in ('p50_ms', 'p99_ms'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f'{name}: {metric} {result[metric]:.2f}, baseline {base[metric]:.2f}')
+
+    # return the list
+    return regressions
+
+# record live pages as fixtures
+def record(kind, urls, fixture_dir, session, headers):
+
+    # make the directory
+    kind_dir = os.path.join(fixture_dir, kind)
+    os.makedirs(kind_dir, exist_ok=True)
+
+    # the index maps each file back to where it came from
+    index_path = os.path.join(kind_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as fp:
+            index = json.load(fp)
+
+    # iterate over each url
+    for url in urls:
+
+        # name the file by the url, so recording it again overwrites it
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + FIXTURE_KINDS[kind]
+
+        # case when the page can be fetched
+        try:
+            response = session.get(url, headers=headers)
+            response.raise_for_status()
+        except Exception as e:
+            logging.warning(f'Failed to record url: {url} ({e!r})')
+            continue
+
+        # write out the page exactly as it was received
+        with open(os.path.join(kind_dir, name), 'wb') as fp:
+            fp.write(response.content)
+        index[name] = url
+
+    # write out the index
+    with open(index_path, 'w', encoding='utf-8') as fp:
+        json.dump(index, fp, indent=4)
+
+
+# runner
+if __name__ == "__main__":
+
+    # fixtures and the baseline live next to the benchmarks
+    fixture_dir = r'../data/fixtures'
+    baseline_path = r'../data/baseline.json'
+
+    # headers
+    headers = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
+                             ' (KHTML, like Gecko) Version/15.3 Safari/605.1.15'}
+
+    logging.basicConfig(level=logging.INFO)
+
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='record live pages as fixtures')
+    record_parser.add_argument('kind', choices=sorted(FIXTURE_KINDS))
+    record_parser.add_argument('urls_file', help='file with the urls to record, one per line')
+    synthesize_parser = subparsers.add_parser('synthesize', help='write synthetic pages of every kind as fixtures')
+    synthesize_parser.add_argument('--pages', type=int, default=3,
+                                   help='number of pages of each kind')
+    synthesize_parser.add_argument('--seed', type=int, default=0,
+                                   help='seed of the pages, the same seed always writes the same bytes')
+    run_parser = subparsers.add_parser('run', help='time the extractors on the recorded fixtures')
+    run_parser.add_argument('--benchmark', action='append', choices=sorted(BENCHMARKS),
+                            help='only run this benchmark, can be given more than once')
+    run_parser.add_argument('--repeat', type=int, default=100,
+                            help='number of timed passes over the fixtures, enough calls for a stable p99')
+    run_parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='relative change against the baseline that counts as a regression')
+    run_parser.add_argument('--min-ms', type=float, default=0.5,
+                            help="don't compare the timings of benchmarks whose baseline p50 is below this")
+    run_parser.add_argument('--save-baseline', action='store_true',
+                            help='save this run as the new baseline')
+    run_parser.add_argument('--out', default=None,
+                            help='also write the report to this path')
+    memory_parser = subparsers.add_parser('memory', help='compare the memory of review records and dicts')
+    memory_parser.add_argument('--reviews', type=int, default=10000,
+                               help='number of reviews to hold')
+    args = parser.parse_args()
+
+    # case when fixtures should be recorded
+    if args.command == 'record':
+
+        # imported here so running the benchmarks doesn't need the network stack
+        from dataset_construction.common.src.frontier import iter_urls
+        from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+        from dataset_construction.common.src.session import PooledSession
+
+        # record the pages
+        with PooledSession(rate_limiter=AdaptiveRateLimiter()) as session:
+            record(args.kind, iter_urls(args.urls_file), fixture_dir, session, headers)
+
+    # case when synthetic fixtures should be written
+    elif args.command == 'synthesize':
+        write_synthetic_fixtures(fixture_dir, FIXTURE_KINDS, pages_per_kind=args.pages, seed=args.seed)
+
+    # case when the memory of the review records should be measured
+    elif args.command == 'memory':
+        for kind in REVIEW_EXTRACTORS:
+            result = record_memory(fixture_dir, kind, num_reviews=args.reviews)
+            if result is None:
+                logging.warning(f'No fixtures for {kind}, skipping')
+                continue
+            print(f"{kind:20} dicts {result['dict_bytes_per_10k'] / 2 ** 20:8.2f} MB  "
+                  f"records {result['record_bytes_per_10k'] / 2 ** 20:8.2f} MB per 10k reviews  "
+                  f"({100 * result['reduction']:.1f}% less)")
+
+    # otherwise, time the extractors
+    else:
+
+        # run the benchmarks
+        report = run_benchmarks(fixture_dir, args.benchmark or list(BENCHMARKS), repeat=args.repeat)
+
+        # print the report
+        for name, result in report.items():
+            print(f"{name:40} {result['pages_per_sec']:10.1f} pages/sec  p50 {result['p50_ms']:8.3f} ms  "
+                  f"p90 {result['p90_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  "
+                  f"peak rss {result['peak_rss_mb']:7.1f} MB")
+
+        # write out the report
+        if args.out is not None:
+            with open(args.out, 'w', encoding='utf-8') as fp:
+                json.dump(report, fp, indent=4)
+
+        # case when this run becomes the baseline, the first run on a machine always does
+        if args.save_baseline or not os.path.exists(baseline_path):
+            with open(baseline_path, 'w', encoding='utf-8') as fp:
+                json.dump({'host': host_info(), 'benchmarks': report}, fp, indent=4)
+            logging.info(f'Saved the baseline to {baseline_path}')
+            baseline = None
+
+        # otherwise, get the baseline
+        else:
+            with open(baseline_path, 'r', encoding='utf-8') as fp:
+                baseline = json.load(fp)
+
+        # nothing to compare against
+        if baseline is None:
+            pass
+
+        # a baseline from another machine or python can't gate this run
+        elif baseline.get('host') != host_info():
+            logging.warning(f'The baseline at {baseline_path} was recorded on {baseline.get("host")}, not on '
+                            f'{host_info()}, skipping the comparison, run with --save-baseline to replace it')
+
+        # otherwise, compare against the baseline
+        else:
+            regressions = compare(report, baseline['benchmarks'], tolerance=args.tolerance, min_ms=args.min_ms)
+
+            # a shared machine has slow spells, so a regression only counts if a second run of it agrees
+            if len(regressions) > 0:
+                names = [name for name in report if compare({name: report[name]}, baseline['benchmarks'],
+                                                            tolerance=args.tolerance, min_ms=args.min_ms)]
+                logging.info(f'Running {", ".join(names)} again to confirm the regressions')
+                rerun = run_benchmarks(fixture_dir, names, repeat=args.repeat)
+                regressions = compare(rerun, baseline['benchmarks'], tolerance=args.tolerance, min_ms=args.min_ms)
+            for regression in regressions:
+                print(f'REGRESSION {regression}')
+
+            # fail so a regression stops a production run
+            if len(regressions) > 0:
+                sys.exit(1)
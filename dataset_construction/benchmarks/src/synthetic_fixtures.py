@@ -0,0 +1,137 @@
+import json
+import os
+import random
+from html import escape
+
+# words the synthetic reviews and descriptions are made of
+WORDS = ['quality', 'fit', 'shrink', 'small', 'runs', 'wash', 'great', 'fabric', 'love', 'price', 'true', 'to',
+         'size', 'comfortable', 'color', 'soft', 'it', 'sound', 'battery', 'screen', 'fast', 'easy', 'setup']
+
+# host of the review photos
+PHOTO_HOST = 'https://photos-us.bazaarvoice.com'
+
+
+# get a run of random words
+def _text(rng, num_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(num_words))
+
+
+# best buy product page with the title block, the overview sections and the feature rows
+def bestbuy_product_page(rng, num_features=12):
+    features = ''.join(f'<div class="list-row"><h4>{escape(_text(rng, 3))}</h4><p>{escape(_text(rng, 40))}</p></div>'
+                       for _ in range(num_features))
+    return ('<html><head><title>Product</title></head><body>'
+            '<div id="shop-product-title-1"><div><a href="/site/brands">Brand</a></div>'
+            f'<h1 class="sku-title">{escape(_text(rng, 6))}</h1></div>'
+            '<div class="embedded-component-container lv product-overview">'
+            f'<h2>Description</h2><p>{escape(_text(rng, 120))}</p>'
+            '<script>(function(){})()</script></div>'
+            f'<div class="embedded-component-container lv product-features">{features}</div>'
+            '</body></html>')
+
+# best buy review page, some reviews have photos
+def bestbuy_reviews_page(rng, num_reviews=20, total_reviews=100):
+    reviews = []
+    for _ in range(num_reviews):
+
+        # the gallery sits between the heading and the body
+        gallery = ''
+        if rng.random() < 0.3:
+            images = ''.join('<li><button><img src="https://pisces.bbystatic.com/image2/BestBuy_US/ugc/photos/'
+                             f'thumbnail/{rng.getrandbits(48):012x}.jpg;maxHeight=140;maxWidth=140"></button></li>'
+                             for _ in range(rng.randint(1, 3)))
+            gallery = f'<ul class="carousel gallery-preview">{images}</ul>'
+
+        reviews.append(
+            '<li class="review-item"><div class="review-item-content">'
+            f'<div class="review-heading"><p class="visually-hidden">Rated {rng.randint(1, 5)} out of 5 stars</p>'
+            f'<h4>{escape(_text(rng, 5))}</h4></div>{gallery}'
+            f'<div class="ugc-review-body"><p>{escape(_text(rng, rng.randint(20, 80)))}</p></div>'
+            f'<div class="ugc-recommendation"><p>{rng.choice(["Yes", "No"])}, I would recommend to a friend</p></div>'
+            f'<div class="feedback-display"><button>Helpful ({rng.randint(0, 40)})</button>'
+            f'<button>Unhelpful ({rng.randint(0, 5)})</button></div>'
+            f'</div><div class="ugc-author v-fw-medium">user{rng.randint(0, 99999):06d}</div></li>')
+    return (f'<html><body><span class="message">Showing 1-{num_reviews} of {total_reviews} reviews</span>'
+            f'<ul class="reviews-list">{"".join(reviews)}</ul></body></html>')
+
+# macy's listing page with a grid of product links
+def macys_listing_page(rng, num_products=60):
+    links = ''.join(f'<li class="cell"><div class="productThumbnail"><a class="productDescLink" '
+                    f'href="/shop/product/{_text(rng, 2).replace(" ", "-")}?ID={rng.randint(1000000, 9999999)}">'
+                    f'{escape(_text(rng, 4))}</a></div></li>' for _ in range(num_products))
+    return (f'<html><body><div id="filters">{escape(_text(rng, 50))}</div>'
+            f'<ul class="items">{links}</ul>'
+            '<a href="/shop/womens-clothing/Pageindex/2">next</a></body></html>')
+
+# macy's xapi product payload, padded with the kind of fields get_product_data skips
+def macys_product_payload(rng, num_padding=200, num_images=8):
+    data = {
+        't_category_name': ['Dresses'],
+        'product_name': [_text(rng, 5)],
+        'product_brand': ['Brand'],
+        'product_original_price': [f'{rng.randint(20, 300)}.00'],
+        'product_price': [f'{rng.randint(10, 200)}.00'],
+        'product_rating': [f'{rng.uniform(1, 5):.1f}'],
+        'product_reviews': [str(rng.randint(0, 500))]
+    }
+    data.update({f'other_{i}': [_text(rng, 3)] for i in range(num_padding)})
+    return {
+        'meta': {'analytics': {'data': data}, 'context': {'page': _text(rng, 30)}},
+        'product': [{
+            'id': rng.randint(1000000, 9999999),
+            'detail': {
+                'description': _text(rng, 80),
+                'bulletText': [_text(rng, 10) for _ in range(6)],
+                'seoKeywords': [_text(rng, 2) for _ in range(5)],
+                'sizeChart': {f'size_{i}': _text(rng, 4) for i in range(20)}
+            },
+            'imagery': {'images': [{'filePath': f'{rng.getrandbits(32):08x}.jpg', 'altText': _text(rng, 4)}
+                                   for _ in range(num_images)]},
+            'traits': {'colors': {'colorMap': [{'normalName': rng.choice(WORDS), 'id': i} for i in range(10)]}}
+        }]
+    }
+
+# macy's xapi review window, some reviews have photos and some have no title
+def macys_reviews_payload(rng, num_reviews=30):
+    reviews = []
+    for _ in range(num_reviews):
+        review = {
+            'authorId': str(rng.randint(10 ** 9, 10 ** 10 - 1)),
+            'rating': rng.randint(1, 5),
+            'reviewText': _text(rng, rng.randint(20, 80)),
+            'totalPositiveFeedbackCount': rng.randint(0, 40),
+            'totalNegativeFeedbackCount': rng.randint(0, 5),
+            'photos': [{'id': f'p{rng.getrandbits(24):06x}',
+                        'sizes': {'normal': {'url': f'{PHOTO_HOST}/photo/{rng.getrandbits(32):08x}.jpg'}}}
+                       for _ in range(rng.randint(0, 2) if rng.random() < 0.3 else 0)],
+            'submissionTime': '2022-05-23T00:00:00.000+00:00'
+        }
+        if rng.random() < 0.9:
+            review['title'] = _text(rng, 5)
+        reviews.append(review)
+    return {'review': {'reviews': reviews, 'totalResults': num_reviews}}
+
+
+# kind -> function that makes the raw bytes of a page
+SYNTHETIC_PAGES = {
+    'bestbuy_product': lambda rng: bestbuy_product_page(rng).encode('utf-8'),
+    'bestbuy_reviews': lambda rng: bestbuy_reviews_page(rng).encode('utf-8'),
+    'macys_listing': lambda rng: macys_listing_page(rng).encode('utf-8'),
+    'macys_product': lambda rng: json.dumps(macys_product_payload(rng)).encode('utf-8'),
+    'macys_reviews': lambda rng: json.dumps(macys_reviews_payload(rng)).encode('utf-8')
+}
+
+
+# write synthetic pages of every kind, the same seed always gives the same bytes so timings stay comparable
+def write_synthetic_fixtures(fixture_dir, extensions, pages_per_kind=3, seed=0):
+    for kind, make_page in SYNTHETIC_PAGES.items():
+
+        # make the directory
+        kind_dir = os.path.join(fixture_dir, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+
+        # each kind gets its own generator, so adding a kind doesn't change the others
+        rng = random.Random(f'{seed}-{kind}')
+        for i in range(pages_per_kind):
+            with open(os.path.join(kind_dir, f'synthetic-{i:02d}{extensions[kind]}'), 'wb') as fp:
+                fp.write(make_page(rng))
@@ -1,7 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from lxml.html import fromstring
 import requests
 import logging
 import re
+from dataset_construction.common.src.selector_registry import Selector, Field, ExtractionEngine, compile_xpath
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.records import BestBuyReview
+
+# declarative spec of the overview section
+BESTBUY_OVERVIEW_FIELDS = [
+    Field('sections', Selector('div', 'class', 'starts-with', 'embedded-component-container lv product-'), list),
+    Field('list_rows', Selector('div', 'class', 'equals', 'list-row'), list)
+]
+OVERVIEW_ENGINE = ExtractionEngine(BESTBUY_OVERVIEW_FIELDS)
+
+# relative expressions used inside the list rows
+H4_XPATH = compile_xpath('h4')
+P_XPATH = compile_xpath('p')
+
+# function to get the text of the first matched element
+def _first_text_content(eles):
+    return eles[0].text_content() if len(eles) > 0 else None
+
+# function to get the image links of the first matched gallery
+def _gallery_links(eles):
+    return [ele.attrib['src'] for ele in GALLERY_IMG_XPATH(eles[0])] if len(eles) > 0 else []
+
+# container of a single review on a review page
+REVIEW_BLOCK_XPATH = compile_xpath('//li[contains(@class, "review-item")]')
+GALLERY_IMG_XPATH = compile_xpath('.//li//button//img')
+
+# declarative spec of a single review, filled with a single walk over its container
+REVIEW_BLOCK_FIELDS = [
+    Field('heading', Selector('div', 'class', 'equals', 'review-heading'), _first_text_content),
+    Field('user', Selector('div', 'class', 'starts-with', 'ugc-author'), _first_text_content),
+    Field('recommendation', Selector('div', 'class', 'contains', 'ugc-recommendation'), _first_text_content),
+    Field('feedback', Selector('div', 'class', 'equals', 'feedback-display'), _first_text_content),
+    Field('body', Selector('div', 'class', 'equals', 'ugc-review-body'), _first_text_content),
+    Field('images', Selector('ul', 'class', 'equals', 'carousel gallery-preview'), _gallery_links)
+]
+REVIEW_BLOCK_ENGINE = ExtractionEngine(REVIEW_BLOCK_FIELDS)
+
+# sort order of the review pages that lists the newest reviews first
+NEWEST_FIRST = 'MOST_RECENT'
+
+# get the total number of reviews from a review page
+def get_total_reviews(doc):
+
+    # get the results range
+    results_range = doc.xpath('//span[@class="message"]')[0].text_content()
+
+    # get total number of reviews
+    return int(results_range.split(' of ')[1].split('reviews')[0].replace(',', '').strip())
+
+# parse a raw product page and get its overview, runs in the parse pool
+def parse_overview_content(content, url):
+    return OverviewScraper(url=url, doc=fromstring(html=content), headers={}).overview_dict
+
+# parse a raw review page and get its reviews, plus the total number of reviews if asked, runs in the parse pool
+def parse_review_content(content, url, count=False):
+
+    # a scraper that only parses, it doesn't fetch anything
+    scraper = ReviewScraper.__new__(ReviewScraper)
+    scraper.url = url
+
+    # parse the page
+    doc_rev = fromstring(html=content)
+    total_reviews = get_total_reviews(doc_rev) if count else None
+
+    # return the total and the reviews
+    return total_reviews, scraper.parse_review_page(doc_rev)
 
 # Class to scrape the overview section
 class OverviewScraper():
@@ -15,8 +83,11 @@ class OverviewScraper():
     # main method that will perform the scraping
     def get_overview_section(self):
 
+        # get all sections and list row elements with a single walk over the tree
+        overview_fields = OVERVIEW_ENGINE.extract(self.doc)
+
         # get all sections
-        overview_sections = self.doc.xpath('//div[starts-with(@class, "embedded-component-container lv product-")]')
+        overview_sections = overview_fields['sections']
 
         # description section
         try:
@@ -25,7 +96,7 @@ class OverviewScraper():
             desc_text = overview_sections[1].text_content().split('(function')[0].split('Description')[1]
 
         # get all of the list row elements
-        list_row_eles = overview_sections[1].xpath('//div[@class="list-row"]')
+        list_row_eles = overview_fields['list_rows']
 
         # make a list to hold all features
         features_list = []
@@ -37,8 +108,8 @@ class OverviewScraper():
             try:
 
                 # get sections of interest
-                header = ele.xpath('h4')[0].text
-                text = ele.xpath('p')[0].text
+                header = H4_XPATH(ele)[0].text
+                text = P_XPATH(ele)[0].text
 
                 # create header-text dictionary
                 header_text_dict = {'header': header, 'description':text}
@@ -75,12 +146,20 @@ class SpecScraper:
         spec_cat_ele = self.doc.xpath('//div[starts-with(@class, "section-title-container")]')
 
 
+# most probes spent on finding the end of the cv thumbnails of a single product, and the highest rung of the
+# ladder, so a host that claims every thumbnail exists can't make the search run away
+MAX_THUMBNAIL_PROBES = 40
+MAX_LADDER_EXPONENT = 11
+
 # Class to scrape thumbnails
 class ThumbnailScraper:
-    def __init__(self, url, doc, headers):
+    def __init__(self, url, doc, headers, session=None, fast_probe=False, max_workers=8):
         self.url = url
         self.doc = doc
         self.headers = headers
+        self.session = session if session is not None else requests
+        self.fast_probe = fast_probe
+        self.max_workers = max_workers
         self.thumbnail_list = []
         self.get_thumbnails()
 
@@ -99,6 +178,12 @@ class ThumbnailScraper:
         # get the endpoint
         endpoint = 'd.jpg;maxHeight=54;maxWidth=54'
 
+        # case when the thumbnails should be probed concurrently
+        if self.fast_probe:
+            self.get_thumbnails_fast(starting_url=starting_url, prod_num=prod_num,
+                                     sku=sku, endpoint=endpoint)
+            return
+
         # all endpoints images start with 11 (for whatever reason)
         i = 11
 
@@ -113,7 +198,7 @@ class ThumbnailScraper:
             ith_thumbnail_url = starting_url + prod_num + '/' + sku + f'cv{i}' + endpoint
 
             # make the request
-            image_potential = requests.get(ith_thumbnail_url, headers=self.headers)
+            image_potential = self.session.get(ith_thumbnail_url, headers=self.headers)
 
             # if the history list has at least 1 item, then you've scraped all thumbnails
             if image_potential.content.startswith(b'\x89'):
@@ -141,7 +226,7 @@ class ThumbnailScraper:
             ith_thumbnail_url = starting_url + prod_num + '/' + sku + thumbnail_pattern + endpoint
 
             # make the request
-            image_potential = requests.get(ith_thumbnail_url, headers=self.headers)
+            image_potential = self.session.get(ith_thumbnail_url, headers=self.headers)
 
             # if an okay url, then add
             if not image_potential.content.startswith(b'\x89'):
@@ -149,11 +234,114 @@ class ThumbnailScraper:
                 # add to list
                 self.thumbnail_list.append(ith_thumbnail_url)
 
+    # check if a thumbnail exists by only fetching its first byte
+    def probe_thumbnail(self, thumbnail_url):
+
+        # only ask for the first byte of the image
+        probe_headers = dict(self.headers, Range='bytes=0-0')
+
+        # stream so the body isn't downloaded up front
+        response = self.session.get(thumbnail_url, headers=probe_headers, stream=True)
+
+        # case when the range was honored, the body is a single byte
+        if response.status_code == 206:
+            first_byte = response.content[:1]
+
+        # a throttled or failed probe says nothing about the thumbnail, so it doesn't count as found
+        elif response.status_code != 200:
+            response.close()
+            return False
+
+        # otherwise, read one byte and drop the rest of the body
+        else:
+            first_byte = response.raw.read(1, decode_content=True)
+            response.close()
+
+        # missing thumbnails are served as a png placeholder, and an empty body isn't an image
+        return len(first_byte) > 0 and not first_byte.startswith(b'\x89')
+
+    # get thumbnails with concurrent, byte-cheap probes
+    def get_thumbnails_fast(self, starting_url, prod_num, sku, endpoint):
+
+        # get the predefined thumbnail urls
+        predefined_urls = [starting_url + prod_num + '/' + sku + thumbnail_pattern + endpoint
+                           for thumbnail_pattern in ['_s', '_r', 'l', '_b']]
+
+        # get the ith cv url
+        def cv_url(i):
+            return starting_url + prod_num + '/' + sku + f'cv{i}' + endpoint
+
+        # get the ith rung of the ladder, all endpoints images start with 11 so it goes 11, 12, 14, 18, ...
+        def rung(k):
+            return 11 + (2 ** k) - 1
+
+        # first round of the ladder, and the exponent the next round starts at
+        ladder = [rung(k) for k in range(6)]
+        next_k = len(ladder)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            # probe the predefined thumbnails along with the first round of the ladder
+            predefined_futures = [executor.submit(self.probe_thumbnail, url) for url in predefined_urls]
+            ladder_found = list(executor.map(self.probe_thumbnail, [cv_url(i) for i in ladder]))
+            num_probes = len(ladder)
+
+            # last index known to exist and first index known to be missing
+            last_found = 10
+            first_missing = None
+
+            # exponential search: find the first rung of the ladder that's missing
+            while first_missing is None:
+                for i, found in zip(ladder, ladder_found):
+                    if not found:
+                        first_missing = i
+                        break
+                    last_found = i
+
+                # every rung existed, stop climbing once the probe budget is spent
+                if first_missing is None:
+                    if num_probes >= MAX_THUMBNAIL_PROBES or next_k > MAX_LADDER_EXPONENT:
+                        logging.warning(f'Gave up probing thumbnails after {num_probes} probes for url: {self.url}')
+                        first_missing = last_found + 1
+                        break
+
+                    # otherwise, keep climbing
+                    ladder = [rung(k) for k in range(next_k, min(next_k + 2, MAX_LADDER_EXPONENT + 1))]
+                    next_k += 2
+                    ladder_found = list(executor.map(self.probe_thumbnail, [cv_url(i) for i in ladder]))
+                    num_probes += len(ladder)
+
+            # binary search for the end of the sequence between the two bounds
+            while first_missing - last_found > 1 and num_probes < MAX_THUMBNAIL_PROBES:
+                middle = (last_found + first_missing) // 2
+                num_probes += 1
+                if self.probe_thumbnail(cv_url(middle)):
+                    last_found = middle
+                else:
+                    first_missing = middle
+
+            # add the predefined thumbnails that exist
+            for url, future in zip(predefined_urls, predefined_futures):
+                if future.result():
+                    self.thumbnail_list.append(url)
+
+        # add every cv thumbnail up to the end of the sequence
+        self.thumbnail_list.extend(cv_url(i) for i in range(11, last_found + 1))
+
 class ReviewScraper:
-    def __init__(self, url, doc, headers):
+    def __init__(self, url, doc, headers, session=None, max_workers=8, watermarks=None, product_key=None,
+                 parse_pool=None):
         self.url = url
         self.doc = doc
         self.headers = headers
+        self.session = session if session is not None else requests
+        self.max_workers = max_workers
+        self.watermarks = watermarks
+        self.product_key = product_key if product_key is not None else url
+        self.parse_pool = parse_pool
+        self.first_page_doc = None
+        self.first_page_reviews = None
+        self.total_reviews = 0
         self.review_headers = []
         self.user_info = []
         self.recommendations = []
@@ -169,23 +357,27 @@ class ReviewScraper:
         # case when there is a review
         try:
 
-            # get the first url
-            first_page = self.url.replace('site', 'site/reviews').replace('.p?', '?variant=A&') + '&page=1'
+            # get the first url, newest first when only the new reviews are wanted
+            sort = f'&sort={NEWEST_FIRST}' if self.watermarks is not None else ''
+            first_page = self.url.replace('site', 'site/reviews').replace('.p?', '?variant=A&') + sort + '&page=1'
 
             # go to the url
-            content = requests.get(first_page, headers=self.headers).content
-
-            # make a doc object out of it
-            first_doc = fromstring(html=content)
+            content = self.session.get(first_page, headers=self.headers).content
 
-            # get the results range
-            results_range = first_doc.xpath('//span[@class="message"]')[0].text_content()
+            # case when the page is parsed in the parse pool, only its reviews come back
+            if self.parse_pool is not None:
+                total_reviews, self.first_page_reviews = self.parse_pool.run(
+                    'bestbuy_reviews', parse_review_content, content, self.url, True)
 
-            # get total number of reviews
-            total_reviews = int(results_range.split(' of ')[1].split('reviews')[0].replace(',','').strip())
+            # otherwise, parse it here and keep the doc around
+            else:
+                with metrics.timer('parse', 'bestbuy_reviews', len(content)):
+                    self.first_page_doc = fromstring(html=content)
+                total_reviews = get_total_reviews(self.first_page_doc)
 
             # find the number of pages
             num_pages = (total_reviews // 20) + 1
+            self.total_reviews = total_reviews
 
             # get all review pages
             self.review_pages = [first_page[:-1] + str(i) for i in range(1, num_pages + 1)]
@@ -205,55 +397,156 @@ class ReviewScraper:
         if len(self.review_pages) == 0:
             return
 
-        # iterate over each review page
-        for rev_page in self.review_pages:
+        # case when only the reviews added since the last run are wanted
+        if self.watermarks is not None:
+            self.get_new_reviews()
+            return
 
-            # make the request
-            rev_req_content = requests.get(rev_page, headers=self.headers).content
+        # fetch every page
+        self.get_all_reviews()
+
+    # get the reviews of every page
+    def get_all_reviews(self):
+
+        # list that holds the reviews of each page, in page order
+        page_reviews = [None] * len(self.review_pages)
+
+        # the first page was already fetched when counting the pages
+        page_reviews[0] = self.get_first_page_reviews()
+
+        # fetch the remaining pages in parallel and parse them as they arrive
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_review_page, rev_page): i
+                       for i, rev_page in enumerate(self.review_pages[1:], start=1)}
+            for future in as_completed(futures):
+                page_reviews[futures[future]] = future.result()
+
+        # create a list of dictionaries corresponding to the reviews pulled
+        for review_list in page_reviews:
+            self.reviews_list.extend(review_list)
+
+    # get the reviews added since the last run, the pages are sorted newest first
+    def get_new_reviews(self):
+
+        # get the watermark of the previous run
+        watermark = self.watermarks.get(self.product_key)
+
+        # the count didn't move, so there's nothing new to fetch
+        if self.watermarks.is_unchanged(watermark, self.total_reviews):
+            return
 
-            # make a lxml parser
+        # case when the product wasn't seen before, every page is fetched in parallel
+        if watermark is None:
+            self.get_all_reviews()
+
+        # otherwise, stop at the first review the previous run had
+        else:
+            for i, rev_page in enumerate(self.review_pages):
+                page = self.get_first_page_reviews() if i == 0 else self.fetch_review_page(rev_page)
+                new_reviews, reached_known = self.watermarks.take_new(page, watermark)
+                self.reviews_list.extend(new_reviews)
+                if reached_known:
+                    break
+
+        # move the watermark past the newest reviews
+        self.watermarks.update(self.product_key, self.total_reviews, self.reviews_list, watermark)
+
+    # get the reviews of the first page, which was fetched when counting the pages
+    def get_first_page_reviews(self):
+        if self.first_page_reviews is not None:
+            return self.first_page_reviews
+        return self.parse_review_page(self.first_page_doc)
+
+    # fetch and parse a single review page
+    def fetch_review_page(self, rev_page):
+
+        # make the request
+        rev_req_content = self.session.get(rev_page, headers=self.headers).content
+
+        # case when the page is parsed in the parse pool
+        if self.parse_pool is not None:
+            return self.parse_pool.run('bestbuy_reviews', parse_review_content, rev_req_content, self.url)[1]
+
+        # make a lxml parser
+        with metrics.timer('parse', 'bestbuy_reviews', len(rev_req_content)):
             doc_rev = fromstring(rev_req_content)
 
-            # get the headers
-            (ratings_list, header_list) = self.get_headers(doc_rev)
+        # get the reviews on the page
+        return self.parse_review_page(doc_rev)
 
-            # get the user info
-            user_info = self.get_user_info(doc_rev)
+    # get all reviews on a parsed review page
+    def parse_review_page(self, doc_rev):
 
-            # gte recommendation
-            recommendations = self.get_recommendations(doc_rev)
+        # time the whole page
+        with metrics.timer('extract', 'ReviewScraper.parse_review_page'):
 
-            # get feedback info
-            (helpful_feedback, unhelpful_feedback) = self.get_feedback(doc_rev)
+            # find each review container once
+            review_blocks = REVIEW_BLOCK_XPATH(doc_rev)
 
-            # get the bodies
-            body_texts = self.get_bodies(doc_rev)
+            # fall back to the whole page scans if the containers aren't there
+            if len(review_blocks) == 0:
+                return self.parse_review_page_by_field(doc_rev)
 
-            # get the list of thumbnails
-            customer_imgs = self.get_review_images(doc_rev, header_list)
+            # pull every field of a review out of its own subtree
+            return [self.parse_review_block(block) for block in review_blocks]
 
-            # zip all lists to make dictionary creation easier
-            zipped_reviews = list(zip(user_info, header_list, ratings_list,
-                                 recommendations, helpful_feedback,
-                                 unhelpful_feedback, body_texts, customer_imgs))
+    # get a single review from its container
+    def parse_review_block(self, block):
 
+        # fill every field with a single walk over the container
+        fields = REVIEW_BLOCK_ENGINE.extract(block)
 
-            # review list
-            review_list = [
-                    {'user': rev[0],
-                     'header': rev[1],
-                     'rating': rev[2],
-                     'recommendation': rev[3],
-                     'feedback': {
-                         'number_helpful': rev[4], 'number_unhelpful': rev[5],
-                                  },
-                     'body': rev[6],
-                     'product_images': rev[7]
-                     } for rev in zipped_reviews
-                ]
+        # separate the rating from the heading
+        heading = fields['heading']
+        rating = heading.split('stars')[0] + 'stars' if heading is not None else None
+        header = heading.split('stars')[1] if heading is not None and 'stars' in heading else None
 
-            # create a list of dictionaries corresponding to the reviews pulled
-            self.reviews_list.extend(review_list)
+        # get the recommendation
+        recommendation = fields['recommendation']
+        if recommendation is not None:
+            recommendation = 'No' if recommendation.strip().startswith('No') else 'Yes'
+
+        # get the number helpful and unhelpful
+        feedback_nums = re.findall(r'\d+', fields['feedback'] or '')
+        number_helpful = int(feedback_nums[0]) if len(feedback_nums) > 0 else None
+        number_unhelpful = int(feedback_nums[1]) if len(feedback_nums) > 1 else None
+
+        # return the review
+        return BestBuyReview(user=fields['user'], header=header, rating=rating, recommendation=recommendation,
+                             number_helpful=number_helpful, number_unhelpful=number_unhelpful, body=fields['body'],
+                             images=fields['images'])
+
+    # get all reviews on a parsed review page with one whole page scan per field
+    def parse_review_page_by_field(self, doc_rev):
+
+        # get the headers
+        (ratings_list, header_list) = self.get_headers(doc_rev)
+
+        # get the user info
+        user_info = self.get_user_info(doc_rev)
+
+        # gte recommendation
+        recommendations = self.get_recommendations(doc_rev)
+
+        # get feedback info
+        (helpful_feedback, unhelpful_feedback) = self.get_feedback(doc_rev)
+
+        # get the bodies
+        body_texts = self.get_bodies(doc_rev)
+
+        # get the list of thumbnails
+        customer_imgs = self.get_review_images(doc_rev, header_list)
+
+        # zip all lists to make record creation easier
+        zipped_reviews = list(zip(user_info, header_list, ratings_list,
+                             recommendations, helpful_feedback,
+                             unhelpful_feedback, body_texts, customer_imgs))
+
+        # review list
+        review_list = [BestBuyReview(*rev) for rev in zipped_reviews]
+
+        # return the reviews
+        return review_list
 
     # get the review images
     def get_review_images(self, doc_rev, header_list):
@@ -1,11 +1,27 @@
+import argparse
+import os
 import requests
 import logging
-import numpy as np
 import time
 import json
 from tqdm import tqdm
 from lxml.html import fromstring
-from dataset_construction.bestbuy_scraper.src.bs4_classes import ReviewScraper, ThumbnailScraper, OverviewScraper, SpecScraper
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dataset_construction.bs4.src.bs4_classes import ReviewScraper, ThumbnailScraper, OverviewScraper, SpecScraper, \
+    parse_overview_content
+from dataset_construction.common.src.checkpoint import Checkpoint
+from dataset_construction.common.src.dedup import NearDuplicateIndex
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.parse_pool import ParsePool, iter_bounded
+from dataset_construction.common.src.frontier import UrlFrontier, iter_urls, canonicalize_url
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+from dataset_construction.common.src.records import encode
+from dataset_construction.common.src.response_cache import ResponseCache
+from dataset_construction.common.src.sinks import make_sink
+from dataset_construction.common.src.session import PooledSession
+from dataset_construction.common.src.watermarks import ReviewWatermarks
 
 # write out product urls
 def write_products(product_dict: dict, out_path: str):
@@ -14,43 +30,70 @@ def write_products(product_dict: dict, out_path: str):
     with open(out_path, 'a', encoding="utf-8") as fp:
 
         # write out the results
-        fp.writelines(str(product_dict) + '\n')
+        fp.write(encode(product_dict) + '\n')
+
+# get the key a product is deduplicated on
+def get_product_key(url):
+
+    # the sku identifies the product
+    if 'skuId=' in url:
+        return 'bestbuy:' + url.split('skuId=')[-1].split('&')[0]
+
+    # otherwise, fall back to the normalized url
+    return canonicalize_url(url)
 
 # scraper
-def bs4_review_scraper(url, out_path):
+def bs4_review_scraper(url, out_path=None, session=None, fast_probe=False, watermarks=None, parse_pool=None):
 
     # headers
     headers = {'User-Agent': 'Mozilla/5.0'}
 
+    # fall back to a fresh connection per request
+    if session is None:
+        session = requests
+
     # get the url
-    cont = requests.get(url, headers=headers).content
+    cont = session.get(url, headers=headers).content
 
-    # get the lxml document
-    lxml_doc = fromstring(html=cont)
+    # case when the page is parsed in the parse pool, only the overview comes back
+    if parse_pool is not None:
+        lxml_doc = None
+        overview_dict = parse_pool.run('OverviewScraper', parse_overview_content, cont, url)
 
-    # scrape thumbnail pics
-    thumbnails = ThumbnailScraper(url=url, doc=lxml_doc, headers=headers)
+    # otherwise, parse it here
+    else:
+
+        # get the lxml document
+        with metrics.timer('parse', 'bestbuy_product', len(cont)):
+            lxml_doc = fromstring(html=cont)
 
-    # overview class
-    overview = OverviewScraper(url=url, doc=lxml_doc, headers=headers)
+        # overview class
+        with metrics.timer('extract', 'OverviewScraper'):
+            overview_dict = OverviewScraper(url=url, doc=lxml_doc, headers=headers).overview_dict
+
+    # scrape thumbnail pics
+    thumbnails = ThumbnailScraper(url=url, doc=lxml_doc, headers=headers, session=session,
+                                  fast_probe=fast_probe)
 
     # scrape the reviews
-    reviews = ReviewScraper(url=url, doc=lxml_doc, headers=headers)
+    reviews = ReviewScraper(url=url, doc=lxml_doc, headers=headers, session=session, watermarks=watermarks,
+                            product_key=get_product_key(url), parse_pool=parse_pool)
 
     # make a dictionary of what you want to return
     url_dict = {
         'url': url,
         'thumbnails': thumbnails.thumbnail_list,
-        'overview_section': overview.overview_dict,
+        'overview_section': overview_dict,
         'reviews': reviews.reviews_list
     }
 
     # case when writing out works
-    try:
-        # write out as text document
-        write_products(url_dict, out_path)
-    except:
-        pass
+    if out_path is not None:
+        try:
+            # write out as text document
+            write_products(url_dict, out_path)
+        except:
+            pass
 
     # return the dictionary
     return url_dict
@@ -67,31 +110,158 @@ if __name__ == "__main__":
     # output path
     output_path = r'../data/bestbuy_scraped.json'
 
-    # list to hold all data
-    data = []
+    # create logger
+    logging.basicConfig(filename="../logs/bs4.log", level=logging.DEBUG)
 
-    # open the file and read all data
-    with open(input_path, 'r') as fp:
-        for line in fp.readlines():
-            data.append(line.replace('\n', ''))
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the urls completed by a previous run')
+    parser.add_argument('--sink', choices=['jsonl', 'parquet', 'arrow'], default='jsonl',
+                        help='kind of sink the products are written to')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve repeat requests from the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='replay responses from the cache without touching the network')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the reviews added since the last run, newest first')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='parse in this many processes while the pages are fetched, 0 parses inline')
+    parser.add_argument('--fetch-workers', type=int, default=8,
+                        help='number of products fetched at once when parsing in processes')
+    parser.add_argument('--dedup', action='store_true',
+                        help='drop reviews that are near duplicates of a review seen before')
+    parser.add_argument('--dedup-capacity', type=int, default=200000,
+                        help='number of recent reviews the dedup remembers')
+    args = parser.parse_args()
 
-    # only get the unique data
-    data = np.unique(data)
+    # stream the urls into the frontier, which keeps one url per sku across runs, and crawl only this run's
+    frontier = UrlFrontier('../data/bestbuy_frontier.sqlite', key_func=get_product_key)
+    run_urls = frontier.add_run(iter_urls(input_path))
+    frontier.close()
 
-    # create logger
-    logging.basicConfig(filename="../logs/bs4.log", level=logging.DEBUG)
+    # on-disk response cache, offline replay only reads from it
+    cache = ResponseCache('../data/http_cache', offline=args.offline) if args.cache or args.offline else None
+
+    # high-water marks of the reviews seen by previous runs
+    watermarks = None
+    if args.incremental:
+        watermarks = ReviewWatermarks('../data/bestbuy_review_watermarks.sqlite', fields=('user', 'header', 'body'))
+
+    # reviews of the last finished run, an incremental run only fetches the new ones and merges them in
+    previous_reviews = {}
+    if watermarks is not None:
+        if os.path.exists(output_path):
+            with open(output_path, 'r', encoding='utf-8') as fp:
+                previous_reviews = {get_product_key(previous['url']): previous.get('reviews') or []
+                                    for previous in json.load(fp)}
+        else:
+            logging.warning(f'No previous output at {output_path}, products will only have their new reviews')
+
+    # results are flushed here as they come in
+    checkpoint = Checkpoint(r'../data/bestbuy_scraped.jsonl', resume=args.resume)
+
+    # sink that the products are written to as they come in
+    sink_path = output_txt if args.sink == 'jsonl' else f'../data/bestbuy_scraped_{args.sink}'
+    sink = make_sink(args.sink, sink_path,
+                     key_func=lambda record: record['url'].split('skuId=')[-1].split('&')[0],
+                     reviews_field='reviews')
+
+    # session that keeps connections to bestbuy.com and the image host alive
+    rate_limiter = AdaptiveRateLimiter()
+    session = PooledSession(pool_connections=4, pool_maxsize=8, rate_limiter=rate_limiter,
+                            policy=FetchPolicy(hedge=True), cache=cache)
+
+    # the stage metrics are exported while the crawl runs
+    metrics.start_exporter('../data/bestbuy_metrics.prom')
+
+    # near-duplicate reviews are dropped as each product comes in, seeded with what a resumed run already wrote
+    dedup = None
+    if args.dedup:
+        dedup = NearDuplicateIndex(capacity=args.dedup_capacity)
+        if args.resume:
+            for previous in checkpoint.load_results():
+                dedup.filter_reviews(previous.get('reviews') or [], 'body')
+
+    # function to write out and flush the results
+    def handle_result(url, url_info):
+        if watermarks is not None:
+            url_info['reviews'] = watermarks.merge(url_info['reviews'], previous_reviews.pop(get_product_key(url), []))
+        if dedup is not None:
+            with metrics.timer('dedup', 'bestbuy_reviews'):
+                url_info['reviews'] = dedup.filter_reviews(url_info['reviews'], 'body')
+        with metrics.timer('write', 'sink'):
+            sink.write(url_info)
+        with metrics.timer('write', 'checkpoint'):
+            checkpoint.record(url, url_info)
+
+    # case when the parsing runs in processes, several products are fetched at once to keep them busy
+    if args.parse_workers > 0:
+
+        # skip the urls that are already done
+        urls = [url for url in run_urls if not checkpoint.is_done(url)]
+
+        # fetch on threads, parse in processes, and write out in completion order
+        parse_pool = ParsePool(max_workers=args.parse_workers)
+        with ThreadPoolExecutor(max_workers=args.fetch_workers) as fetch_executor:
+            scraper = partial(bs4_review_scraper, session=session, fast_probe=True, watermarks=watermarks,
+                              parse_pool=parse_pool)
+            for url, future in tqdm(iter_bounded(fetch_executor, scraper, urls, 2 * args.fetch_workers),
+                                    total=len(urls)):
+
+                # a failing product shouldn't stop the crawl
+                try:
+                    url_info = future.result()
+                except Exception as e:
+                    logging.warning(f'Failed to scrape url: {url} ({e!r})')
+                    metrics.error('crawl', 'bestbuy_product')
+                    continue
+                handle_result(url, url_info)
+        parse_pool.close()
+
+    # otherwise, go one at a time
+    else:
+
+        # iterate over each url
+        for url in tqdm(run_urls):
+
+            # skip the urls that are already done
+            if checkpoint.is_done(url):
+                continue
+
+            # run the scraper, a failing product shouldn't stop the crawl
+            try:
+                url_info = bs4_review_scraper(url, session=session, fast_probe=True, watermarks=watermarks)
+            except Exception as e:
+                logging.warning(f'Failed to scrape url: {url} ({e!r})')
+                metrics.error('crawl', 'bestbuy_product')
+                continue
+
+            # write out and flush the results
+            handle_result(url, url_info)
 
-    # list to hold results
-    scraped_list = []
+    # log how many connections were reused
+    for host, host_stats in session.get_stats().items():
+        logging.info(f"{host}: {host_stats['requests']} requests, {host_stats['new_connections']} new "
+                     f"connections, {host_stats['reused_connections']} reused connections")
+    for host, rate in rate_limiter.get_rates().items():
+        logging.info(f"{host}: {rate['rate']:.2f} requests/sec, {rate['concurrency']} in flight")
+    session.close()
 
-    # iterate over each url
-    for url in tqdm(data):
+    # write out the stage metrics
+    metrics.stop_exporter('../data/bestbuy_metrics.prom')
+    metrics.write_json('../data/bestbuy_metrics.json')
 
-        # run the scraper
-        url_info = bs4_review_scraper(url, output_txt)
+    # log how many reviews the dedup dropped
+    if dedup is not None:
+        logging.info(f'Dropped {dedup.num_duplicates} of {dedup.num_seen} reviews as near duplicates')
 
-        # add scraping results to list
-        scraped_list.append(url_info)
+    # get the results of this and every previous run
+    scraped_list = checkpoint.load_results()
+    checkpoint.close()
+    sink.close()
+    if watermarks is not None:
+        watermarks.close()
 
     # write to json
     with open(output_path, 'w') as fp:
@@ -1,11 +1,15 @@
-def get_product_info(doc):
+from dataset_construction.common.src.selector_registry import compile_xpath
+
+# compiled paths of the product info
+NAME_XPATH = compile_xpath('//div[starts-with(@id, "shop-product-title")]')
+DIV_XPATH = compile_xpath('.//div')
+A_XPATH = compile_xpath('.//a')
 
-    # define the name path
-    name_path = '//div[starts-with(@id, "shop-product-title")]'
+def get_product_info(doc):
 
     # get the name ele
     try:
-        name_ele = doc.xpath(name_path)[0]
+        name_ele = NAME_XPATH(doc)[0]
     except:
         # something is wrong with url
         return {}
@@ -13,7 +17,7 @@ def get_product_info(doc):
     # return a dictionary with all information
     try:
         return {
-            'company': name_ele.xpath('.//div')[0].xpath('.//a')[0].text,
+            'company': A_XPATH(DIV_XPATH(name_ele)[0])[0].text,
             'product_name': name_ele.find_class('sku-title')[0].text_content()
         }
 
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+from dataset_construction.common.src.records import encode
+
+
+# read the scraped products, either a json list or one json document per line
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as fp:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in fp if line.endswith('\n')]
+        return json.load(fp)
+
+
+# class that flushes results as they come in and remembers which products are done
+class Checkpoint:
+    def __init__(self, results_path, manifest_path=None, resume=False):
+        self.results_path = results_path
+        self.manifest_path = manifest_path if manifest_path is not None else results_path + '.manifest'
+        self.completed = set()
+
+        # case when a previous run should be picked up
+        if resume:
+            self.load_manifest()
+
+        # otherwise, start from scratch
+        else:
+            for path in (self.results_path, self.manifest_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        # both files are only ever appended to
+        self.results_fp = open(self.results_path, 'a', encoding='utf-8')
+        self.manifest_fp = open(self.manifest_path, 'a', encoding='utf-8')
+
+        # end a partially written last line so the next result starts on its own line
+        for fp, path in ((self.results_fp, self.results_path), (self.manifest_fp, self.manifest_path)):
+            if os.path.getsize(path) > 0:
+                with open(path, 'rb') as check_fp:
+                    check_fp.seek(-1, os.SEEK_END)
+                    if check_fp.read(1) != b'\n':
+                        fp.write('\n')
+
+    # read the keys that were completed by previous runs
+    def load_manifest(self):
+
+        # nothing to load on the first run
+        if not os.path.exists(self.manifest_path):
+            return
+
+        # one key per line
+        with open(self.manifest_path, 'r', encoding='utf-8') as fp:
+            self.completed = {line.rstrip('\n') for line in fp if line.endswith('\n')}
+
+        logging.info(f'Resuming with {len(self.completed)} completed keys from {self.manifest_path}')
+
+    # check if a key was already scraped
+    def is_done(self, key):
+        return str(key) in self.completed
+
+    # write out a result and mark its key as done
+    def record(self, key, result):
+
+        # the result goes out first, so a crash never marks a key done without its result
+        self.results_fp.write(encode(result) + '\n')
+        self.results_fp.flush()
+
+        # mark the key as done
+        self.manifest_fp.write(f'{key}\n')
+        self.manifest_fp.flush()
+        self.completed.add(str(key))
+
+    # read back every result flushed so far, across all runs
+    def load_results(self):
+
+        # make sure everything is on disk
+        self.results_fp.flush()
+
+        # list to hold the results
+        results = []
+
+        # one json document per line
+        with open(self.results_path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+
+                # a crash can leave a partially written last line behind
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f'Skipping a partially written result in {self.results_path}')
+
+        # return the results
+        return results
+
+    # close both files
+    def close(self):
+        self.results_fp.close()
+        self.manifest_fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
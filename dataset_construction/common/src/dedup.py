@@ -0,0 +1,127 @@
+from collections import deque
+
+
+# near-duplicate detection of review texts, minhash signatures bucketed with lsh so a text is only compared
+# against the few reviews that share a band with it, and only the newest reviews are remembered
+class NearDuplicateIndex:
+    def __init__(self, num_perm=128, bands=16, threshold=0.8, shingle_size=5, capacity=200000, seed=1):
+
+        # numpy is only needed by the dedup stage
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('numpy is required for the review dedup: pip install numpy')
+        self.np = numpy
+
+        # the signature is cut into bands of rows, two reviews are compared if any band matches
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) has to be a multiple of bands ({bands})')
+
+        # shingles are packed into a single 64 bit integer
+        if not 1 <= shingle_size <= 8:
+            raise ValueError(f'shingle_size has to be between 1 and 8, got {shingle_size}')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.capacity = capacity
+
+        # multiply-shift hashes, one per permutation, plus the multipliers that hash a band into a bucket key
+        rng = numpy.random.default_rng(seed)
+        self.perm_mult = rng.integers(0, 2 ** 63, size=num_perm, dtype=numpy.uint64) * 2 + 1
+        self.perm_add = rng.integers(0, 2 ** 63, size=num_perm, dtype=numpy.uint64)
+        self.band_mult = rng.integers(0, 2 ** 63, size=self.rows, dtype=numpy.uint64) * 2 + 1
+
+        # byte weights that pack a shingle into an integer
+        self.byte_weights = numpy.uint64(256) ** numpy.arange(shingle_size, dtype=numpy.uint64)
+
+        # band -> bucket key -> id of the last review in the bucket
+        self.buckets = [{} for _ in range(bands)]
+
+        # id -> (signature, bucket keys), and the ids from oldest to newest so the oldest can be dropped
+        self.entries = {}
+        self.order = deque()
+        self.next_id = 0
+
+        # counters
+        self.num_seen = 0
+        self.num_duplicates = 0
+
+    # get the minhash signature of a text
+    def signature(self, text):
+        np = self.np
+
+        # shingles are overlapping runs of bytes of the normalized text, short texts are a single shingle
+        data = np.frombuffer(' '.join(text.lower().split()).encode('utf-8'), dtype=np.uint8)
+        if len(data) < self.shingle_size:
+            data = np.pad(data, (0, self.shingle_size - len(data)))
+        windows = np.lib.stride_tricks.sliding_window_view(data, self.shingle_size)
+        shingles = np.unique(windows.astype(np.uint64) @ self.byte_weights)
+
+        # every shingle through every permutation at once, in place since the temporaries dominate the time
+        hashes = np.multiply.outer(shingles, self.perm_mult)
+        hashes += self.perm_add
+
+        # the signature is the smallest hash of each permutation, the top 32 bits of it
+        return (hashes.min(axis=0) >> np.uint64(32)).astype(np.uint32)
+
+    # get the bucket key of every band of a signature
+    def bucket_keys(self, signature):
+        bands = signature.reshape(self.bands, self.rows).astype(self.np.uint64)
+        return (bands * self.band_mult).sum(axis=1).tolist()
+
+    # find a remembered review that's a near duplicate, None if there isn't one
+    def query(self, signature, keys):
+
+        # reviews that share at least one band
+        candidates = {self.buckets[band].get(key) for band, key in enumerate(keys)}
+        candidates.discard(None)
+
+        # the share of equal minhashes estimates the jaccard similarity
+        for candidate in candidates:
+            if (self.entries[candidate][0] == signature).mean() >= self.threshold:
+                return candidate
+        return None
+
+    # remember a review, dropping the oldest one when the index is full
+    def add(self, signature, keys):
+
+        # drop the oldest, its buckets may have been taken over by newer reviews since
+        if len(self.order) >= self.capacity:
+            old_id = self.order.popleft()
+            _, old_keys = self.entries.pop(old_id)
+            for band, key in enumerate(old_keys):
+                if self.buckets[band].get(key) == old_id:
+                    del self.buckets[band][key]
+
+        # add the review
+        review_id = self.next_id
+        self.next_id += 1
+        self.entries[review_id] = (signature, keys)
+        self.order.append(review_id)
+        for band, key in enumerate(keys):
+            self.buckets[band][key] = review_id
+
+    # check if a text is a near duplicate of one seen before, and remember it if it isn't
+    def is_duplicate(self, text):
+
+        # reviews without a text can't be compared
+        if not text:
+            return False
+        self.num_seen += 1
+
+        # look for a near duplicate
+        signature = self.signature(text)
+        keys = self.bucket_keys(signature)
+        if self.query(signature, keys) is not None:
+            self.num_duplicates += 1
+            return True
+
+        # otherwise, remember it
+        self.add(signature, keys)
+        return False
+
+    # drop the reviews whose text is a near duplicate of one seen before
+    def filter_reviews(self, reviews, field):
+        return [review for review in reviews if not self.is_duplicate(review.get(field))]
@@ -0,0 +1,65 @@
+import random
+import threading
+import time
+from collections import defaultdict, deque
+import requests
+
+
+# raised when a request runs past its total deadline
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+# rolling window of recent latencies per host, used to pick the hedging delay
+class LatencyTracker:
+    def __init__(self, window=200):
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    # record the latency of a successful request
+    def record(self, host, latency):
+        with self.lock:
+            self.latencies[host].append(latency)
+
+    # get a quantile of the recent latencies, None if there aren't enough samples
+    def quantile(self, host, q, min_samples):
+        with self.lock:
+            samples = sorted(self.latencies[host])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# deadlines, retries and hedging for idempotent GET requests
+class FetchPolicy:
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, total_timeout=90.0, retries=3,
+                 backoff=0.5, max_backoff=30.0, retry_statuses=(429, 500, 502, 503, 504),
+                 hedge=False, hedge_quantile=0.95, hedge_min_samples=20):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_tracker = LatencyTracker()
+
+    # jittered exponential backoff before the given retry, a Retry-After can only make it longer
+    def backoff_time(self, attempt, retry_after=None):
+        wait = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+    # get the delay after which a duplicate request is sent, None if hedging is off or there's no history
+    def hedge_delay(self, host):
+        if not self.hedge:
+            return None
+        return self.latency_tracker.quantile(host, self.hedge_quantile, self.hedge_min_samples)
+
+    # get the time left before the deadline
+    def remaining(self, deadline):
+        return deadline - time.monotonic()
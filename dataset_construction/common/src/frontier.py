@@ -0,0 +1,134 @@
+import re
+import sqlite3
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# urls that were written without a newline in between end up glued together on one line
+GLUED_URL_PATTERN = re.compile(r'(?=https?://)|(?=/shop/product/)')
+
+
+# lazily read the urls of a file, one at a time
+def iter_urls(path, prefix=''):
+
+    # open the file
+    with open(path, 'r', encoding='utf-8') as fp:
+
+        # the file is streamed, never read into memory at once
+        for line in fp:
+
+            # split up glued urls
+            for url in GLUED_URL_PATTERN.split(line.strip()):
+
+                # skip the empty pieces
+                if len(url) == 0:
+                    continue
+
+                # make relative urls absolute
+                yield prefix + url if url.startswith('/') else url
+
+
+# normalize a url so the same page always has the same string
+def canonicalize_url(url):
+
+    # split up the url
+    parts = urlsplit(url.strip())
+
+    # lowercase the scheme and host, sort the query and drop the fragment
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+# on-disk set of urls keyed by product, shared across runs
+class UrlFrontier:
+    def __init__(self, db_path, key_func=canonicalize_url):
+        self.db_path = db_path
+        self.key_func = key_func
+
+        # the primary key index keeps every lookup on disk
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS frontier '
+                          '(key TEXT PRIMARY KEY, url TEXT NOT NULL, added_at REAL NOT NULL)')
+        self.conn.commit()
+
+    # add a url, returns True if its key wasn't seen before
+    def add(self, url, commit=True):
+
+        # insert unless the key is already there
+        cursor = self.conn.execute('INSERT OR IGNORE INTO frontier (key, url, added_at) VALUES (?, ?, ?)',
+                                   (str(self.key_func(url)), url, time.time()))
+        if commit:
+            self.conn.commit()
+
+        # a row was only inserted if the key is new
+        return cursor.rowcount == 1
+
+    # add urls in batches, returns how many keys weren't seen before
+    def add_many(self, urls, batch_size=10000):
+
+        # number of new keys
+        num_new = 0
+
+        # iterate over the urls, committing every batch
+        for i, url in enumerate(urls, start=1):
+            num_new += self.add(url, commit=False)
+            if i % batch_size == 0:
+                self.conn.commit()
+
+        # commit the last batch
+        self.conn.commit()
+        return num_new
+
+    # add the urls of a batch in a single transaction, returns the ones whose key wasn't seen before, in order
+    def add_new(self, urls):
+        new_urls = [url for url in urls if self.add(url, commit=False)]
+        self.conn.commit()
+        return new_urls
+
+    # add the urls of a run, returns them with one url per key so a run only crawls its own input
+    def add_run(self, urls, batch_size=10000):
+
+        # keys of this run, the frontier itself may hold the keys of every previous run
+        run_keys = set()
+        run_urls = []
+
+        # iterate over the urls, committing every batch
+        for i, url in enumerate(urls, start=1):
+            self.add(url, commit=False)
+            key = str(self.key_func(url))
+            if key not in run_keys:
+                run_keys.add(key)
+                run_urls.append(url)
+            if i % batch_size == 0:
+                self.conn.commit()
+
+        # commit the last batch
+        self.conn.commit()
+        return run_urls
+
+    # check if the key of a url was seen before
+    def __contains__(self, url):
+        cursor = self.conn.execute('SELECT 1 FROM frontier WHERE key = ?', (str(self.key_func(url)),))
+        return cursor.fetchone() is not None
+
+    # number of unique keys
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM frontier').fetchone()[0]
+
+    # stream the urls in the order they were added
+    def __iter__(self):
+
+        # a separate cursor so adding urls while iterating doesn't reset it
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT url FROM frontier ORDER BY rowid')
+        for (url,) in cursor:
+            yield url
+
+    # close the database
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from dataset_construction.common.src.metrics import metrics
+
+
+# get the format, width and height of an image from its header bytes, (None, None, None) if it isn't known
+def image_dimensions(data):
+
+    # png, the size is in the ihdr chunk right after the signature
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height
+
+    # gif, the size of the logical screen
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        width, height = struct.unpack('<HH', data[6:10])
+        return 'gif', width, height
+
+    # webp, the size is stored differently by each of the three encodings
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            return 'webp', width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L':
+            bits = int.from_bytes(data[21:25], 'little')
+            return 'webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X':
+            return 'webp', int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+
+    # jpeg, walk the segments until the start of frame
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(data):
+
+            # skip anything that isn't a marker, and the fill bytes before one
+            if data[i] != 0xff or data[i + 1] == 0xff:
+                i += 1
+                continue
+            marker = data[i + 1]
+
+            # markers without a length
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                i += 2
+                continue
+
+            # start of frame, except the huffman, arithmetic and jpeg-ls tables that share the range
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return 'jpeg', width, height
+
+            # skip the segment
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+
+    # unknown format
+    return None, None, None
+
+
+# content-addressed store of downloaded images, identical bytes are kept once whatever url they came from
+class ImageStore:
+    def __init__(self, root, session=None, headers=None, max_workers=16):
+        self.root = root
+        self.session = session if session is not None else requests
+        self.headers = headers if headers is not None else {}
+        self.max_workers = max_workers
+        os.makedirs(root, exist_ok=True)
+
+        # the index maps urls to hashes and keeps the size and dimensions of every image, shared by the threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                          'format TEXT, width INTEGER, height INTEGER, stored_at REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+        self.conn.commit()
+
+    # get the path of an image, fanned out over subdirectories so no directory gets too big
+    def path_of(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    # get the hash a url was stored under, None if it wasn't fetched yet
+    def lookup(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT digest FROM urls WHERE url = ?', (url,)).fetchone()
+        return row[0] if row is not None else None
+
+    # store the bytes of an image, returns the hash
+    def put(self, data):
+
+        # the hash is the name
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_of(digest)
+
+        # case when the same bytes came from another url
+        if os.path.exists(path):
+            return digest
+
+        # written under a temporary name first, so a crash never leaves half an image behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+        # index the image
+        image_format, width, height = image_dimensions(data)
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO images (digest, size, format, width, height, stored_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (digest, len(data), image_format, width, height, time.time()))
+            self.conn.commit()
+
+        # return the hash
+        return digest
+
+    # download a single image, skipped if the url is already in the store
+    def fetch(self, url):
+
+        # case when a previous run already stored it
+        digest = self.lookup(url)
+        if digest is not None and os.path.exists(self.path_of(digest)):
+            return digest
+
+        # make the request
+        response = self.session.get(url, headers=self.headers)
+        response.raise_for_status()
+
+        # store the bytes and remember the url
+        with metrics.timer('store', 'images', len(response.content)):
+            digest = self.put(response.content)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)', (url, digest))
+            self.conn.commit()
+
+        # return the hash
+        return digest
+
+    # download images concurrently, returns url -> hash with None for the ones that failed
+    def fetch_many(self, urls):
+
+        # the same url is only downloaded once
+        unique_urls = list(dict.fromkeys(url for url in urls if url))
+
+        # function that doesn't let a single image stop the rest
+        def fetch_one(url):
+            try:
+                return self.fetch(url)
+            except Exception as e:
+                logging.warning(f'Failed to fetch image: {url} ({e!r})')
+                metrics.error('image', urlsplit(url).netloc)
+                return None
+
+        # download them
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(unique_urls, executor.map(fetch_one, unique_urls)))
+
+    # get the number of urls and images, and the bytes on disk
+    def stats(self):
+        with self.lock:
+            num_urls = self.conn.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+            num_images, num_bytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images').fetchone()
+        return {'urls': num_urls, 'images': num_images, 'bytes': num_bytes}
+
+    # close the index
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the latency buckets in seconds, the last bucket catches everything
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# latency histogram plus the bytes and errors of a single stage and target
+class StageHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes = 0
+        self.errors = 0
+
+    # add a latency
+    def observe(self, seconds, nbytes=0):
+
+        # find the first bucket that holds it
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+
+        # update the totals
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.bytes += nbytes
+
+    # estimate a quantile from the bucket bounds
+    def quantile(self, q):
+
+        # case when nothing was observed
+        if self.count == 0:
+            return None
+
+        # walk the buckets until the quantile is covered
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    # get a summary of the histogram
+    def summary(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'seconds': self.sum,
+                'mean_seconds': self.sum / self.count if self.count > 0 else None,
+                'p50_seconds': self.quantile(0.5),
+                'p90_seconds': self.quantile(0.9),
+                'p99_seconds': self.quantile(0.99)}
+
+
+# latencies, bytes and errors of every stage of a crawl, per host or per extractor
+class StageMetrics:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.exporter = None
+        self.exporter_stop = threading.Event()
+
+    # get the histogram of a stage and target, creating it on first use
+    def get_histogram(self, stage, target):
+        key = (stage, target)
+        if key not in self.histograms:
+            self.histograms[key] = StageHistogram()
+        return self.histograms[key]
+
+    # record how long a stage took
+    def observe(self, stage, target, seconds, nbytes=0):
+        with self.lock:
+            self.get_histogram(stage, target).observe(seconds, nbytes)
+
+    # record a failed stage
+    def error(self, stage, target):
+        with self.lock:
+            self.get_histogram(stage, target).errors += 1
+
+    # time the code inside the with block, an exception counts as an error of the stage
+    @contextmanager
+    def timer(self, stage, target, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(stage, target)
+            raise
+        self.observe(stage, target, time.perf_counter() - start, nbytes)
+
+    # get a summary of every stage, with the totals first so the bottleneck stands out
+    def summary(self):
+
+        # copy the histograms under the lock
+        with self.lock:
+            targets = {}
+            for (stage, target), histogram in sorted(self.histograms.items()):
+                targets.setdefault(stage, {})[target] = histogram.summary()
+
+        # add up each stage over its targets
+        stages = {stage: {'count': sum(t['count'] for t in stage_targets.values()),
+                          'errors': sum(t['errors'] for t in stage_targets.values()),
+                          'bytes': sum(t['bytes'] for t in stage_targets.values()),
+                          'seconds': sum(t['seconds'] for t in stage_targets.values())}
+                  for stage, stage_targets in targets.items()}
+
+        # return the summary
+        return {'started_at': self.started_at,
+                'elapsed_seconds': time.time() - self.started_at,
+                'stages': stages,
+                'targets': targets}
+
+    # write out the summary as json
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as fp:
+            json.dump(self.summary(), fp, indent=4)
+
+    # get the metrics in the prometheus text format
+    def to_prometheus(self):
+
+        # lines of the exposition
+        lines = ['# HELP scraper_stage_seconds Latency of each stage of the crawl.',
+                 '# TYPE scraper_stage_seconds histogram']
+        bytes_lines = ['# HELP scraper_stage_bytes_total Bytes handled by each stage of the crawl.',
+                       '# TYPE scraper_stage_bytes_total counter']
+        error_lines = ['# HELP scraper_stage_errors_total Failures of each stage of the crawl.',
+                       '# TYPE scraper_stage_errors_total counter']
+
+        # iterate over each histogram
+        with self.lock:
+            for (stage, target), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",target="{target}"'
+
+                # buckets are cumulative
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'scraper_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'scraper_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'scraper_stage_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'scraper_stage_seconds_count{{{labels}}} {histogram.count}')
+                bytes_lines.append(f'scraper_stage_bytes_total{{{labels}}} {histogram.bytes}')
+                error_lines.append(f'scraper_stage_errors_total{{{labels}}} {histogram.errors}')
+
+        # return the text
+        return '\n'.join(lines + bytes_lines + error_lines) + '\n'
+
+    # write out the prometheus text, replaced in one go so a scraper never reads half a file
+    def write_prometheus(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    # keep rewriting the prometheus file while the crawl runs
+    def start_exporter(self, path, interval=15.0):
+
+        # function that runs on the exporter thread
+        def export():
+            while not self.exporter_stop.wait(interval):
+                self.write_prometheus(path)
+
+        # start the thread
+        self.exporter_stop.clear()
+        self.exporter = threading.Thread(target=export, daemon=True)
+        self.exporter.start()
+
+    # stop the exporter and write out the final numbers
+    def stop_exporter(self, path):
+        if self.exporter is not None:
+            self.exporter_stop.set()
+            self.exporter.join()
+            self.exporter = None
+        self.write_prometheus(path)
+
+
+# metrics shared by every stage of a crawl
+metrics = StageMetrics()
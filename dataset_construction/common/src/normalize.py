@@ -0,0 +1,127 @@
+# values the scrapers use for a field they couldn't find
+MISSING_VALUES = ['', 'N/A', 'n/a', 'NA', 'None', 'none', 'null', '-1', '-1.0']
+
+# first number in a string, e.g. 1299.99 in "$1,299.99" or 5 in "Rated 5 out of 5 stars"
+NUMBER_PATTERN = r'(?P<number>-?\d+(?:\.\d+)?)'
+
+# kind of every product field that gets normalized, nested fields are dotted
+PRODUCT_FIELDS = {
+    'price': 'float',
+    'original_price': 'float',
+    'current_price': 'float',
+    'product_rating': 'float',
+    'number_reviews': 'int',
+    'product_name': 'text',
+    'brand': 'text',
+    'product_brand': 'text',
+    'category': 'text',
+    'description.paragraph': 'text'
+}
+
+# kind of every review field that gets normalized
+REVIEW_FIELDS = {
+    'rating': 'float',
+    'recommendation': 'bool',
+    'number_positive_feedback': 'int',
+    'number_negative_feedback': 'int',
+    'feedback.number_helpful': 'int',
+    'feedback.number_unhelpful': 'int',
+    'user': 'text',
+    'user_id': 'text',
+    'header': 'text',
+    'review_title': 'text',
+    'body': 'text',
+    'review_body': 'text'
+}
+
+# fields the reviews of a product are nested under
+REVIEW_LISTS = ('product_reviews', 'reviews')
+
+
+# turns whole columns of raw scraped strings into typed, nullable columns with arrow kernels
+class ColumnNormalizer:
+    def __init__(self, product_fields=None, review_fields=None):
+        self.product_fields = product_fields if product_fields is not None else PRODUCT_FIELDS
+        self.review_fields = review_fields if review_fields is not None else REVIEW_FIELDS
+
+        # pyarrow is only needed by the normalization pass
+        try:
+            import pyarrow
+            import pyarrow.compute
+        except ImportError:
+            raise ImportError('pyarrow is required for the normalization pass: pip install pyarrow')
+        self.pa = pyarrow
+        self.pc = pyarrow.compute
+
+    # get the column as trimmed strings, with every missing value as null
+    def clean(self, values):
+        pa, pc = self.pa, self.pc
+
+        # columns of a single type are converted by arrow, mixed ones go through str first
+        try:
+            column = pc.cast(pa.array(values), pa.string())
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            column = pa.array([None if value is None else str(value) for value in values], type=pa.string())
+        column = pc.utf8_trim_whitespace(column)
+        return pc.if_else(pc.is_in(column, value_set=pa.array(MISSING_VALUES)), pa.scalar(None, pa.string()), column)
+
+    # get the first number of every value, separators and currency signs are dropped first
+    def to_number(self, column, data_type):
+        pc = self.pc
+        column = pc.replace_substring_regex(column, pattern=r'[$,]', replacement='')
+        numbers = pc.struct_field(pc.extract_regex(column, pattern=NUMBER_PATTERN), [0])
+        return pc.cast(pc.cast(numbers, self.pa.float64()), data_type, safe=False)
+
+    # get yes/true as true and no/false as false, anything else as null
+    def to_bool(self, column):
+        pa, pc = self.pa, self.pc
+        lowered = pc.utf8_lower(column)
+        is_true = pc.or_(pc.starts_with(lowered, 'yes'), pc.equal(lowered, 'true'))
+        is_false = pc.or_(pc.starts_with(lowered, 'no'), pc.equal(lowered, 'false'))
+        return pc.if_else(is_true, True, pc.if_else(is_false, False, pa.scalar(None, pa.bool_())))
+
+    # normalize a column of raw values of a kind, returns the python values
+    def normalize_column(self, values, kind):
+        column = self.clean(values)
+        if kind == 'float':
+            column = self.to_number(column, self.pa.float64())
+        elif kind == 'int':
+            column = self.to_number(column, self.pa.int64())
+        elif kind == 'bool':
+            column = self.to_bool(column)
+        elif kind != 'text':
+            raise ValueError(f'Unknown kind of field: {kind}')
+        return column.to_pylist()
+
+    # normalize the fields of a list of records in place, one column at a time
+    def normalize_fields(self, records, fields):
+        for path, kind in fields.items():
+
+            # find the dict each record keeps the field in, records without the field are left alone
+            *parents, key = path.split('.')
+            holders = records
+            for parent in parents:
+                holders = [holder[parent] for holder in holders if isinstance(holder.get(parent), dict)]
+            holders = [holder for holder in holders if key in holder]
+
+            # nothing to normalize
+            if len(holders) == 0:
+                continue
+
+            # normalize the whole column at once and put it back
+            for holder, value in zip(holders, self.normalize_column([holder[key] for holder in holders], kind)):
+                holder[key] = value
+
+    # normalize scraped products and their reviews in place
+    def normalize(self, products):
+
+        # the products
+        self.normalize_fields(products, self.product_fields)
+
+        # the reviews of every product, as one column
+        reviews = [review for product in products for field in REVIEW_LISTS
+                   for review in (product.get(field) or [])]
+        self.normalize_fields(reviews, self.review_fields)
+
+        # return the products
+        return products
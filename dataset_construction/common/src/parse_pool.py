@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from dataset_construction.common.src.metrics import metrics
+
+
+# run an extractor in a worker process and time it there
+def _timed_call(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+# process pool that runs the cpu heavy parsing and extraction off the fetch threads
+class ParsePool:
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.max_pending = max_pending if max_pending is not None else 2 * self.max_workers
+
+        # spawn so the workers don't inherit the locks of the fetch threads
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+        # bounded number of pages waiting to be parsed, so fetching can't run ahead of parsing
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+    # send raw bytes to a worker and wait for the compact result, func has to be importable by the workers
+    def run(self, target, func, content, *args):
+
+        # wait for a free slot
+        self.slots.acquire()
+        submitted = time.perf_counter()
+
+        # make the call, the slot is given back however it ends
+        try:
+            result, seconds = self.executor.submit(_timed_call, func, (content,) + args).result()
+        except Exception:
+            metrics.error('extract', target)
+            raise
+        finally:
+            self.slots.release()
+
+        # time in the worker counts as extraction, the rest was spent waiting for a worker
+        metrics.observe('extract', target, seconds, len(content))
+        metrics.observe('parse_queue', target, max(0.0, time.perf_counter() - submitted - seconds))
+
+        # return the result
+        return result
+
+    # stop the workers
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# run func over the items on an executor with at most max_pending in flight, yields (item, future) as they finish
+def iter_bounded(executor, func, items, max_pending):
+
+    # future -> item
+    pending = {}
+
+    # iterate over each item
+    for item in items:
+
+        # wait for a free slot, handing back what finished in the meantime
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+
+        # submit the item
+        pending[executor.submit(func, item)] = item
+
+    # hand back the rest
+    for future in as_completed(pending):
+        yield pending[future], future
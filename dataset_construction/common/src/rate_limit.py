@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+# pacing state of a single host
+class HostState:
+    def __init__(self, rate, concurrency):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_backoff = 0.0
+        self.latency = None
+        self.error_rate = 0.0
+
+    # add the tokens earned since the last refill, the bucket holds about a second worth
+    def refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    # seconds to wait before the next request can go out, None if it has to wait for a free slot
+    def wait_time(self, now):
+
+        # every slot is taken
+        if self.in_flight >= int(self.concurrency):
+            return None
+
+        # wait out a Retry-After, then for the next token
+        return max(self.blocked_until - now, (1.0 - self.tokens) / self.rate, 0.0)
+
+
+# per-host token bucket that tunes its rate and concurrency with additive increase, multiplicative decrease
+class AdaptiveRateLimiter:
+    def __init__(self, initial_rate=2.0, min_rate=0.2, max_rate=50.0, initial_concurrency=2,
+                 max_concurrency=32, increase=0.5, decrease=0.5, latency_target=2.0,
+                 error_threshold=0.1, throttle_statuses=(403, 429, 503), backoff_interval=1.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        self.throttle_statuses = throttle_statuses
+        self.backoff_interval = backoff_interval
+
+        # host -> state, all guarded by one condition
+        self.hosts = {}
+        self.cond = threading.Condition()
+
+    # get the state of a host, creating it on first use
+    def get_state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.initial_rate, self.initial_concurrency)
+        return self.hosts[host]
+
+    # block until a request to the url's host is allowed, returns the host
+    def acquire(self, url):
+
+        # get the host
+        host = urlsplit(url).netloc
+
+        with self.cond:
+            state = self.get_state(host)
+
+            # wait for a token and a free slot
+            while True:
+                now = time.monotonic()
+                state.refill(now)
+                wait = state.wait_time(now)
+                if wait == 0.0:
+                    break
+                self.cond.wait(timeout=wait)
+
+            # take the token and the slot
+            state.tokens -= 1.0
+            state.in_flight += 1
+
+        # return the host
+        return host
+
+    # record how a request went and adjust the host's pace
+    def release(self, host, status_code=None, latency=None, retry_after=None):
+
+        with self.cond:
+            state = self.get_state(host)
+            state.in_flight -= 1
+
+            # exceptions and 5xx responses count as errors
+            is_error = status_code is None or status_code >= 500
+            state.error_rate = 0.9 * state.error_rate + 0.1 * is_error
+
+            # smoothed latency
+            if latency is not None:
+                state.latency = latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+
+            # case when the host pushed back
+            if status_code in self.throttle_statuses or retry_after is not None \
+                    or (is_error and state.error_rate > self.error_threshold):
+                self.back_off(host, state, retry_after)
+
+            # case when the host is healthy, speed up by about one request per second every second
+            elif not is_error and (state.latency is None or state.latency <= self.latency_target):
+                state.rate = min(self.max_rate, state.rate + self.increase / state.rate)
+                state.concurrency = min(self.max_concurrency, state.concurrency + 1.0 / state.concurrency)
+
+            # wake up the waiting requests
+            self.cond.notify_all()
+
+    # cut the pace of a host
+    def back_off(self, host, state, retry_after):
+
+        # don't send anything until the Retry-After is up
+        now = time.monotonic()
+        if retry_after is not None:
+            state.blocked_until = max(state.blocked_until, now + retry_after)
+
+        # requests that were already in flight report the same push back, only cut once per interval
+        if now - state.last_backoff < self.backoff_interval:
+            return
+        state.last_backoff = now
+
+        # multiplicative decrease
+        state.rate = max(self.min_rate, state.rate * self.decrease)
+        state.concurrency = max(1.0, state.concurrency * self.decrease)
+        state.tokens = min(state.tokens, 0.0)
+
+        logging.warning(f'Backing off {host}: {state.rate:.2f} requests/sec, '
+                        f'{int(state.concurrency)} in flight')
+
+    # get the current pace of every host
+    def get_rates(self):
+        with self.cond:
+            return {host: {'rate': state.rate,
+                           'concurrency': int(state.concurrency),
+                           'in_flight': state.in_flight,
+                           'latency': state.latency,
+                           'error_rate': state.error_rate}
+                    for host, state in self.hosts.items()}
+
+
+# parse a Retry-After header into seconds
+def parse_retry_after(value):
+
+    # no header
+    if value is None:
+        return None
+
+    # case when it's a number of seconds
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # otherwise, it's an http date
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,163 @@
+import json
+import sys
+from collections.abc import Mapping
+
+# every product image of macy's lives under this prefix, so only the file path is kept
+MACYS_IMAGE_PREFIX = 'https://slimages.macysassets.com/is/image/MCY/products/'
+
+
+# base class of the scraped records, slots instead of a dict per record but still reads like a dict
+class Record(Mapping):
+    __slots__ = ()
+
+    # keys of the dict view, in the order they're written out
+    fields = ()
+
+    # get a field like a dict would
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    # set a stored field like a dict would, e.g. the reviews fetched after the product
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    # get the plain dict, nested records are left to the encoder
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.fields}
+
+
+# image of a review, the shared part of the url is interned so every image of a host points at one string
+class ReviewImage:
+    __slots__ = ('prefix', 'path')
+
+    def __init__(self, url):
+        prefix, _, path = url.rpartition('/')
+        self.prefix = sys.intern(prefix + '/') if prefix else ''
+        self.path = path
+
+    # get the full url
+    @property
+    def url(self):
+        return self.prefix + self.path
+
+    # rebuilt from the url, so images coming back from the parse pool share the prefix again
+    def __reduce__(self):
+        return ReviewImage, (self.url,)
+
+    def __repr__(self):
+        return f'ReviewImage({self.url!r})'
+
+
+# a review of macy's
+class MacysReview(Record):
+    __slots__ = ('user_id', 'rating', 'review_title', 'review_body', 'images', 'number_positive_feedback',
+                 'number_negative_feedback')
+    fields = __slots__
+
+    def __init__(self, user_id, rating, review_title, review_body, images, number_positive_feedback,
+                 number_negative_feedback):
+        self.user_id = user_id
+        self.rating = rating
+        self.review_title = review_title
+        self.review_body = review_body
+        self.images = images
+        self.number_positive_feedback = number_positive_feedback
+        self.number_negative_feedback = number_negative_feedback
+
+
+# a product of macy's, with its reviews
+class MacysProduct(Record):
+    __slots__ = ('url', 'product_name', 'product_brand', 'category', 'original_price', 'current_price',
+                 'product_description', 'product_bullet_description', 'product_rating', 'number_reviews',
+                 'image_paths', 'product_keywords', 'product_reviews')
+    fields = ('url', 'product_name', 'product_brand', 'category', 'original_price', 'current_price',
+              'product_description', 'product_bullet_description', 'product_rating', 'number_reviews',
+              'product_images', 'product_keywords', 'product_reviews')
+
+    def __init__(self, url, product_name, product_brand, category, original_price, current_price,
+                 product_description, product_bullet_description, product_rating, number_reviews, image_paths,
+                 product_keywords, product_reviews):
+        self.url = url
+        self.product_name = product_name
+
+        # brands and categories repeat across thousands of products
+        self.product_brand = sys.intern(product_brand) if isinstance(product_brand, str) else product_brand
+        self.category = sys.intern(category) if isinstance(category, str) else category
+        self.original_price = original_price
+        self.current_price = current_price
+        self.product_description = product_description
+        self.product_bullet_description = product_bullet_description
+        self.product_rating = product_rating
+        self.number_reviews = number_reviews
+        self.image_paths = image_paths
+        self.product_keywords = product_keywords
+        self.product_reviews = product_reviews
+
+    # get the full image urls
+    @property
+    def product_images(self):
+        return [MACYS_IMAGE_PREFIX + path for path in self.image_paths]
+
+
+# a review of best buy
+class BestBuyReview(Record):
+    __slots__ = ('user', 'header', 'rating', 'recommendation', 'number_helpful', 'number_unhelpful', 'body',
+                 'images')
+    fields = ('user', 'header', 'rating', 'recommendation', 'feedback', 'body', 'product_images')
+
+    def __init__(self, user, header, rating, recommendation, number_helpful, number_unhelpful, body, images):
+        self.user = user
+        self.header = header
+
+        # there are only a handful of ratings
+        self.rating = sys.intern(rating) if isinstance(rating, str) else rating
+        self.recommendation = recommendation
+        self.number_helpful = number_helpful
+        self.number_unhelpful = number_unhelpful
+        self.body = body
+        self.images = [ReviewImage(url) for url in images]
+
+    # get the feedback counts
+    @property
+    def feedback(self):
+        return {'number_helpful': self.number_helpful, 'number_unhelpful': self.number_unhelpful}
+
+    # get the full image urls
+    @property
+    def product_images(self):
+        return [image.url for image in self.images]
+
+
+# turn the records into what json can write, meant as the default= of json.dump
+def json_default(obj):
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    if isinstance(obj, ReviewImage):
+        return obj.url
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+# shared encoder, the records are written straight out without building a copy of the whole result first
+ENCODER = json.JSONEncoder(default=json_default)
+
+
+# encode a result with records in it
+def encode(obj):
+    return ENCODER.encode(obj)
+
+# encode a result with records in it as utf-8 bytes
+def encode_bytes(obj):
+    return ENCODER.encode(obj).encode('utf-8')
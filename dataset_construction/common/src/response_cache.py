@@ -0,0 +1,162 @@
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+
+# url classes, checked in order, and the pattern that picks them out
+URL_CLASSES = [
+    ('thumbnails', re.compile(r'pisces\.bbystatic\.com|slimages\.macysassets\.com')),
+    ('reviews', re.compile(r'/reviews|/site/reviews/')),
+    ('product', re.compile(r'/xapi/digital/v1/product/|/shop/product/|bestbuy\.com/site/')),
+    ('listing', re.compile(r'/Pageindex/|macys\.com/shop/'))
+]
+
+# seconds a cached response stays fresh, per url class
+DEFAULT_TTLS = {
+    'product': 24 * 3600,
+    'reviews': 24 * 3600,
+    'thumbnails': 30 * 24 * 3600,
+    'listing': 7 * 24 * 3600,
+    'other': 24 * 3600
+}
+
+# headers that describe the encoded body on the wire, the cache stores the decoded one
+WIRE_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length', 'connection'}
+
+
+# raised in offline mode when a url isn't in the cache
+class OfflineCacheMiss(requests.ConnectionError):
+    pass
+
+
+# get the class of a url
+def classify_url(url):
+    for url_class, pattern in URL_CLASSES:
+        if pattern.search(url):
+            return url_class
+    return 'other'
+
+
+# on-disk cache of responses, with bodies stored by the hash of their content
+class ResponseCache:
+    def __init__(self, cache_dir, ttls=None, offline=False):
+        self.cache_dir = cache_dir
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.offline = offline
+
+        # the bodies live in files named by their hash
+        self.body_dir = os.path.join(cache_dir, 'bodies')
+        os.makedirs(self.body_dir, exist_ok=True)
+
+        # the index maps a request to its response, shared by the fetch threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                          'status INTEGER NOT NULL, headers TEXT NOT NULL, body_hash TEXT NOT NULL, '
+                          'fetched_at REAL NOT NULL)')
+        self.conn.commit()
+
+    # get the key of a request, range requests are cached separately
+    def make_key(self, url, range_header=None):
+        return hashlib.sha256(f'GET {url} {range_header or ""}'.encode('utf-8')).hexdigest()
+
+    # get the path of a body
+    def body_path(self, body_hash):
+        return os.path.join(self.body_dir, body_hash[:2], body_hash)
+
+    # get the cached entry of a request
+    def lookup(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT url, status, headers, body_hash, fetched_at FROM responses '
+                                    'WHERE key = ?', (key,)).fetchone()
+
+        # not cached, or the body went missing
+        if row is None or not os.path.exists(self.body_path(row[3])):
+            return None
+
+        # return the entry
+        return {'url': row[0], 'status': row[1], 'headers': json.loads(row[2]),
+                'body_hash': row[3], 'fetched_at': row[4]}
+
+    # check if an entry is still within the ttl of its url class
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttls[classify_url(entry['url'])]
+
+    # get the headers that ask the server if an entry changed
+    def conditional_headers(self, entry):
+
+        # servers send the names in any case, e.g. etag over http/2
+        stored = CaseInsensitiveDict(entry['headers'])
+        headers = {}
+        if 'ETag' in stored:
+            headers['If-None-Match'] = stored['ETag']
+        if 'Last-Modified' in stored:
+            headers['If-Modified-Since'] = stored['Last-Modified']
+        return headers
+
+    # store a response, its body has to be read already
+    def store(self, key, url, response):
+
+        # write the body once per distinct content
+        body = response.content
+        body_hash = hashlib.sha256(body).hexdigest()
+        path = self.body_path(body_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(body)
+            os.replace(tmp_path, path)
+
+        # keep the headers that still hold for the decoded body
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in WIRE_HEADERS}
+
+        # point the request at the body
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, url, status, headers, body_hash, fetched_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, url, response.status_code, json.dumps(headers), body_hash, time.time()))
+            self.conn.commit()
+
+        # return the stored entry
+        return {'url': url, 'status': response.status_code, 'headers': headers,
+                'body_hash': body_hash, 'fetched_at': time.time()}
+
+    # mark an entry as fresh again after the server said it didn't change
+    def touch(self, key, entry):
+        entry['fetched_at'] = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE responses SET fetched_at = ? WHERE key = ?', (entry['fetched_at'], key))
+            self.conn.commit()
+
+    # build a response out of an entry
+    def build_response(self, entry):
+
+        # read the body
+        with open(self.body_path(entry['body_hash']), 'rb') as fp:
+            body = fp.read()
+
+        # the raw response lets callers stream or read the body like a live one
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.url = entry['url']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = HTTPResponse(body=io.BytesIO(body), headers=entry['headers'], status=entry['status'],
+                                    preload_content=False, decode_content=False)
+        response.from_cache = True
+
+        # return the response
+        return response
+
+    # close the index
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,161 @@
+import time
+from collections import defaultdict
+from lxml import etree
+
+
+# class that compiles every xpath expression once and hands out the compiled version
+class SelectorRegistry:
+    def __init__(self):
+        self.compiled = {}
+
+    # get the compiled version of an expression
+    def xpath(self, expression):
+
+        # compile on first use
+        if expression not in self.compiled:
+            self.compiled[expression] = etree.XPath(expression)
+
+        # return the compiled expression
+        return self.compiled[expression]
+
+
+# registry shared by all scrapers
+registry = SelectorRegistry()
+
+
+# get a compiled xpath expression from the shared registry
+def compile_xpath(expression):
+    return registry.xpath(expression)
+
+
+# a tag plus an optional attribute test, e.g. div[contains(@class, "product-title")]
+class Selector:
+    def __init__(self, tag, attr=None, op='equals', value=None):
+        self.tag = tag
+        self.attr = attr
+        self.op = op
+        self.value = value
+
+        # the equivalent xpath, for running the selector on its own
+        if attr is None:
+            self.expression = f'//{tag}'
+        elif op == 'equals':
+            self.expression = f'//{tag}[@{attr}="{value}"]'
+        else:
+            self.expression = f'//{tag}[{op}(@{attr}, "{value}")]'
+        self.xpath = compile_xpath(self.expression)
+
+    # check if an element matches the selector
+    def matches(self, ele):
+
+        # only the tag has to match
+        if self.attr is None:
+            return True
+
+        # get the attribute
+        attr_value = ele.get(self.attr)
+        if attr_value is None:
+            return False
+
+        # run the attribute test
+        if self.op == 'equals':
+            return attr_value == self.value
+        elif self.op == 'contains':
+            return self.value in attr_value
+        elif self.op == 'starts-with':
+            return attr_value.startswith(self.value)
+
+        # unknown test
+        raise ValueError(f'Unknown selector op: {self.op}')
+
+
+# a field of a retailer's spec: the selector to match and how to turn the matches into a value
+class Field:
+    def __init__(self, name, selector, extract):
+        self.name = name
+        self.selector = selector
+        self.extract = extract
+
+
+# class that fills every field of a spec with a single walk over the tree
+class ExtractionEngine:
+    def __init__(self, fields, profile=False):
+        self.fields = fields
+        self.profile = profile
+
+        # fields grouped by tag, so each element is only tested against the fields that can match it
+        self.fields_by_tag = defaultdict(list)
+        for field in fields:
+            self.fields_by_tag[field.selector.tag].append(field)
+
+        # name -> seconds spent matching and extracting
+        self.timings = defaultdict(lambda: {'match_seconds': 0.0, 'extract_seconds': 0.0, 'calls': 0})
+
+    # get the matches of every field in document order
+    def match(self, doc):
+
+        # name -> matched elements
+        matches = {field.name: [] for field in self.fields}
+
+        # walk the tree once
+        for ele in doc.iter():
+
+            # comments and processing instructions don't have a string tag
+            tag_fields = self.fields_by_tag.get(ele.tag)
+            if tag_fields is None:
+                continue
+
+            # test the element against every field with this tag
+            for field in tag_fields:
+                if self.profile:
+                    start = time.perf_counter()
+                    matched = field.selector.matches(ele)
+                    self.timings[field.name]['match_seconds'] += time.perf_counter() - start
+                else:
+                    matched = field.selector.matches(ele)
+                if matched:
+                    matches[field.name].append(ele)
+
+        # return the matches
+        return matches
+
+    # fill every field of the spec
+    def extract(self, doc):
+
+        # match all fields in one pass
+        matches = self.match(doc)
+
+        # dictionary to hold the values
+        values = {}
+
+        # turn the matches into values
+        for field in self.fields:
+            if self.profile:
+                start = time.perf_counter()
+                values[field.name] = field.extract(matches[field.name])
+                self.timings[field.name]['extract_seconds'] += time.perf_counter() - start
+                self.timings[field.name]['calls'] += 1
+            else:
+                values[field.name] = field.extract(matches[field.name])
+
+        # return the values
+        return values
+
+    # time each field's selector as a standalone xpath scan, to compare against the single pass
+    def time_xpath(self, doc):
+
+        # name -> seconds
+        xpath_timings = {}
+        for field in self.fields:
+            start = time.perf_counter()
+            field.selector.xpath(doc)
+            xpath_timings[field.name] = time.perf_counter() - start
+
+        # return the timings
+        return xpath_timings
+
+    # get a per-field breakdown sorted by total time, slowest first
+    def timing_report(self):
+        report = [dict(field=name, total_seconds=t['match_seconds'] + t['extract_seconds'], **t)
+                  for name, t in self.timings.items()]
+        return sorted(report, key=lambda row: row['total_seconds'], reverse=True)
@@ -0,0 +1,351 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from dataset_construction.common.src.fetch_policy import DeadlineExceeded
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.response_cache import OfflineCacheMiss
+from dataset_construction.common.src.rate_limit import parse_retry_after
+
+
+# connections that time the dns lookup, the tcp connect and the tls handshake
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with metrics.timer('connect', self.host):
+            super().connect()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with metrics.timer('connect', self.host):
+            super().connect()
+
+
+# pools that hand out the timed connections
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+# adapter that remembers every connection pool it has sent a request through
+class StatsAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.pools_seen = defaultdict(set)
+        self.pools_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    # use the timed connections
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+    # send the request and keep track of the pool that served it
+    def send(self, request, **kwargs):
+
+        # make the request, the body is read later so this is the time to the first byte
+        with metrics.timer('ttfb', urlsplit(request.url).netloc):
+            response = super().send(request, **kwargs)
+
+        # urllib3 hangs the pool on the raw response
+        pool = getattr(response.raw, '_pool', None)
+
+        # pools can get evicted, so keep a reference to every one of them
+        if pool is not None:
+            with self.pools_lock:
+                self.pools_seen[pool.host].add(pool)
+
+        # return the response
+        return response
+
+
+# largest streamed body that gets read up front so it can be cached
+STREAM_CACHE_LIMIT = 65536
+
+
+# close the response of a finished future
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+# session shared by the scrapers that keeps a keep-alive connection pool per host
+class PooledSession:
+    def __init__(self, headers=None, pool_connections=10, pool_maxsize=10, pool_block=False, rate_limiter=None,
+                 policy=None, cache=None):
+        self.rate_limiter = rate_limiter
+        self.policy = policy
+        self.cache = cache
+
+        # threads that run the first and the duplicate request of a hedged get
+        self.hedge_executor = None
+        if policy is not None and policy.hedge:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=2 * pool_maxsize)
+        self.session = requests.Session()
+        self.adapter = StatsAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                    pool_block=pool_block)
+
+        # every request goes through the same adapter
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        # default headers
+        if headers is not None:
+            self.session.headers.update(headers)
+
+    # make a GET request, served from the response cache when there is one
+    def get(self, url, **kwargs):
+
+        # no cache
+        if self.cache is None:
+            return self.fetch(url, **kwargs)
+
+        # the key covers the query and the byte range
+        full_url = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        request_headers = dict(kwargs.get('headers') or {})
+        key = self.cache.make_key(full_url, request_headers.get('Range'))
+        entry = self.cache.lookup(key)
+
+        # serve fresh entries, and anything cached when replaying offline
+        if entry is not None and (self.cache.offline or self.cache.is_fresh(entry)):
+            return self.cache.build_response(entry)
+
+        # nothing to replay
+        if self.cache.offline:
+            raise OfflineCacheMiss(f'Not in the cache: {full_url}')
+
+        # ask the server if the stale entry changed
+        if entry is not None:
+            request_headers.update(self.cache.conditional_headers(entry))
+            kwargs['headers'] = request_headers
+
+        # make the request
+        response = self.fetch(url, **kwargs)
+
+        # case when the entry didn't change
+        if entry is not None and response.status_code == 304:
+            response.close()
+            self.cache.touch(key, entry)
+            return self.cache.build_response(entry)
+
+        # only successful responses are cached
+        if response.status_code not in (200, 206):
+            return response
+
+        # streamed bodies are left to the caller, unless they're small enough to read up front
+        if kwargs.get('stream'):
+            content_length = response.headers.get('Content-Length')
+            if content_length is None or int(content_length) > STREAM_CACHE_LIMIT:
+                return response
+
+        # store the response, and hand back the stored copy so streamed callers can still read it
+        return self.cache.build_response(self.cache.store(key, full_url, response))
+
+    # make a GET request with the deadlines, retries and hedging of the fetch policy
+    def fetch(self, url, **kwargs):
+
+        # no policy, just make the request
+        if self.policy is None:
+            return self.get_once(url, **kwargs)
+
+        # the total deadline covers every attempt
+        deadline = time.monotonic() + self.policy.total_timeout
+
+        # iterate until a response comes back or the retries run out
+        attempt = 0
+        while True:
+
+            # make the request
+            response = None
+            try:
+                response = self.get_hedged(url, deadline, **kwargs)
+            except requests.RequestException as e:
+
+                # only connection problems and timeouts are worth retrying
+                if not isinstance(e, (requests.ConnectionError, requests.Timeout)) or attempt >= self.policy.retries:
+                    raise
+                wait_seconds = self.policy.backoff_time(attempt)
+                error = e
+
+            # case when there's a response
+            else:
+
+                # return anything that isn't a retryable status
+                if response.status_code not in self.policy.retry_statuses or attempt >= self.policy.retries:
+                    return response
+                wait_seconds = self.policy.backoff_time(attempt, parse_retry_after(response.headers.get('Retry-After')))
+                error = None
+
+            # give up if the wait would run past the deadline
+            if wait_seconds >= self.policy.remaining(deadline):
+                if response is not None:
+                    return response
+                raise DeadlineExceeded(f'Deadline exceeded for {url}') from error
+
+            # wait and retry
+            logging.debug(f'Retrying {url} in {wait_seconds:.2f}s (attempt {attempt + 1})')
+            if response is not None:
+                response.close()
+            time.sleep(wait_seconds)
+            attempt += 1
+
+    # make a request, sending a duplicate if the first one takes longer than the host's p95
+    def get_hedged(self, url, deadline, **kwargs):
+
+        # get the hedging delay
+        delay = self.policy.hedge_delay(urlsplit(url).netloc)
+
+        # streamed bodies are read by the caller, so they can't be hedged
+        if delay is None or kwargs.get('stream'):
+            return self.get_timed(url, deadline, **kwargs)
+
+        # send the first request and give it until the delay
+        first = self.hedge_executor.submit(self.get_timed, url, deadline, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if first in done:
+            return first.result()
+
+        # send the duplicate
+        pending = {first, self.hedge_executor.submit(self.get_timed, url, deadline, **kwargs)}
+
+        # take whichever answers first, an error only counts if both fail
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+
+                    # the slower one gets closed once it comes back
+                    for other in pending:
+                        other.add_done_callback(_close_response)
+                    return future.result()
+
+        # both failed
+        return first.result()
+
+    # make a single request within the connect, read and total deadlines
+    def get_timed(self, url, deadline, **kwargs):
+
+        # get the time left
+        remaining = self.policy.remaining(deadline)
+        if remaining <= 0:
+            raise DeadlineExceeded(f'Deadline exceeded for {url}')
+
+        # connect and read timeouts, capped by the time left
+        kwargs.setdefault('timeout', (min(self.policy.connect_timeout, remaining),
+                                      min(self.policy.read_timeout, remaining)))
+
+        # streamed bodies are read by the caller
+        start = time.monotonic()
+        if kwargs.get('stream'):
+            return self.get_once(url, **kwargs)
+
+        # otherwise, download the body and stop if it runs past the deadline
+        response = self.get_once(url, deadline=deadline, **kwargs)
+
+        # successful latencies feed the hedging delay
+        if response.status_code < 400:
+            self.policy.latency_tracker.record(urlsplit(url).netloc, time.monotonic() - start)
+
+        # return the response
+        return response
+
+    # make a single GET request on a pooled connection
+    def get_once(self, url, stream=False, deadline=None, **kwargs):
+
+        # no pacing
+        if self.rate_limiter is None:
+            response = self.session.get(url, stream=True, **kwargs)
+            return response if stream else self.download(response, url, deadline)
+
+        # wait for the host's rate limiter
+        host = self.rate_limiter.acquire(url)
+        start = time.monotonic()
+
+        # make the request, a failure still has to give the slot back
+        try:
+            response = self.session.get(url, stream=True, **kwargs)
+            if not stream:
+                self.download(response, url, deadline)
+        except Exception:
+            self.rate_limiter.release(host)
+            raise
+
+        # let the limiter adjust the pace of the host
+        self.rate_limiter.release(host, status_code=response.status_code, latency=time.monotonic() - start,
+                                  retry_after=parse_retry_after(response.headers.get('Retry-After')))
+
+        # throttling used to get lost in bare excepts, so make it visible
+        if response.status_code in self.rate_limiter.throttle_statuses:
+            logging.warning(f'Got {response.status_code} from {url}')
+
+        # return the response
+        return response
+
+    # read the body of a streamed response, stopping if it runs past the deadline
+    def download(self, response, url, deadline=None):
+
+        # the body is read apart from the headers so the download gets timed on its own
+        host = urlsplit(url).netloc
+        start = time.perf_counter()
+        chunks = []
+        try:
+            for chunk in response.iter_content(chunk_size=65536):
+                chunks.append(chunk)
+                if deadline is not None and time.monotonic() > deadline:
+                    response.close()
+                    raise DeadlineExceeded(f'Deadline exceeded while downloading {url}')
+        except Exception:
+            metrics.error('download', host)
+            raise
+        response._content = b''.join(chunks)
+        metrics.observe('download', host, time.perf_counter() - start, len(response._content))
+
+        # return the response
+        return response
+
+    # get the connection reuse stats per host
+    def get_stats(self):
+
+        # dictionary of host -> stats
+        stats = {}
+
+        # iterate over each host
+        with self.adapter.pools_lock:
+            for host, pools in self.adapter.pools_seen.items():
+
+                # urllib3 counts new connections and requests per pool
+                num_requests = sum(pool.num_requests for pool in pools)
+                num_connections = sum(pool.num_connections for pool in pools)
+
+                # everything that didn't need a new connection reused one
+                stats[host] = {
+                    'requests': num_requests,
+                    'new_connections': num_connections,
+                    'reused_connections': num_requests - num_connections
+                }
+
+        # return the stats
+        return stats
+
+    # close every pooled connection and the cache
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
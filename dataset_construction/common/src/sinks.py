@@ -0,0 +1,209 @@
+import logging
+import os
+import time
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.records import encode
+
+
+# base class for the places scraped records get written to
+class RecordSink:
+
+    # write out a single record
+    def write(self, record):
+        raise NotImplementedError
+
+    # flush anything that's buffered and release the file handles
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# sink that writes one json document per line
+class JsonLinesSink(RecordSink):
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'a', encoding='utf-8')
+
+    # write out a single record
+    def write(self, record):
+        self.fp.write(encode(record) + '\n')
+
+    # close the file
+    def close(self):
+        self.fp.close()
+
+
+# base class for the sinks that write products and reviews as separate columnar tables
+class ColumnarSink(RecordSink):
+    extension = None
+
+    def __init__(self, out_dir, key_func, reviews_field, batch_size=1000,
+                 product_schema=None, review_schema=None):
+
+        # pyarrow is only needed by the columnar sinks
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is required for the parquet and arrow sinks: pip install pyarrow')
+        self.pa = pyarrow
+
+        self.out_dir = out_dir
+        self.key_func = key_func
+        self.reviews_field = reviews_field
+        self.batch_size = batch_size
+
+        # rows waiting to be written, per table
+        self.rows = {'products': [], 'reviews': []}
+
+        # given schemas are fixed, otherwise the schema of a table is inferred and grows with the columns seen
+        self.schemas = {'products': product_schema, 'reviews': review_schema}
+        self.fixed = {table_name: schema is not None for table_name, schema in self.schemas.items()}
+        self.writers = {}
+
+        # every run writes its own part files, so resumed runs add to the dataset
+        self.part_prefix = f'part-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        self.num_parts = {table_name: 0 for table_name in self.rows}
+        for table_name in self.rows:
+            os.makedirs(os.path.join(out_dir, table_name), exist_ok=True)
+
+    # split a record into a product row and its review rows
+    def write(self, record):
+
+        # get the product id
+        product_id = str(self.key_func(record))
+
+        # the product row has everything except the nested reviews
+        product_row = {key: value for key, value in record.items() if key != self.reviews_field}
+        product_row['product_id'] = product_id
+        self.rows['products'].append(product_row)
+
+        # each review gets the product id to join on and its position in the product
+        for i, review in enumerate(record.get(self.reviews_field, [])):
+            self.rows['reviews'].append(dict(review, product_id=product_id, review_index=i))
+
+        # write out a row group once enough products are buffered
+        if len(self.rows['products']) >= self.batch_size:
+            self.flush()
+
+    # write out the buffered rows of every table
+    def flush(self):
+        for table_name, rows in self.rows.items():
+
+            # nothing to write
+            if len(rows) == 0:
+                continue
+
+            # a batch that doesn't fit is dropped and logged, so a single odd record doesn't stop the crawl
+            try:
+                self.flush_table(table_name, rows)
+            except Exception as e:
+                logging.warning(f'Dropped a batch of {len(rows)} {table_name} rows that could not be written ({e!r})')
+                metrics.error('write', table_name)
+            rows.clear()
+
+    # write out the buffered rows of a table
+    def flush_table(self, table_name, rows):
+
+        # build the batch, a fixed schema has to know every column
+        if self.fixed[table_name]:
+            schema = self.schemas[table_name]
+            unknown = sorted({key for row in rows for key in row} - set(schema.names))
+            if len(unknown) > 0:
+                raise ValueError(f'The {table_name} schema has no columns for: {", ".join(unknown)}')
+            table = self.pa.Table.from_pylist(rows, schema=schema)
+
+        # otherwise, merge the columns of the batch into the ones seen so far
+        else:
+            table = self.pa.Table.from_pylist(rows)
+            schema = table.schema
+            if self.schemas[table_name] is not None:
+                schema = self.unify_schemas(table_name, self.schemas[table_name], table.schema)
+
+            # a part file has a single schema, so new columns or types start the next part file
+            if schema != self.schemas[table_name] and table_name in self.writers:
+                self.writers.pop(table_name).close()
+            self.schemas[table_name] = schema
+
+            # conform the batch to the schema of the part file
+            if table.schema != schema:
+                table = self.pa.Table.from_pylist(rows, schema=schema)
+
+        # open the writer of the next part file
+        if table_name not in self.writers:
+            path = os.path.join(self.out_dir, table_name, f'{self.part_prefix}-{self.num_parts[table_name]:04d}'
+                                                         f'{self.extension}')
+            self.writers[table_name] = self.open_writer(path, schema)
+            self.num_parts[table_name] += 1
+
+        # write the batch out
+        self.write_table(self.writers[table_name], table)
+
+    # get a schema that holds the columns of both, columns that were only ever empty take the type of the other
+    def unify_schemas(self, table_name, schema, batch_schema):
+
+        # ints widen to floats where pyarrow supports it
+        try:
+            try:
+                return self.pa.unify_schemas([schema, batch_schema], promote_options='permissive')
+            except TypeError:
+                return self.pa.unify_schemas([schema, batch_schema])
+
+        # a column that changed type can't be written to the same table
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError) as e:
+            raise ValueError(f'The {table_name} batch doesn\'t fit the columns written so far: {e}') from e
+
+    # open a writer for a table
+    def open_writer(self, path, schema):
+        raise NotImplementedError
+
+    # write a batch to a writer
+    def write_table(self, writer, table):
+        writer.write_table(table)
+
+    # flush what's left and close the writers
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+# sink that writes parquet files, one row group per batch
+class ParquetSink(ColumnarSink):
+    extension = '.parquet'
+
+    # open a parquet writer
+    def open_writer(self, path, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema)
+
+
+# sink that writes arrow ipc files, one record batch per batch
+class ArrowIPCSink(ColumnarSink):
+    extension = '.arrow'
+
+    # open an arrow ipc file writer
+    def open_writer(self, path, schema):
+        return self.pa.ipc.new_file(path, schema)
+
+
+# make a sink from its name
+def make_sink(kind, path, key_func, reviews_field, batch_size=1000, product_schema=None, review_schema=None):
+
+    # get the sink class
+    if kind == 'jsonl':
+        return JsonLinesSink(path)
+    elif kind == 'parquet':
+        return ParquetSink(path, key_func, reviews_field, batch_size=batch_size,
+                           product_schema=product_schema, review_schema=review_schema)
+    elif kind == 'arrow':
+        return ArrowIPCSink(path, key_func, reviews_field, batch_size=batch_size,
+                            product_schema=product_schema, review_schema=review_schema)
+
+    # unknown sink
+    raise ValueError(f'Unknown sink: {kind}')
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+# per-product high-water marks of the reviews, so a recrawl only fetches the reviews added since the last run
+class ReviewWatermarks:
+    def __init__(self, db_path, fields, keep=5):
+        self.db_path = db_path
+        self.fields = fields
+        self.keep = keep
+
+        # shared by the review threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS watermarks (key TEXT PRIMARY KEY, review_count INTEGER NOT NULL, '
+                          'fingerprints TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self.conn.commit()
+
+    # get a short hash that identifies a review
+    def fingerprint(self, review):
+        values = [str(review.get(field)) for field in self.fields]
+        return hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+    # get the watermark of a product, None on the first run
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT review_count, fingerprints, updated_at FROM watermarks WHERE key = ?',
+                                    (str(key),)).fetchone()
+
+        # case when the product wasn't seen before
+        if row is None:
+            return None
+
+        # return the watermark
+        return {'review_count': row[0], 'fingerprints': json.loads(row[1]), 'updated_at': row[2]}
+
+    # check if nothing was added since the last run
+    def is_unchanged(self, watermark, review_count):
+        return watermark is not None and watermark['review_count'] == review_count
+
+    # split a newest-first page into the reviews before the first known one, and whether a known one was hit
+    def take_new(self, reviews, watermark):
+
+        # every review is new on the first run
+        if watermark is None:
+            return reviews, False
+
+        # stop at the first review the previous run already had
+        for i, review in enumerate(reviews):
+            if self.fingerprint(review) in watermark['fingerprints']:
+                return reviews[:i], True
+
+        # the whole page is new
+        return reviews, False
+
+    # move the watermark past the newest reviews, a few are kept in case the newest one gets deleted
+    def update(self, key, review_count, new_reviews, watermark=None):
+
+        # newest first, followed by the ones of the previous run
+        fingerprints = [self.fingerprint(review) for review in new_reviews[:self.keep]]
+        if watermark is not None:
+            fingerprints += [fp for fp in watermark['fingerprints'] if fp not in fingerprints]
+
+        # write it out
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO watermarks (key, review_count, fingerprints, updated_at) '
+                              'VALUES (?, ?, ?, ?)',
+                              (str(key), review_count, json.dumps(fingerprints[:self.keep]), time.time()))
+            self.conn.commit()
+
+    # merge the new reviews of a product into the ones of the previous run, newest first and without repeats
+    def merge(self, new_reviews, previous_reviews):
+        new_fingerprints = {self.fingerprint(review) for review in new_reviews}
+        return list(new_reviews) + [review for review in previous_reviews
+                                    if self.fingerprint(review) not in new_fingerprints]
+
+    # close the database
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from dataset_construction.common.src.frontier import canonicalize_url
+
+
+# get the shard of a key, stable across processes and hosts unlike hash()
+def shard_of(key, num_shards):
+    return int(hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+
+# get an id for this worker that's unique across hosts
+def make_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+# a batch of tasks leased by a worker
+class Lease:
+    def __init__(self, lease_id, worker_id, tasks, expires_at):
+        self.lease_id = lease_id
+        self.worker_id = worker_id
+        self.tasks = tasks
+        self.expires_at = expires_at
+
+
+# work queue where workers lease batches of urls, a batch that isn't finished in time goes back to the queue
+class LeaseQueue:
+    def __init__(self, db_path, num_shards=16, visibility_timeout=300.0, max_attempts=3, key_func=canonicalize_url):
+        self.db_path = db_path
+        self.num_shards = num_shards
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.key_func = key_func
+
+        # several worker processes share the file, so wait on their locks instead of failing
+        self.conn = sqlite3.connect(db_path, timeout=60.0, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                          'shard INTEGER NOT NULL, status TEXT NOT NULL, lease_id TEXT, lease_expires REAL, '
+                          'worker_id TEXT, attempts INTEGER NOT NULL, updated_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, shard)')
+
+    # add urls to the queue, returns how many keys weren't queued before
+    def enqueue_many(self, urls, batch_size=10000):
+
+        # number of new keys
+        num_new = 0
+
+        # insert in batches, each batch in its own transaction
+        batch = []
+        for url in urls:
+            key = str(self.key_func(url))
+            batch.append((key, url, shard_of(key, self.num_shards), time.time()))
+            if len(batch) >= batch_size:
+                num_new += self.insert_batch(batch)
+                batch = []
+        num_new += self.insert_batch(batch)
+
+        # return the number of new keys
+        return num_new
+
+    # insert a batch of tasks, keys that are already queued are skipped
+    def insert_batch(self, batch):
+        before = self.conn.total_changes
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany("INSERT OR IGNORE INTO tasks (key, url, shard, status, attempts, updated_at) "
+                              "VALUES (?, ?, ?, 'pending', 0, ?)", batch)
+        self.conn.execute('COMMIT')
+        return self.conn.total_changes - before
+
+    # lease a batch of tasks, None if nothing is available right now
+    def lease(self, worker_id, batch_size=20, shards=None):
+
+        # pending tasks, plus leased ones whose worker didn't finish them in time
+        now = time.time()
+        query = ("SELECT key, url FROM tasks WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                 "AND attempts < ?")
+        params = [now, self.max_attempts]
+
+        # workers can be pinned to some of the shards
+        if shards is not None:
+            query += f" AND shard IN ({', '.join('?' * len(shards))})"
+            params += list(shards)
+        query += ' ORDER BY shard, rowid LIMIT ?'
+        params.append(batch_size)
+
+        # the select and the update happen in one write transaction, so two workers never get the same task
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            tasks = self.conn.execute(query, params).fetchall()
+            if len(tasks) == 0:
+                self.conn.execute('COMMIT')
+                return None
+
+            # mark the tasks as leased
+            lease = Lease(uuid.uuid4().hex, worker_id, tasks, now + self.visibility_timeout)
+            self.conn.executemany("UPDATE tasks SET status = 'leased', lease_id = ?, lease_expires = ?, worker_id = ?, "
+                                  "attempts = attempts + 1, updated_at = ? WHERE key = ?",
+                                  [(lease.lease_id, lease.expires_at, worker_id, now, key) for key, _ in tasks])
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        # return the lease
+        return lease
+
+    # push the deadline of a lease back, returns False if the lease was lost to another worker
+    def heartbeat(self, lease):
+        lease.expires_at = time.time() + self.visibility_timeout
+        cursor = self.conn.execute("UPDATE tasks SET lease_expires = ? WHERE lease_id = ? AND status = 'leased'",
+                                   (lease.expires_at, lease.lease_id))
+        return cursor.rowcount > 0
+
+    # mark tasks of a lease as done, returns how many still belonged to it
+    def complete(self, lease, keys):
+        self.conn.execute('BEGIN IMMEDIATE')
+        changed = 0
+        for key in keys:
+            changed += self.conn.execute("UPDATE tasks SET status = 'done', lease_id = NULL, updated_at = ? "
+                                         "WHERE key = ? AND lease_id = ?", (time.time(), key, lease.lease_id)).rowcount
+        self.conn.execute('COMMIT')
+        return changed
+
+    # hand a failed task back, it's given up on once it runs out of attempts
+    def fail(self, lease, key):
+        self.conn.execute("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                          "lease_id = NULL, updated_at = ? WHERE key = ? AND lease_id = ?",
+                          (self.max_attempts, time.time(), key, lease.lease_id))
+
+    # hand back the unfinished tasks of a lease, e.g. when a worker shuts down
+    def release(self, lease):
+        self.conn.execute("UPDATE tasks SET status = 'pending', lease_id = NULL, attempts = attempts - 1, "
+                          "updated_at = ? WHERE lease_id = ? AND status = 'leased'", (time.time(), lease.lease_id))
+
+    # get the number of tasks per status
+    def stats(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+
+    # check if every task is either done or given up on, a lease that's still live isn't done yet
+    def is_drained(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tasks WHERE (status = 'pending' AND attempts < ?) "
+                                 "OR (status = 'leased' AND (lease_expires >= ? OR attempts < ?))",
+                                 (self.max_attempts, time.time(), self.max_attempts)).fetchone()[0] == 0
+
+    # close the database
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,181 @@
+import pytest
+from dataset_construction.common.src import work_queue
+from dataset_construction.common.src.work_queue import LeaseQueue, shard_of
+
+# urls of the tasks
+URLS = [f'https://www.macys.com/shop/product/item?ID={i}' for i in range(10)]
+
+
+# clock the queue reads instead of the real time, so leases expire when a test says so
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    return clock
+
+# path of the sqlite file both workers share
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'queue.sqlite')
+
+# two workers, each with its own connection to the same file like two processes would have
+@pytest.fixture
+def workers(db_path, clock):
+    first = LeaseQueue(db_path, num_shards=4, visibility_timeout=60.0, max_attempts=3)
+    second = LeaseQueue(db_path, num_shards=4, visibility_timeout=60.0, max_attempts=3)
+    first.enqueue_many(URLS)
+    yield first, second
+    first.close()
+    second.close()
+
+
+# the shard of a key doesn't depend on the process
+def test_shard_is_stable():
+    assert shard_of('macys:1', 16) == shard_of('macys:1', 16)
+    assert {shard_of(f'macys:{i}', 4) for i in range(100)} == {0, 1, 2, 3}
+
+# urls already queued by another worker aren't queued again
+def test_enqueue_skips_known_keys(workers):
+    first, second = workers
+    assert second.enqueue_many(URLS + URLS[:1] + ['https://www.macys.com/shop/product/item?ID=10']) == 1
+    assert first.stats() == {'pending': 11}
+
+
+# two workers sharing the file never get the same task
+def test_workers_lease_disjoint_batches(workers):
+    first, second = workers
+
+    # lease everything between the two
+    first_lease = first.lease('first', batch_size=6)
+    second_lease = second.lease('second', batch_size=6)
+
+    # every task went to exactly one of them
+    first_keys = {key for key, _ in first_lease.tasks}
+    second_keys = {key for key, _ in second_lease.tasks}
+    assert len(first_keys) == 6
+    assert len(second_keys) == 4
+    assert first_keys.isdisjoint(second_keys)
+
+    # nothing is left to lease
+    assert first.lease('first') is None
+    assert second.lease('second') is None
+
+# workers pinned to shards only get the tasks of their shards
+def test_lease_by_shard(workers):
+    first, _ = workers
+    lease = first.lease('first', batch_size=len(URLS), shards=[0, 1])
+    assert all(shard_of(key, 4) in (0, 1) for key, _ in lease.tasks)
+
+
+# a worker that crashes holding a lease loses it once the visibility timeout runs out
+def test_lease_expires_after_crash(workers, clock):
+    first, second = workers
+
+    # the first worker leases a batch and dies without finishing it
+    crashed = first.lease('first', batch_size=len(URLS))
+    first.close()
+
+    # the batch stays hidden until the lease runs out
+    clock.advance(59.0)
+    assert second.lease('second', batch_size=len(URLS)) is None
+    assert not second.is_drained()
+
+    # then it goes to the other worker
+    clock.advance(2.0)
+    recovered = second.lease('second', batch_size=len(URLS))
+    assert [key for key, _ in recovered.tasks] == [key for key, _ in crashed.tasks]
+    assert second.complete(recovered, [key for key, _ in recovered.tasks]) == len(URLS)
+    assert second.stats() == {'done': len(URLS)}
+    assert second.is_drained()
+
+# a heartbeat keeps a lease alive past the visibility timeout
+def test_heartbeat_extends_lease(workers, clock):
+    first, second = workers
+    lease = first.lease('first', batch_size=len(URLS))
+
+    # heartbeats every 40 seconds keep the batch hidden well past the first 60
+    for _ in range(3):
+        clock.advance(40.0)
+        assert first.heartbeat(lease)
+        assert second.lease('second') is None
+
+    # once the heartbeats stop, it expires a timeout after the last one
+    clock.advance(61.0)
+    assert second.lease('second', batch_size=len(URLS)) is not None
+
+    # the first worker finds out its lease was lost
+    assert not first.heartbeat(lease)
+
+
+# only the worker holding the lease can mark its tasks as done
+def test_only_holder_completes(workers, clock):
+    first, second = workers
+
+    # the first lease runs out and the batch goes to the second worker
+    stale = first.lease('first', batch_size=3)
+    keys = [key for key, _ in stale.tasks]
+    clock.advance(61.0)
+    current = second.lease('second', batch_size=3)
+    assert [key for key, _ in current.tasks] == keys
+
+    # the late worker's completion doesn't count, the holder's does
+    assert first.complete(stale, keys) == 0
+    assert second.stats() == {'leased': 3, 'pending': 7}
+    assert second.complete(current, keys) == 3
+    assert second.stats() == {'done': 3, 'pending': 7}
+
+    # failing or releasing a stale lease doesn't touch the tasks either
+    first.fail(stale, keys[0])
+    first.release(stale)
+    assert second.stats() == {'done': 3, 'pending': 7}
+
+
+# a task that keeps failing is given up on after max_attempts
+def test_max_attempts_marks_failed(workers):
+    first, second = workers
+    key = None
+
+    # a failed task goes back to the front of its shard, so the same one comes back on alternating workers
+    for attempt in range(3):
+        worker = (first, second)[attempt % 2]
+        lease = worker.lease(f'worker{attempt}', batch_size=1)
+        key = key if key is not None else lease.tasks[0][0]
+        assert [leased_key for leased_key, _ in lease.tasks] == [key]
+        worker.fail(lease, key)
+
+    # it's failed and isn't handed out again
+    assert first.stats() == {'failed': 1, 'pending': 9}
+    lease = second.lease('second', batch_size=len(URLS))
+    assert key not in {leased_key for leased_key, _ in lease.tasks}
+
+# a task whose worker keeps crashing runs out of attempts too
+def test_max_attempts_after_crashes(workers, clock):
+    first, second = workers
+
+    # every attempt expires
+    for _ in range(3):
+        assert first.lease('first', batch_size=len(URLS)) is not None
+        clock.advance(61.0)
+
+    # nothing is handed out again and the queue counts as drained
+    assert second.lease('second') is None
+    assert second.is_drained()
+
+# releasing a lease on shutdown gives the attempt back
+def test_release_returns_attempt(workers):
+    first, second = workers
+    for _ in range(5):
+        lease = first.lease('first', batch_size=len(URLS))
+        first.release(lease)
+    assert second.lease('second', batch_size=len(URLS)) is not None
@@ -0,0 +1,191 @@
+import argparse
+import json
+import logging
+import os
+import time
+from functools import partial
+from dataset_construction.bs4.src.bs4_scraper import bs4_review_scraper, get_product_key as get_bestbuy_key
+from dataset_construction.common.src.checkpoint import Checkpoint
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.common.src.frontier import iter_urls
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+from dataset_construction.common.src.session import PooledSession
+from dataset_construction.common.src.work_queue import LeaseQueue, make_worker_id
+from dataset_construction.macys_scraper.src.scrape_products_simple import crawl_product, \
+    get_product_key as get_macys_key
+
+# headers
+MACYS_HEADERS = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
+                               ' (KHTML, like Gecko) Version/15.3 Safari/605.1.15'}
+
+# where each site's urls come from and the key its products are sharded on
+SITES = {
+    'macys': {'input_path': '../../macys_scraper/data/macys_products_to_scrape.txt',
+              'prefix': 'https://www.macys.com',
+              'key_func': get_macys_key},
+    'bestbuy': {'input_path': '../../bs4/data/backup_products_to_scrape_05_23.txt',
+                'prefix': '',
+                'key_func': get_bestbuy_key}
+}
+
+
+# get the function that crawls a single url of a site
+def make_crawler(site, session):
+    if site == 'macys':
+        return partial(crawl_product, headers=MACYS_HEADERS, session=session)
+    return partial(bs4_review_scraper, session=session, fast_probe=True)
+
+# get the session of a site, every worker paces its own ip
+def make_session(site):
+    if site == 'macys':
+        return PooledSession(rate_limiter=AdaptiveRateLimiter(), policy=FetchPolicy())
+    return PooledSession(pool_connections=4, pool_maxsize=8, rate_limiter=AdaptiveRateLimiter(),
+                         policy=FetchPolicy(hedge=True))
+
+# lease batches until the queue is drained, writing every result to this worker's own shard
+def run_worker(queue, site, shard_dir, worker_id, batch_size=20, shards=None, poll_interval=10.0):
+
+    # this worker's output shard, picked up again if the worker restarts
+    os.makedirs(shard_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(shard_dir, f'{worker_id}.jsonl'), resume=True)
+
+    # get the crawler
+    session = make_session(site)
+    crawl = make_crawler(site, session)
+
+    # iterate until every task is done or given up on
+    lease = None
+    try:
+        while True:
+
+            # get a batch
+            lease = queue.lease(worker_id, batch_size=batch_size, shards=shards)
+
+            # case when nothing is available, other workers may still hand leases back
+            if lease is None:
+                if queue.is_drained():
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # iterate over each task of the batch
+            last_heartbeat = time.time()
+            for key, url in lease.tasks:
+
+                # keep the lease alive, and stop if it expired and went to another worker
+                if time.time() - last_heartbeat > queue.visibility_timeout / 2:
+                    if not queue.heartbeat(lease):
+                        logging.warning(f'Lost lease {lease.lease_id}, dropping the rest of the batch')
+                        break
+                    last_heartbeat = time.time()
+
+                # a task that was written out before a crash only needs marking
+                if not checkpoint.is_done(key):
+
+                    # a failing product goes back to the queue
+                    try:
+                        result = crawl(url)
+                    except Exception as e:
+                        logging.warning(f'Failed to crawl url: {url} ({e!r})')
+                        metrics.error('crawl', site)
+                        queue.fail(lease, key)
+                        continue
+
+                    # write out the result
+                    with metrics.timer('write', 'checkpoint'):
+                        checkpoint.record(key, result)
+
+                # mark it done
+                queue.complete(lease, [key])
+            lease = None
+
+    # hand back whatever wasn't finished, so another worker doesn't have to wait out the lease
+    finally:
+        if lease is not None:
+            queue.release(lease)
+        checkpoint.close()
+        session.close()
+        metrics.write_json(os.path.join(shard_dir, f'{worker_id}_metrics.json'))
+
+# merge every worker's shard into one list, a product written by two workers is kept once
+def merge_shards(shard_dir, key_func):
+
+    # key -> result
+    results = {}
+
+    # iterate over each shard
+    for name in sorted(os.listdir(shard_dir)):
+        if not name.endswith('.jsonl'):
+            continue
+
+        # read the shard, skipping a partially written last line
+        with open(os.path.join(shard_dir, name), 'r', encoding='utf-8') as fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    continue
+                result = json.loads(line)
+                results.setdefault(str(key_func(result['url'])), result)
+
+    # return the results
+    return list(results.values())
+
+
+# runner
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['enqueue', 'worker', 'status', 'merge'])
+    parser.add_argument('--site', choices=sorted(SITES), required=True)
+    parser.add_argument('--queue', default=None,
+                        help='path of the queue database, defaults to ../data/<site>_queue.sqlite')
+    parser.add_argument('--input', default=None,
+                        help='file with the urls to enqueue, defaults to the site\'s product list')
+    parser.add_argument('--num-shards', type=int, default=16,
+                        help='number of shards the product keys are hashed into')
+    parser.add_argument('--shards', default=None,
+                        help='comma separated shards this worker leases from, defaults to all of them')
+    parser.add_argument('--batch-size', type=int, default=20,
+                        help='number of products leased at once')
+    parser.add_argument('--visibility-timeout', type=float, default=600.0,
+                        help='seconds before an unfinished batch goes back to the queue')
+    parser.add_argument('--worker-id', default=None,
+                        help='name of this worker\'s output shard, defaults to <host>-<pid>')
+    args = parser.parse_args()
+
+    # get the site
+    site = SITES[args.site]
+    queue_path = args.queue if args.queue is not None else f'../data/{args.site}_queue.sqlite'
+    shard_dir = f'../data/shards/{args.site}'
+    os.makedirs(os.path.dirname(queue_path) or '.', exist_ok=True)
+
+    # open the queue
+    queue = LeaseQueue(queue_path, num_shards=args.num_shards, visibility_timeout=args.visibility_timeout,
+                       key_func=site['key_func'])
+
+    # case when the coordinator fills the queue
+    if args.command == 'enqueue':
+        input_path = args.input if args.input is not None else site['input_path']
+        num_new = queue.enqueue_many(iter_urls(input_path, prefix=site['prefix']))
+        logging.info(f'Queued {num_new} new products: {queue.stats()}')
+
+    # case when this is a worker
+    elif args.command == 'worker':
+        shards = [int(shard) for shard in args.shards.split(',')] if args.shards is not None else None
+        worker_id = args.worker_id if args.worker_id is not None else make_worker_id()
+        run_worker(queue, args.site, shard_dir, worker_id, batch_size=args.batch_size, shards=shards)
+
+    # case when the progress should be printed
+    elif args.command == 'status':
+        print(json.dumps(queue.stats(), indent=4))
+
+    # otherwise, merge the shards into a single file
+    else:
+        with open(f'../data/{args.site}_scraped.json', 'w', encoding='utf-8') as fp:
+            json.dump(merge_shards(shard_dir, site['key_func']), fp, indent=4)
+
+    # close the queue
+    queue.close()
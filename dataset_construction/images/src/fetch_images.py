@@ -0,0 +1,75 @@
+import argparse
+import logging
+from dataset_construction.common.src.checkpoint import load_results
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.common.src.image_store import ImageStore
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+from dataset_construction.common.src.session import PooledSession
+
+# headers
+HEADERS = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15'
+                         ' (KHTML, like Gecko) Version/15.3 Safari/605.1.15'}
+
+# scraped output of each site
+SITE_OUTPUTS = {
+    'macys': '../../macys_scraper/data/macys_scraped.json',
+    'bestbuy': '../../bs4/data/bestbuy_scraped.json'
+}
+
+
+# get every url nested in a payload, macy's review photos come as the raw xapi objects
+def find_urls(value):
+    if isinstance(value, str):
+        if value.startswith('http'):
+            yield value
+    elif isinstance(value, dict):
+        for nested in value.values():
+            yield from find_urls(nested)
+    elif isinstance(value, list):
+        for nested in value:
+            yield from find_urls(nested)
+
+# get the image urls of a scraped product of either site
+def iter_image_urls(result):
+
+    # product images of macy's, thumbnails of best buy
+    yield from result.get('product_images') or []
+    yield from result.get('thumbnails') or []
+
+    # images of the reviews
+    for review in result.get('product_reviews') or result.get('reviews') or []:
+        yield from review.get('product_images') or []
+        yield from find_urls(review.get('images'))
+
+
+# runner
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--site', choices=sorted(SITE_OUTPUTS), required=True)
+    parser.add_argument('--input', default=None,
+                        help='scraped products to get the images of, defaults to the site\'s scraped output')
+    parser.add_argument('--store', default='../data/store',
+                        help='directory of the image store, shared by both sites')
+    parser.add_argument('--max-workers', type=int, default=16,
+                        help='number of images downloaded at once')
+    args = parser.parse_args()
+
+    # get the urls, in the order they appear
+    input_path = args.input if args.input is not None else SITE_OUTPUTS[args.site]
+    urls = [url for result in load_results(input_path) for url in iter_image_urls(result)]
+
+    # download them, with the deadlines and retries every other crawl uses
+    session = PooledSession(pool_maxsize=args.max_workers, rate_limiter=AdaptiveRateLimiter(), policy=FetchPolicy())
+    with ImageStore(args.store, session=session, headers=HEADERS, max_workers=args.max_workers) as store:
+        digests = store.fetch_many(urls)
+        num_failed = sum(digest is None for digest in digests.values())
+        logging.info(f'{len(urls)} image urls, {len(digests)} unique, {num_failed} failed: {store.stats()}')
+    session.close()
+
+    # write out the metrics
+    metrics.write_json(f'../data/{args.site}_images_metrics.json')
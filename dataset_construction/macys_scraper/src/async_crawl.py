@@ -0,0 +1,212 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tqdm import tqdm
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.session import PooledSession
+from dataset_construction.macys_scraper.src.scrape_products_simple import get_prod_id, get_product_data, \
+    get_review_offsets, _get_review_data, parse_product_json, parse_review_window, NEWEST_FIRST
+from dataset_construction.macys_scraper.src.xapi_schema import decode_product, decode_reviews
+
+
+# class that crawls the xapi product and review endpoints with several requests in flight
+class AsyncCrawler:
+    def __init__(self, headers, max_in_flight=16, site_url='https://www.macys.com', rate_limiter=None,
+                 policy=None, cache=None, watermarks=None, parse_pool=None):
+        self.headers = headers
+        self.watermarks = watermarks
+        self.parse_pool = parse_pool
+        self.max_in_flight = max_in_flight
+        self.site_url = site_url.rstrip('/')
+
+        # one session so the blocking requests share a connection pool
+        self.session = PooledSession(pool_connections=4, pool_maxsize=max_in_flight, rate_limiter=rate_limiter,
+                                     policy=policy, cache=cache)
+
+    # get a response without blocking the event loop
+    async def fetch_response(self, url, params=None):
+
+        # wait for a free request slot
+        async with self.semaphore:
+
+            # run the blocking request on the thread pool
+            return await self.loop.run_in_executor(
+                self.executor, partial(self.session.get, url, headers=self.headers, params=params))
+
+    # get a json payload without blocking the event loop, decoded with the decoder of its endpoint
+    async def fetch_json(self, url, params=None, target='macys_product', decode=decode_product):
+
+        # make the request
+        response = await self.fetch_response(url, params=params)
+
+        # decode the payload
+        with metrics.timer('parse', target, len(response.content)):
+            return decode(response.content)
+
+    # run an extractor in the parse pool without blocking the event loop
+    async def run_parse(self, target, func, content, *args):
+        return await self.loop.run_in_executor(self.executor,
+                                               partial(self.parse_pool.run, target, func, content, *args))
+
+    # get a single window of reviews
+    async def fetch_review_window(self, base_url, params):
+
+        # case when the window is parsed in the parse pool
+        if self.parse_pool is not None:
+            response = await self.fetch_response(base_url, params=params)
+            return await self.run_parse('_get_review_data', parse_review_window, response.content)
+
+        # otherwise, parse it here
+        reviews_dict = await self.fetch_json(base_url, params=params, target='macys_reviews', decode=decode_reviews)
+        with metrics.timer('extract', '_get_review_data'):
+            return _get_review_data(reviews_dict)
+
+    # get all reviews of a product at once
+    async def fetch_reviews(self, product_id, num_reviews):
+
+        # url without attributes
+        base_url = f'{self.site_url}/xapi/digital/v1/product/{product_id}/reviews'
+
+        # case when only the reviews added since the last run are wanted
+        if self.watermarks is not None:
+            return await self.fetch_new_reviews(base_url, f'macys:{product_id}', num_reviews)
+
+        # request every offset concurrently
+        windows = await asyncio.gather(*[self.fetch_review_window(base_url, {'offset': offset})
+                                         for offset in get_review_offsets(num_reviews)])
+
+        # merge the windows in offset order
+        reviews_list = []
+        for window in windows:
+            reviews_list.extend(window)
+
+        # return the list
+        return reviews_list
+
+    # get the reviews of a product added since the last run, newest first
+    async def fetch_new_reviews(self, base_url, key, num_reviews):
+
+        # get the watermark of the previous run
+        watermark = self.watermarks.get(key)
+
+        # the count didn't move, so there's nothing new to fetch
+        if self.watermarks.is_unchanged(watermark, num_reviews):
+            return []
+
+        # list that will hold the new reviews
+        reviews_list = []
+
+        # case when the product wasn't seen before, every offset is requested concurrently
+        if watermark is None:
+            windows = await asyncio.gather(*[
+                self.fetch_review_window(base_url, {'offset': offset, 'sort': NEWEST_FIRST})
+                for offset in get_review_offsets(num_reviews)])
+            for window in windows:
+                reviews_list.extend(window)
+
+        # otherwise, page newest first and stop at the first review the previous run had
+        else:
+            for offset in get_review_offsets(num_reviews):
+                window = await self.fetch_review_window(base_url, {'offset': offset, 'sort': NEWEST_FIRST})
+                new_reviews, reached_known = self.watermarks.take_new(window, watermark)
+                reviews_list.extend(new_reviews)
+                if reached_known:
+                    break
+
+        # move the watermark past the newest reviews
+        self.watermarks.update(key, num_reviews, reviews_list, watermark)
+
+        # return the list
+        return reviews_list
+
+    # run the whole pipeline for a single product url
+    async def crawl_url(self, url):
+
+        # get the product id
+        url_id = get_prod_id(url)
+        prod_url = f'{self.site_url}/xapi/digital/v1/product/{url_id}'
+
+        # case when the payload is parsed in the parse pool
+        if self.parse_pool is not None:
+            response = await self.fetch_response(prod_url)
+            results, product_id = await self.run_parse('get_product_data', parse_product_json, response.content, url)
+
+        # otherwise, parse it here
+        else:
+            prod_results = await self.fetch_json(prod_url)
+            with metrics.timer('extract', 'get_product_data'):
+                results = get_product_data(prod_dict=prod_results, url=url, headers=self.headers,
+                                           fetch_reviews=False)
+            product_id = prod_results['product'][0]['id']
+
+        # get the reviews
+        results['product_reviews'] = await self.fetch_reviews(product_id, results['number_reviews'])
+
+        # return the results
+        return results
+
+    # worker that keeps pulling urls off the queue
+    async def worker(self, queue, results, progress, on_result):
+
+        # iterate until the queue is drained
+        while True:
+            try:
+                idx, url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            # a failing product shouldn't stop the crawl
+            try:
+                results[idx] = await self.crawl_url(url)
+            except Exception as e:
+                logging.warning(f'Failed to crawl url: {url} ({e!r})')
+                metrics.error('crawl', 'macys_product')
+
+            # hand finished results off right away, e.g. to a checkpoint
+            else:
+                if on_result is not None:
+                    on_result(url, results[idx])
+
+            # update the progress bar
+            progress.update(1)
+
+    # crawl every url and return the results in input order
+    async def crawl(self, urls, on_result=None):
+
+        # state shared by the workers
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+        # fill the queue
+        queue = asyncio.Queue()
+        for idx, url in enumerate(urls):
+            queue.put_nowait((idx, url))
+
+        # list to hold all output
+        results = [None] * len(urls)
+
+        # run the workers
+        try:
+            with tqdm(total=len(urls)) as progress:
+                await asyncio.gather(*[self.worker(queue, results, progress, on_result)
+                                       for _ in range(self.max_in_flight)])
+        finally:
+            self.executor.shutdown(wait=False)
+
+        # drop the products that failed
+        return [result for result in results if result is not None]
+
+
+# crawl a list of product urls with the async engine
+def crawl_products(urls, headers, max_in_flight=16, site_url='https://www.macys.com', on_result=None,
+                   rate_limiter=None, policy=None, cache=None, watermarks=None, parse_pool=None):
+
+    # create the crawler
+    crawler = AsyncCrawler(headers=headers, max_in_flight=max_in_flight, site_url=site_url,
+                           rate_limiter=rate_limiter, policy=policy, cache=cache, watermarks=watermarks,
+                           parse_pool=parse_pool)
+
+    # run it
+    return asyncio.run(crawler.crawl(urls, on_result=on_result))
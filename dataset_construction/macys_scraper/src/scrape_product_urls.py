@@ -1,13 +1,39 @@
+import argparse
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
 from lxml.html import fromstring
 from tqdm import tqdm
 import requests
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.frontier import UrlFrontier, iter_urls
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+from dataset_construction.common.src.response_cache import ResponseCache
+from dataset_construction.common.src.selector_registry import compile_xpath
+from dataset_construction.common.src.session import PooledSession
+from dataset_construction.macys_scraper.src.scrape_products_simple import get_product_key
+
+# links to the products of a listing page
+PRODUCT_LINK_XPATH = compile_xpath('//a[starts-with(@class, "productDescLink")]')
+
+# page links and page numbers inside the pagination element
+PAGINATION_XPATH = compile_xpath('//*[contains(@class, "pagination") or contains(@id, "pagination") '
+                                 'or contains(@class, "Pagination") or contains(@id, "Pagination")]')
+PAGE_VALUES_XPATH = compile_xpath('.//a/@href | .//option/@value | .//a/text() | .//li/text()')
+
+# a listing page url, split up into the category and the page number
+LISTING_PAGE_PATTERN = re.compile(r'^(?P<base>.+?)/Pageindex/(?P<page>\d+)\?id=(?P<id>\d+)')
+CATEGORY_ROOT_PATTERN = re.compile(r'^(?P<base>[^?]+?)/?\?id=(?P<id>\d+)')
+PAGE_LINK_PATTERN = re.compile(r'/Pageindex/(\d+)')
 
 
 # scrape product urls from each url
-def scrape_urls(doc, url, out_path):
+def scrape_urls(doc, url, out_path, frontier=None):
 
     # get the elements
-    url_eles = doc.xpath('//a[starts-with(@class, "productDescLink")]')
+    url_eles = PRODUCT_LINK_XPATH(doc)
 
     # case when this works
     try:
@@ -15,7 +41,7 @@ def scrape_urls(doc, url, out_path):
         prod_urls = {ele.attrib['href'] for ele in url_eles}
 
         # write out the urls
-        write_product_urls(prod_urls, out_path, len(prod_urls))
+        write_product_urls(prod_urls, out_path, len(prod_urls), frontier=frontier)
 
     # for whatever reason, this may not work
     except:
@@ -23,14 +49,158 @@ def scrape_urls(doc, url, out_path):
         # just return
         print(f'failed at url: {url}')
 
+# scrape product urls while the page is still downloading
+def stream_product_urls(url, headers, session=requests, chunk_size=16384):
+
+    # set of product urls
+    prod_urls = set()
+
+    # parser that hands out elements as they are parsed
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+
+    # the element that holds the product grid, known once the first product link shows up
+    grid_ele = None
+
+    # stream the page
+    with session.get(url, headers=headers, stream=True) as response:
+
+        # feed the chunks as they arrive
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            parser.feed(chunk)
+
+            # go through what's been parsed so far
+            for event, ele in parser.read_events():
+
+                # collect the product links
+                if event == 'start':
+                    if ele.tag == 'a' and ele.get('class', '').startswith('productDescLink'):
+                        prod_urls.add(ele.get('href'))
+
+                        # the grid is the closest list around the first product link
+                        if grid_ele is None:
+                            grid_ele = next(ele.iterancestors('ul'), None)
+
+                # once the grid has closed, the rest of the page isn't needed
+                elif ele is grid_ele:
+                    return prod_urls
+
+                # drop finished elements so the tree doesn't grow with the page
+                else:
+                    ele.clear(keep_tail=True)
+                    while ele.getprevious() is not None:
+                        del ele.getparent()[0]
+
+    # the grid never closed, so the whole page was read
+    parser.close()
+    return prod_urls
+
+# get the category roots, as (base url, category id), out of listing page or category urls
+def get_category_roots(urls):
+
+    # ordered set of roots
+    roots = {}
+
+    # iterate over each url
+    for url in urls:
+
+        # case when it's a listing page, or a category root
+        match = LISTING_PAGE_PATTERN.match(url) or CATEGORY_ROOT_PATTERN.match(url)
+        if match is None:
+            logging.warning(f'Not a category url: {url}')
+            continue
+
+        # add the root
+        roots.setdefault((match.group('base'), match.group('id')), None)
+
+    # return the roots
+    return list(roots)
+
+# get the url of a page of a category
+def listing_page_url(root, page):
+    return f'{root[0]}/Pageindex/{page}?id={root[1]}'
+
+# get the product urls of a listing page
+def get_product_hrefs(doc):
+    return {ele.get('href') for ele in PRODUCT_LINK_XPATH(doc) if ele.get('href') is not None}
+
+# get the last page number shown in the pagination element, None if there's no pagination
+def get_last_page(doc):
+
+    # gather every number in the page links, the dropdown and the labels
+    pages = []
+    for pagination_ele in PAGINATION_XPATH(doc):
+        for value in PAGE_VALUES_XPATH(pagination_ele):
+
+            # case when it's a link to a page
+            value = str(value).strip()
+            match = PAGE_LINK_PATTERN.search(value)
+            if match is not None:
+                pages.append(int(match.group(1)))
+
+            # case when it's a page number
+            elif value.isdigit():
+                pages.append(int(value))
+
+    # return the largest
+    return max(pages) if len(pages) > 0 else None
+
+# get the product urls of a single listing page
+def fetch_listing_page(root, headers, session, page):
+
+    # get the page's html
+    content = session.get(listing_page_url(root, page), headers=headers).content
+    with metrics.timer('parse', 'macys_listing', len(content)):
+        doc = fromstring(html=content)
+
+    # get the product urls
+    with metrics.timer('extract', 'get_product_hrefs'):
+        return doc, get_product_hrefs(doc)
+
+# harvest the product urls of a category, stopping at its last page, returns the urls and the pages fetched
+def discover_category(root, headers, session=requests, max_workers=8):
+
+    # get the first page
+    doc, prod_urls = fetch_listing_page(root, headers, session, 1)
+    if len(prod_urls) == 0:
+        return prod_urls, 1
+
+    # function to get the product urls of a page
+    def fetch_hrefs(page):
+        return fetch_listing_page(root, headers, session, page)[1]
+
+    # fetch the rest of the pages concurrently
+    last_page = get_last_page(doc)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # case when the pagination says where the category ends
+        if last_page is not None:
+            for page_urls in executor.map(fetch_hrefs, range(2, last_page + 1)):
+                prod_urls |= page_urls
+            return prod_urls, max(last_page, 1)
+
+        # otherwise, go a window at a time until a page doesn't have anything new
+        page = 2
+        while True:
+            pages = range(page, page + max_workers)
+            for page_urls in executor.map(fetch_hrefs, pages):
+                if len(page_urls - prod_urls) == 0:
+                    return prod_urls, pages[-1]
+                prod_urls |= page_urls
+            page += max_workers
+
 # write out product urls
-def write_product_urls(urls_set: set, out_path: str, num_products_wrote: int):
+def write_product_urls(urls_set: set, out_path: str, num_products_wrote: int, frontier=None):
+
+    # only keep the products the frontier hasn't seen before, the whole page is added in one transaction
+    if frontier is not None:
+        prefix = "https://www.macys.com"
+        urls_set = [url[len(prefix):] for url in frontier.add_new(prefix + url for url in urls_set)]
 
     # open the file
     with open(out_path, 'a') as fp:
 
-        # write out the results
-        fp.writelines('\n'.join(list(urls_set)))
+        # write out the results, one per line
+        fp.writelines(url + '\n' for url in urls_set)
 
 # runner
 if __name__ == "__main__":
@@ -41,22 +211,95 @@ if __name__ == "__main__":
     # output path
     out_path = r'../data/macys_products_to_scrape.txt'
 
-    # read data
-    data = []
-    with open(input_path, 'r') as fp:
-        for line in fp.readlines():
-            data.append(line.split('\n')[0])
-            if len(line.split('https')) > 2:
-                data.append('https' + line.split('https')[2].split('\n')[0])
+    # frontier of the products, shared with the product scrapers
+    frontier = UrlFrontier('../data/macys_frontier.sqlite', key_func=get_product_key)
 
     # headers
     headers = {'User-Agent': 'Mozilla/5.0'}
 
-    # iterate over each url
-    for url in tqdm(data):
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', action='store_true',
+                        help='parse the pages while they download and stop once the product grid closes')
+    parser.add_argument('--discover', action='store_true',
+                        help='crawl each category from its first page until its last one, instead of the page list')
+    parser.add_argument('--roots', default=input_path,
+                        help='file with the category urls to discover, listing page urls are reduced to their category')
+    parser.add_argument('--max-workers', type=int, default=8,
+                        help='number of listing pages of a category fetched at once when discovering')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve repeat requests from the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='replay responses from the cache without touching the network')
+    args = parser.parse_args()
+
+    # on-disk response cache, offline replay only reads from it
+    cache = ResponseCache('../data/http_cache', offline=args.offline) if args.cache or args.offline else None
+
+    # session paced by the per-host rate limiter
+    rate_limiter = AdaptiveRateLimiter()
+    session = PooledSession(rate_limiter=rate_limiter, policy=FetchPolicy(), cache=cache)
+
+    # the stage metrics are exported while the crawl runs
+    metrics.start_exporter('../data/macys_listing_metrics.prom')
+
+    # case when the pages of each category are discovered
+    if args.discover:
+
+        # number of listing pages requested
+        num_pages = 0
+
+        # iterate over each category
+        for root in tqdm(get_category_roots(iter_urls(args.roots))):
+
+            # a failing category shouldn't stop the crawl
+            try:
+                prod_urls, category_pages = discover_category(root, headers, session=session,
+                                                              max_workers=args.max_workers)
+            except Exception as e:
+                logging.warning(f'Failed to discover category: {listing_page_url(root, 1)} ({e!r})')
+                metrics.error('crawl', 'macys_listing')
+                continue
+            num_pages += category_pages
+
+            # write out the urls
+            with metrics.timer('write', 'product_urls'):
+                write_product_urls(prod_urls, out_path, len(prod_urls), frontier=frontier)
+
+        # log how many listing pages it took
+        logging.info(f'Requested {num_pages} listing pages')
+
+    # otherwise, go through the precomputed page list
+    else:
+
+        # iterate over each url, glued urls are split up as the file is read
+        for url in tqdm(iter_urls(input_path)):
+
+            # case when the page should be streamed
+            if args.stream:
+
+                # get the product urls as the page comes in, the parse overlaps the download
+                with metrics.timer('parse', 'macys_listing_stream'):
+                    prod_urls = stream_product_urls(url, headers, session=session)
+
+                # write out the urls
+                with metrics.timer('write', 'product_urls'):
+                    write_product_urls(prod_urls, out_path, len(prod_urls), frontier=frontier)
+                continue
+
+            # get the page's html
+            content = session.get(url, headers=headers).content
+            with metrics.timer('parse', 'macys_listing', len(content)):
+                doc = fromstring(html=content)
+
+            # scrape the urls
+            with metrics.timer('extract', 'scrape_urls'):
+                scrape_urls(doc, url, out_path, frontier=frontier)
 
-        # get the page's html
-        doc = fromstring(html=requests.get(url, headers=headers).content)
+    # close the frontier and the session
+    frontier.close()
+    session.close()
 
-        # scrape the urls
-        scrape_urls(doc, url, out_path)
+    # write out the stage metrics
+    metrics.stop_exporter('../data/macys_listing_metrics.prom')
+    metrics.write_json('../data/macys_listing_metrics.json')
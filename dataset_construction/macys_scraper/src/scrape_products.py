@@ -1,7 +1,22 @@
+import argparse
 import requests
+import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from lxml.html import fromstring
+from dataset_construction.common.src.checkpoint import Checkpoint
+from dataset_construction.common.src.selector_registry import Selector, Field, ExtractionEngine, compile_xpath
+from dataset_construction.common.src.sinks import make_sink
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.parse_pool import ParsePool, iter_bounded
+from dataset_construction.common.src.frontier import UrlFrontier, iter_urls
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+from dataset_construction.common.src.records import encode
+from dataset_construction.common.src.response_cache import ResponseCache
+from dataset_construction.common.src.session import PooledSession
+from dataset_construction.macys_scraper.src.scrape_products_simple import get_prod_id, get_product_key
 
 
 # write out product urls
@@ -11,105 +26,59 @@ def write_products(product_dict: dict, out_path: str):
     with open(out_path, 'a') as fp:
 
         # write out the results
-        fp.writelines(str(product_dict) + '\n')
+        fp.write(encode(product_dict) + '\n')
 
-# function to get the brand and product title
-def get_brand_prod_title(doc):
-    # get the brand
-    brand_ele = doc.xpath('//a[contains(@data-auto, "product-brand")]')
-
-    # if the brand title wasn't found, set the brand title to an empty string
-    if len(brand_ele) == 0:
-
-        # make the brand an empty string
-        brand = "N/A"
-
-    # otherwise, get the string
-    else:
-
-        try:
-            # get string
-            brand = brand_ele[0].text_content().strip()
-        except:
-            brand = 'N/A'
+# selectors of the product page fields
+BRAND_SELECTOR = Selector('a', 'data-auto', 'contains', 'product-brand')
+TITLE_SELECTOR = Selector('div', 'class', 'contains', 'product-title')
+DESCRIPTION_SELECTOR = Selector('p', 'itemprop', 'contains', 'description')
+BULLETS_SELECTOR = Selector('ul', 'data-auto', 'contains', 'product-description-bullets')
+THUMBNAIL_SELECTOR = Selector('picture', 'class', 'contains', 'main-picture')
+RELATED_SELECTOR = Selector('div', 'class', 'contains', 'productThumbnail')
+PRICE_SELECTOR = Selector('div', 'class', 'contains', 'lowest-sale-price')
 
-    # get the title
-    title_ele = doc.xpath('//div[contains(@class, "product-title")]')
+# relative expressions used inside the matched elements
+LI_XPATH = compile_xpath('.//li')
+IMG_XPATH = compile_xpath('.//img')
+CHILDREN_XPATH = compile_xpath('./*')
 
-    # if the title wasn't found, set the brand title to an empty string
-    if len(title_ele) == 0:
+# function to get the text of the first matched element
+def _first_text(eles):
 
-        # make the title an empty string
-        title = "N/A"
+    # if the element wasn't found, set the text to N/A
+    if len(eles) == 0:
+        return "N/A"
 
     # otherwise, get the string
-    else:
-        try:
-            # get string
-            title = title_ele[0].text_content().strip()
-        except:
-            title = 'N/A'
-
-    # return a tuple of the brand and title
-    return (brand, title)
-
-
-# function to get the product description
-def get_prod_description(doc):
-    # get the path to the product description
-    prod_desc_ele = doc.xpath('//p[contains(@itemprop, "description")]')
-
-    # if empty, then return empty list
-    if len(prod_desc_ele) == 0:
-
-        # set to empty string
-        paragraph_info = 'N/A'
-
-    # otherwise, get the content
-    else:
-        try:
-
-            # set content equal to the paragraph_info var
-            paragraph_info = prod_desc_ele[0].text_content().strip()
-        except:
-            paragraph_info = 'N/A'
+    try:
+        return eles[0].text_content().strip()
+    except:
+        return 'N/A'
 
-    # get the path to the product bullet list
-    bullet_ele = doc.xpath('//ul[contains(@data-auto, "product-description-bullets")]')
+# function to get the bullets from the matched bullet lists
+def _bullets_from(bullet_ele):
 
-    # if empty, then return empty list
+    # if empty, then return N/A
     if len(bullet_ele) == 0:
-
-        # set to empty string
-        bullet_info = 'N/A'
+        return 'N/A'
 
     # otherwise, get the content
-    else:
+    try:
+        # set content equal to the paragraph_info var
+        nested_bullets = LI_XPATH(bullet_ele[0])
 
-        try:
-            # set content equal to the paragraph_info var
-            nested_bullets = bullet_ele[0].xpath('.//li')
+        # get the text
+        return [ele.text_content().strip() for ele in nested_bullets]
 
-            # get the text
-            bullet_info = [ele.text_content().strip() for ele in nested_bullets]
+    except:
+        return 'N/A'
 
-        except:
-            bullet_info = 'N/A'
+# function to get the thumbnails from the matched pictures
+def _thumbnails_from(thumbnail_eles):
 
-    # return the information
-    return {
-        "paragraph": paragraph_info,
-        "bullets": bullet_info
-    }
-
-# function to get the thumbnails
-def get_thumbnails(doc):
     # define thumbnail list
     thumbnail_urls = []
 
-    # element that has the thumbnails
-    thumbnail_eles = doc.xpath('//picture[contains(@class, "main-picture")]')
-
     # in the event this does work
     try:
 
@@ -117,7 +86,7 @@ def get_thumbnails(doc):
         for ele in thumbnail_eles:
 
             # get all corresponding nested thumbnail elements
-            nested_thumbnail_img = ele.xpath('.//img')[0].attrib['src']
+            nested_thumbnail_img = IMG_XPATH(ele)[0].attrib['src']
 
             # get all the thumbnail links
             if nested_thumbnail_img not in thumbnail_urls:
@@ -132,36 +101,23 @@ def get_thumbnails(doc):
     # return the thumbnails
     return thumbnail_urls
 
-# function to get related products
-def get_related_products(doc):
-    # elements that represent related products
-    related_eles = doc.xpath('//div[contains(@class, "productThumbnail")]')
-
-    # case when this doesn't work
-    if len(related_eles) == 0:
-
-        # return an empty list
-        return []
-
-    # otherwise, get all the images
-    else:
+# function to get related products from the matched thumbnails
+def _related_from(related_eles):
 
-        # get all images
-        try:
-            return ["https://www.macys.com" + ele.xpath('./*')[0].attrib["href"]
+    # get all images
+    try:
+        return ["https://www.macys.com" + CHILDREN_XPATH(ele)[0].attrib["href"]
                 for ele in related_eles]
-        except:
-            return []
+    except:
+        return []
 
-# get the product price
-def get_price(doc):
-    # try to see if there's a sale price
-    sale_price_ele = doc.xpath('//div[contains(@class, "lowest-sale-price")]')
+# function to get the price from the matched sale prices
+def _price_from(sale_price_ele):
 
     # if the length is not 0, then this is the price you want to return
     if len(sale_price_ele) > 0:
         try:
-            return float(sale_price_ele[0].xpath('./*')[0].text_content().strip().replace('$','').replace(',', ''))
+            return float(CHILDREN_XPATH(sale_price_ele[0])[0].text_content().strip().replace('$','').replace(',', ''))
         except:
             return -1
 
@@ -169,11 +125,52 @@ def get_price(doc):
     else:
         return -1
 
+# declarative spec of the product page, filled with a single walk over the tree
+MACYS_PRODUCT_FIELDS = [
+    Field('brand', BRAND_SELECTOR, _first_text),
+    Field('title', TITLE_SELECTOR, _first_text),
+    Field('paragraph', DESCRIPTION_SELECTOR, _first_text),
+    Field('bullets', BULLETS_SELECTOR, _bullets_from),
+    Field('thumbnails', THUMBNAIL_SELECTOR, _thumbnails_from),
+    Field('price', PRICE_SELECTOR, _price_from)
+]
+
+# function to get the brand and product title
+def get_brand_prod_title(doc):
+
+    # return a tuple of the brand and title
+    return (_first_text(BRAND_SELECTOR.xpath(doc)), _first_text(TITLE_SELECTOR.xpath(doc)))
+
+
+# function to get the product description
+def get_prod_description(doc):
+
+    # return the information
+    return {
+        "paragraph": _first_text(DESCRIPTION_SELECTOR.xpath(doc)),
+        "bullets": _bullets_from(BULLETS_SELECTOR.xpath(doc))
+    }
+
+# function to get the thumbnails
+def get_thumbnails(doc):
+    return _thumbnails_from(THUMBNAIL_SELECTOR.xpath(doc))
+
+# function to get related products
+def get_related_products(doc):
+    return _related_from(RELATED_SELECTOR.xpath(doc))
+
+# get the product price
+def get_price(doc):
+    return _price_from(PRICE_SELECTOR.xpath(doc))
+
+# pagination of the reviews
+PAGINATION_XPATH = compile_xpath('//ul[contains(@class, "pagination text-center")]')
+
 # get customer reviews
 def get_reviews(doc):
 
     # go to the pagination element
-    pagination_ele = doc.xpath('//ul[contains(@class, "pagination text-center")]')
+    pagination_ele = PAGINATION_XPATH(doc)
 
     # if this is empty, then that should mean there aren't any reviews
     if len(pagination_ele) == 0:
@@ -185,18 +182,12 @@ def get_reviews(doc):
 
 
 # function to scrape a product page
-def scrape_product(doc, url):
-    # get the thumbnails
-    thumbnails = get_thumbnails(doc)
+def scrape_product(doc, url, engine=None):
 
-    # get the brand and product title
-    brand, title = get_brand_prod_title(doc)
-
-    # get the product description
-    prod_desc = get_prod_description(doc)
-
-    # get the price
-    price = get_price(doc)
+    # fill every field with a single walk over the tree
+    if engine is None:
+        engine = ExtractionEngine(MACYS_PRODUCT_FIELDS)
+    fields = engine.extract(doc)
 
     # get related items
     # related_items = get_related_products(doc)
@@ -206,14 +197,38 @@ def scrape_product(doc, url):
 
     # return the scraped data
     return {
-        'product_name': title,
-        'brand': brand,
-        'price': price,
-        'description': prod_desc,
-        'thumbnails': thumbnails
+        'url': url,
+        'product_name': fields['title'],
+        'brand': fields['brand'],
+        'price': fields['price'],
+        'description': {
+            "paragraph": fields['paragraph'],
+            "bullets": fields['bullets']
+        },
+        'thumbnails': fields['thumbnails']
     }
 
 
+# get a scraped product with the missing-value sentinels as nulls and empty lists, so every column has one type
+def to_columnar(scraped_data):
+
+    # the price is -1 when it wasn't found, and an int when it has no cents
+    price = scraped_data['price']
+    price = None if price == -1 else float(price)
+
+    # the bullets are N/A when there aren't any
+    bullets = scraped_data['description']['bullets']
+    bullets = bullets if isinstance(bullets, list) else []
+
+    # return a copy, the checkpoint keeps the record as it was scraped
+    return dict(scraped_data, price=price, description=dict(scraped_data['description'], bullets=bullets))
+
+
+# parse a raw product page and scrape it, runs in the parse pool
+def parse_product_page(content, url):
+    return scrape_product(fromstring(content), url)
+
+
 # runner
 if __name__ == "__main__":
 
@@ -225,38 +240,145 @@ if __name__ == "__main__":
                              ' (KHTML, like Gecko) Version/15.3 Safari/605.1.15'}
 
     # output path
-    output_path = r'../data/macys_scraped.json'
+    output_path = r'../data/macys_scraped_html.json'
+
+    # the rates and the selector profile are logged at the end of the run
+    logging.basicConfig(level=logging.INFO)
+
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the products completed by a previous run')
+    parser.add_argument('--sink', choices=['jsonl', 'parquet', 'arrow'], default='jsonl',
+                        help='kind of sink the products are written to')
+    parser.add_argument('--profile-selectors', action='store_true',
+                        help='log how long each field of the product page takes')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve repeat requests from the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='replay responses from the cache without touching the network')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='parse in this many processes while the pages are fetched, 0 parses inline')
+    parser.add_argument('--fetch-workers', type=int, default=16,
+                        help='number of pages fetched at once when parsing in processes')
+    args = parser.parse_args()
+
+    # stream the urls into the frontier, which keeps one url per product across runs, and crawl only this run's
+    frontier = UrlFrontier('../data/macys_frontier.sqlite', key_func=get_product_key)
+    run_urls = frontier.add_run(iter_urls(input_path, prefix="https://www.macys.com"))
+    frontier.close()
+
+    # on-disk response cache, offline replay only reads from it
+    cache = ResponseCache('../data/http_cache', offline=args.offline) if args.cache or args.offline else None
+
+    # session paced by the per-host rate limiter
+    rate_limiter = AdaptiveRateLimiter()
+    session = PooledSession(rate_limiter=rate_limiter, policy=FetchPolicy(), cache=cache)
+
+    # one engine for the whole run so the timings add up
+    engine = ExtractionEngine(MACYS_PRODUCT_FIELDS, profile=args.profile_selectors)
+
+    # results are flushed here as they come in, apart from the xapi runner's so neither resumes from the other
+    checkpoint = Checkpoint(r'../data/macys_scraped_html.jsonl', resume=args.resume)
+
+    # sink that the products are written to as they come in
+    sink_path = '../data/macys_scraped.txt' if args.sink == 'jsonl' else f'../data/macys_scraped_html_{args.sink}'
+    sink = make_sink(args.sink, sink_path, key_func=lambda record: get_prod_id(record['url']),
+                     reviews_field='reviews')
+
+    # the stage metrics are exported while the crawl runs
+    metrics.start_exporter('../data/macys_html_metrics.prom')
+
+    # function to write out and flush the results
+    def handle_result(url, scraped_data):
+
+        # write out products, the columnar sinks need one type per column
+        with metrics.timer('write', 'sink'):
+            sink.write(scraped_data if args.sink == 'jsonl' else to_columnar(scraped_data))
+
+        # flush the results
+        with metrics.timer('write', 'checkpoint'):
+            checkpoint.record(get_prod_id(url), scraped_data)
+
+    # case when the parsing runs in processes, several pages are fetched at once to keep them busy
+    if args.parse_workers > 0:
+
+        # skip the products that are already done
+        urls = [url for url in run_urls if not checkpoint.is_done(get_prod_id(url))]
+
+        # function that fetches a page on a fetch thread and scrapes it in the parse pool
+        def crawl_url(url):
+            content = session.get(url, headers=headers).content
+            return parse_pool.run('scrape_product', parse_product_page, content, url)
+
+        # fetch on threads, parse in processes, and write out in completion order
+        parse_pool = ParsePool(max_workers=args.parse_workers)
+        with ThreadPoolExecutor(max_workers=args.fetch_workers) as fetch_executor:
+            for url, future in tqdm(iter_bounded(fetch_executor, crawl_url, urls, 2 * args.fetch_workers),
+                                    total=len(urls)):
+
+                # if it didn't work, count it and move on
+                try:
+                    scraped_data = future.result()
+                except Exception as e:
+                    logging.warning(f'Failed to get url: {url} ({e!r})')
+                    metrics.error('crawl', 'macys_product')
+                    continue
+                handle_result(url, scraped_data)
+        parse_pool.close()
+
+    # otherwise, go one at a time
+    else:
 
-    # read in the data
-    with open(input_path, 'r') as fp:
-        data = ["https://www.macys.com" + line.split('\n')[0] for line in fp.readlines()]
+        # iterate over each url
+        for url in tqdm(run_urls):
 
-    # list to hold all scraped urls
-    scraped_list = []
+            # skip the products that are already done
+            if checkpoint.is_done(get_prod_id(url)):
+                continue
 
-    # iterate over each url
-    for url in tqdm(data):
+            # in the case when this works
+            try:
 
-        # in the case when this works
-        try:
+                # get the html for the site
+                content = session.get(url, headers=headers).content
+                with metrics.timer('parse', 'macys_product', len(content)):
+                    doc = fromstring(content)
 
-            # get the html for the site
-            doc = fromstring(requests.get(url, headers=headers).content)
+            # sometimes it won't work
+            except Exception as e:
 
-        # sometimes it won't work
-        except:
+                # if it doesn't, count it and move on
+                logging.warning(f'Failed to get url: {url} ({e!r})')
+                metrics.error('crawl', 'macys_product')
+                continue
+
+            # scrape the urls
+            with metrics.timer('extract', 'scrape_product'):
+                scraped_data = scrape_product(doc, url, engine=engine)
+
+            # write out and flush the results
+            handle_result(url, scraped_data)
 
-            # if it doesn't, just move on
-            continue
+    # get the results of this and every previous run
+    scraped_list = checkpoint.load_results()
+    checkpoint.close()
+    sink.close()
+    session.close()
 
-        # scrape the urls
-        scraped_data = scrape_product(doc, url)
+    # write out the stage metrics
+    metrics.stop_exporter('../data/macys_html_metrics.prom')
+    metrics.write_json('../data/macys_html_metrics.json')
 
-        # write out products
-        write_products(scraped_data, out_path="../data/macys_scraped.txt")
+    # log the pace the crawl settled on
+    for host, rate in rate_limiter.get_rates().items():
+        logging.info(f"{host}: {rate['rate']:.2f} requests/sec, {rate['concurrency']} in flight")
 
-        # add to list
-        scraped_list.append(scraped_data)
+    # log the per-field timing breakdown
+    if args.profile_selectors:
+        for row in engine.timing_report():
+            logging.info(f"{row['field']}: {row['total_seconds']:.4f}s total, {row['match_seconds']:.4f}s matching, "
+                         f"{row['extract_seconds']:.4f}s extracting over {row['calls']} pages")
 
     # write to json
     with open(output_path, 'w') as fp:
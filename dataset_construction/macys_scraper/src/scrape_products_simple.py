@@ -1,6 +1,16 @@
+import argparse
+import logging
 import requests
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit, parse_qsl
 from tqdm import tqdm
+from dataset_construction.common.src.frontier import canonicalize_url
+from dataset_construction.common.src.metrics import metrics
+from dataset_construction.common.src.records import MacysProduct, MacysReview
+from dataset_construction.macys_scraper.src.xapi_schema import decode_product, decode_reviews
 
 # function to get a product's id
 def get_prod_id(url):
@@ -8,6 +18,11 @@ def get_prod_id(url):
     # case when this works
     try:
 
+        # get the id from the query, CategoryID= also contains ID=
+        query = dict(parse_qsl(urlsplit(url).query))
+        if 'ID' in query:
+            return query['ID']
+
         # get the id
         return url.split('ID=')[1].split('&')[0]
 
@@ -18,6 +33,22 @@ def get_prod_id(url):
         print("id fetch didn't work")
         return -1
 
+# function to get the key a product is deduplicated on
+def get_product_key(url):
+
+    # get the id
+    url_id = get_prod_id(url)
+
+    # the same ID with a different CategoryID is the same product
+    if url_id != -1:
+        return f'macys:{url_id}'
+
+    # otherwise, fall back to the normalized url
+    return canonicalize_url(url)
+
+# sort order of the reviews endpoint that returns the newest reviews first
+NEWEST_FIRST = 'NEWEST'
+
 # function to get data from the reviews dictionary
 def _get_review_data(rev_dict_list):
 
@@ -57,75 +88,119 @@ def _get_review_data(rev_dict_list):
         # get photos
         images = rev_dict['photos']
 
-        # make a dictionary of all this information
-        review_dict = {
-            'user_id': user_id,
-            'rating': rating,
-            'review_title': rev_title,
-            'review_body': rev_body,
-            'images': images,
-            'number_positive_feedback': num_positive_feedback,
-            'number_negative_feedback': num_negative_feedback
-        }
+        # make a record of all this information, it reads like the dictionary it replaced
+        review_record = MacysReview(user_id=user_id, rating=rating, review_title=rev_title, review_body=rev_body,
+                                    images=images, number_positive_feedback=num_positive_feedback,
+                                    number_negative_feedback=num_negative_feedback)
 
         # add to list
-        rev_list.append(review_dict)
+        rev_list.append(review_record)
 
     # return this list
     return rev_list
 
+# function to plan the review offsets to request
+def get_review_offsets(num_reviews, page_size=30):
+
+    # the number of reviews is known up front, so every window can be computed at once
+    return list(range(0, num_reviews, page_size))
+
+# function to parse a raw window of reviews, runs in the parse pool
+def parse_review_window(content):
+    return _get_review_data(decode_reviews(content))
+
+# function to get a single window of reviews
+def _get_review_window(base_url, headers, session, offset, sort=None, parse_pool=None):
+
+    # the sort order is only sent when asked for
+    params = {'offset': offset}
+    if sort is not None:
+        params['sort'] = sort
+
+    # make the request
+    response = session.get(url=base_url, headers=headers, params=params)
+
+    # case when the window is parsed in the parse pool
+    if parse_pool is not None:
+        return parse_pool.run('_get_review_data', parse_review_window, response.content)
+
+    # otherwise, parse it here
+    with metrics.timer('parse', 'macys_reviews', len(response.content)):
+        reviews_dict = decode_reviews(response.content)
+
+    # get reviews data
+    with metrics.timer('extract', '_get_review_data'):
+        return _get_review_data(reviews_dict)
+
 # function to get the reviews
-def get_reviews(product_dict, num_reviews, headers):
+def get_reviews(product_dict, num_reviews, headers, site_url='http://www.macys.com', max_workers=8,
+                session=requests, watermarks=None, parse_pool=None):
 
     # get the id
     id = product_dict['id']
 
     # url without attributes
-    base_url = f'http://www.macys.com/xapi/digital/v1/product/{id}/reviews'
+    base_url = f'{site_url}/xapi/digital/v1/product/{id}/reviews'
+
+    # case when only the reviews added since the last run are wanted
+    if watermarks is not None:
+        return get_new_reviews(base_url, num_reviews, headers, session, watermarks, f'macys:{id}',
+                               max_workers=max_workers, parse_pool=parse_pool)
 
     # list that will hold all reviews
     reviews_list = []
 
-    # check if number of reviews > 8
-    if num_reviews > 8:
+    # get the windows to request
+    offsets = get_review_offsets(num_reviews)
+
+    # exit if there aren't any reviews
+    if len(offsets) == 0:
+        return reviews_list
 
-        # offset value
-        offset = 8
+    # request every window concurrently, map keeps the results in offset order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window_func = partial(_get_review_window, base_url, headers, session, parse_pool=parse_pool)
+        for reviews_result_dict in executor.map(window_func, offsets):
 
-        # iterate until offset is larger than number of reviews
-        while (offset < num_reviews):
+            # add this to a list
+            reviews_list.extend(reviews_result_dict)
 
-            # make the request
-            rev_req = requests.get(url=base_url, headers=headers,
-                                   params={'offset': offset}).json()
+    # return the list
+    return reviews_list
 
-            # get the reviews dictionary
-            reviews_dict = rev_req['review']['reviews']
+# function to get the reviews added since the last run, newest first
+def get_new_reviews(base_url, num_reviews, headers, session, watermarks, key, max_workers=8, parse_pool=None):
 
-            # get reviews data
-            reviews_result_dict = _get_review_data(reviews_dict)
+    # get the watermark of the previous run
+    watermark = watermarks.get(key)
 
-            # add this to a list
-            reviews_list.extend(reviews_result_dict)
+    # the count didn't move, so there's nothing new to fetch
+    if watermarks.is_unchanged(watermark, num_reviews):
+        return []
 
-            # update offset
-            offset += 30
-
-    # case when there are reviews, but less than 8
-    # elif num_reviews > 0:
-    #
-    #     # make the request
-    #     rev_req = requests.get(url=base_url, headers=headers,
-    #                            params={'offset': 8}).json()
-    #
-    #     # get the reviews dictionary
-    #     reviews_dict = rev_req['review']['reviews']
-    #
-    #     # get reviews data
-    #     reviews_result_dict = _get_review_data(reviews_dict)
-    #
-    #     # add this to a list
-    #     reviews_list.extend(reviews_result_dict)
+    # list that will hold the new reviews
+    reviews_list = []
+
+    # case when the product wasn't seen before, every window is requested concurrently
+    if watermark is None:
+        window_func = partial(_get_review_window, base_url, headers, session, sort=NEWEST_FIRST,
+                              parse_pool=parse_pool)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for reviews_result_dict in executor.map(window_func, get_review_offsets(num_reviews)):
+                reviews_list.extend(reviews_result_dict)
+
+    # otherwise, page newest first and stop at the first review the previous run had
+    else:
+        for offset in get_review_offsets(num_reviews):
+            window = _get_review_window(base_url, headers, session, offset, sort=NEWEST_FIRST,
+                                        parse_pool=parse_pool)
+            new_reviews, reached_known = watermarks.take_new(window, watermark)
+            reviews_list.extend(new_reviews)
+            if reached_known:
+                break
+
+    # move the watermark past the newest reviews
+    watermarks.update(key, num_reviews, reviews_list, watermark)
 
     # return the list
     return reviews_list
@@ -133,7 +208,7 @@ def get_reviews(product_dict, num_reviews, headers):
 
 
 # extract all data of interest (except reviews)
-def get_product_data(prod_dict, url, headers):
+def get_product_data(prod_dict, url, headers, fetch_reviews=True, session=requests, watermarks=None):
 
     # get the meta data dictionary
     meta_dict = prod_dict['meta']['analytics']['data']
@@ -162,8 +237,9 @@ def get_product_data(prod_dict, url, headers):
     # get the number of reviews
     num_reviews = int(meta_dict['product_reviews'][0])
 
-    # get reviews
-    prod_reviews = get_reviews(prod_dict, num_reviews, headers)
+    # get reviews (the async crawler fetches these itself)
+    prod_reviews = get_reviews(prod_dict, num_reviews, headers, session=session,
+                               watermarks=watermarks) if fetch_reviews else []
 
     # get the description
     prod_desc = prod_dict['detail']['description']
@@ -183,38 +259,80 @@ def get_product_data(prod_dict, url, headers):
     # get keywords
     keywords = prod_dict['detail']['seoKeywords']
 
-    # get product images
-    prod_images = ["https://slimages.macysassets.com/is/image/MCY/products/" +
-                   image_dict['filePath'] for image_dict in prod_dict['imagery']['images']]
+    # get product images, the shared prefix is added back when they're read
+    prod_image_paths = [image_dict['filePath'] for image_dict in prod_dict['imagery']['images']]
 
     # get the colors
     # colors = [color_dict['normalName'] for color_dict in prod_dict['traits']['colors']['colorMap']]
 
-    # make a dictionary of all results
-    results_dict = {
-        'url': url,
-        'product_name': prod_name,
-        'product_brand': prod_brand,
-        'category': category_name,
-        'original_price': orig_price,
-        'current_price': cur_price,
-        'product_description': prod_desc,
-        'product_bullet_description': bullet_text,
-        'product_rating': prod_rating,
-        'number_reviews': num_reviews,
-        'product_images': prod_images,
-        'product_keywords': keywords,
-        'product_reviews': prod_reviews
-        # 'colors': colors
-    }
-
-    # return the dictionary
-    return results_dict
+    # make a record of all results
+    results_record = MacysProduct(url=url, product_name=prod_name, product_brand=prod_brand, category=category_name,
+                                  original_price=orig_price, current_price=cur_price, product_description=prod_desc,
+                                  product_bullet_description=bullet_text, product_rating=prod_rating,
+                                  number_reviews=num_reviews, image_paths=prod_image_paths,
+                                  product_keywords=keywords, product_reviews=prod_reviews)
+
+    # return the record
+    return results_record
+
+# parse a raw xapi product payload, runs in the parse pool
+def parse_product_json(content, url):
+
+    # decode the payload
+    prod_dict = decode_product(content)
+
+    # return the product data and the id its reviews are under
+    return get_product_data(prod_dict, url, headers={}, fetch_reviews=False), prod_dict['product'][0]['id']
+
+# crawl a single product, its details and its reviews
+def crawl_product(url, headers, session=requests, watermarks=None, parse_pool=None, site_url='https://www.macys.com'):
+
+    # get the product id
+    url_id = get_prod_id(url)
+
+    # make the product url for the request
+    prod_url = f'{site_url}/xapi/digital/v1/product/{url_id}'
+
+    # make the request
+    response = session.get(url=prod_url, headers=headers)
+
+    # case when the payload is parsed in the parse pool
+    if parse_pool is not None:
+        results, product_id = parse_pool.run('get_product_data', parse_product_json, response.content, url)
+
+    # otherwise, parse it here
+    else:
+        with metrics.timer('parse', 'macys_product', len(response.content)):
+            prod_results = decode_product(response.content)
+        with metrics.timer('extract', 'get_product_data'):
+            results = get_product_data(prod_dict=prod_results, url=url, headers=headers, fetch_reviews=False)
+        product_id = prod_results['product'][0]['id']
+
+    # get the reviews
+    results['product_reviews'] = get_reviews({'id': product_id}, results['number_reviews'], headers,
+                                             site_url=site_url, session=session, watermarks=watermarks,
+                                             parse_pool=parse_pool)
+
+    # return the results
+    return results
 
 
 # runner
 if __name__ == "__main__":
 
+    # imported here since the async engine imports this module
+    from dataset_construction.macys_scraper.src.async_crawl import crawl_products
+    from dataset_construction.common.src.parse_pool import ParsePool, iter_bounded
+    from dataset_construction.common.src.checkpoint import Checkpoint
+    from dataset_construction.common.src.dedup import NearDuplicateIndex
+    from dataset_construction.common.src.frontier import UrlFrontier, iter_urls
+    from dataset_construction.common.src.fetch_policy import FetchPolicy
+    from dataset_construction.common.src.rate_limit import AdaptiveRateLimiter
+    from dataset_construction.common.src.response_cache import ResponseCache
+    from dataset_construction.common.src.session import PooledSession
+    from dataset_construction.common.src.sinks import make_sink
+    from dataset_construction.common.src.watermarks import ReviewWatermarks
+
     # input file
     input_path = '../data/macys_products_to_scrape.txt'
 
@@ -225,34 +343,161 @@ if __name__ == "__main__":
     # output path
     output_path = r'../data/macys_scraped.json'
 
-    # read in the data
-    with open(input_path, 'r') as fp:
-        data = ["https://www.macys.com" + line.split('\n')[0] for line in fp.readlines()]
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='crawl with the asyncio engine')
+    parser.add_argument('--max-in-flight', type=int, default=16,
+                        help='number of requests in flight for the asyncio engine')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the products completed by a previous run')
+    parser.add_argument('--sink', choices=['jsonl', 'parquet', 'arrow'], default=None,
+                        help='also write the products and reviews to this kind of sink')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve repeat requests from the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='replay responses from the cache without touching the network')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the reviews added since the last run, newest first')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='parse in this many processes while the pages are fetched, 0 parses inline')
+    parser.add_argument('--fetch-workers', type=int, default=8,
+                        help='number of products fetched at once when parsing in processes')
+    parser.add_argument('--dedup', action='store_true',
+                        help='drop reviews that are near duplicates of a review seen before')
+    parser.add_argument('--dedup-capacity', type=int, default=200000,
+                        help='number of recent reviews the dedup remembers')
+    args = parser.parse_args()
+
+    # stream the urls into the frontier, which keeps one url per product across runs, and crawl only this run's
+    frontier = UrlFrontier('../data/macys_frontier.sqlite', key_func=get_product_key)
+    run_urls = frontier.add_run(iter_urls(input_path, prefix="https://www.macys.com"))
+    frontier.close()
+
+    # on-disk response cache, offline replay only reads from it
+    cache = ResponseCache('../data/http_cache', offline=args.offline) if args.cache or args.offline else None
+
+    # high-water marks of the reviews seen by previous runs
+    watermarks = None
+    if args.incremental:
+        watermarks = ReviewWatermarks('../data/macys_review_watermarks.sqlite',
+                                      fields=('user_id', 'review_title', 'review_body'))
+
+    # reviews of the last finished run, an incremental run only fetches the new ones and merges them in
+    previous_reviews = {}
+    if watermarks is not None:
+        if os.path.exists(output_path):
+            with open(output_path, 'r', encoding='utf-8') as fp:
+                previous_reviews = {get_prod_id(previous['url']): previous.get('product_reviews') or []
+                                    for previous in json.load(fp)}
+        else:
+            logging.warning(f'No previous output at {output_path}, products will only have their new reviews')
+
+    # results are flushed here as they come in
+    checkpoint = Checkpoint(r'../data/macys_scraped.jsonl', resume=args.resume)
+
+    # optional sink, products and reviews are joined on the product id
+    sink = None
+    if args.sink is not None:
+        sink = make_sink(args.sink, f'../data/macys_scraped_{args.sink}',
+                         key_func=lambda record: get_prod_id(record['url']), reviews_field='product_reviews')
+
+    # near-duplicate reviews are dropped as each product comes in, seeded with what a resumed run already wrote
+    dedup = None
+    if args.dedup:
+        dedup = NearDuplicateIndex(capacity=args.dedup_capacity)
+        if args.resume:
+            for previous in checkpoint.load_results():
+                dedup.filter_reviews(previous.get('product_reviews') or [], 'review_body')
+
+    # function to handle a finished product
+    def handle_result(url, results):
+        if watermarks is not None:
+            results['product_reviews'] = watermarks.merge(results['product_reviews'],
+                                                          previous_reviews.pop(get_prod_id(url), []))
+        if dedup is not None:
+            with metrics.timer('dedup', 'macys_reviews'):
+                results['product_reviews'] = dedup.filter_reviews(results['product_reviews'], 'review_body')
+        with metrics.timer('write', 'checkpoint'):
+            checkpoint.record(get_prod_id(url), results)
+        if sink is not None:
+            with metrics.timer('write', 'sink'):
+                sink.write(results)
+
+    # skip the products that are already done
+    data = [url for url in run_urls[:50] if not checkpoint.is_done(get_prod_id(url))]
+
+    # the stage metrics are exported while the crawl runs
+    metrics.start_exporter('../data/macys_metrics.prom')
+
+    # every request to macys.com is paced by the same limiter and has deadlines and retries
+    rate_limiter = AdaptiveRateLimiter()
+    policy = FetchPolicy()
+
+    # process pool that the payloads are parsed in
+    parse_pool = ParsePool(max_workers=args.parse_workers) if args.parse_workers > 0 else None
+
+    # case when the asyncio engine should be used
+    if args.use_async:
+
+        # crawl all urls concurrently
+        crawl_products(data, headers, max_in_flight=args.max_in_flight,
+                       on_result=handle_result, rate_limiter=rate_limiter, policy=policy,
+                       cache=cache, watermarks=watermarks, parse_pool=parse_pool)
+
+    # otherwise, go one at a time
+    else:
+
+        # session shared by the product and review requests
+        session = PooledSession(rate_limiter=rate_limiter, policy=policy, cache=cache)
+
+        # function to crawl a single product
+        crawl_url = partial(crawl_product, headers=headers, session=session, watermarks=watermarks,
+                            parse_pool=parse_pool)
+
+        # products run one at a time, unless the parsing runs in processes and needs several to keep busy
+        fetch_workers = args.fetch_workers if parse_pool is not None else 1
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor:
+            for url, future in tqdm(iter_bounded(fetch_executor, crawl_url, data, 2 * fetch_workers), total=len(data)):
 
-    # get unique values
-    data = list(set(data))
+                # a failing product shouldn't stop the crawl
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logging.warning(f'Failed to crawl url: {url} ({e!r})')
+                    metrics.error('crawl', 'macys_product')
+                    continue
 
-    # list to hold all output
-    output_list = []
+                # flush the results
+                handle_result(url, results)
 
-    # iterate over each url
-    for url in tqdm(data[:50]):
+        # close the pooled connections
+        session.close()
 
-        # get the product id
-        url_id = get_prod_id(url)
+    # stop the parse workers
+    if parse_pool is not None:
+        parse_pool.close()
 
-        # make the product url for the request
-        prod_url = f'https://www.macys.com/xapi/digital/v1/product/{url_id}'
+    # write out the stage metrics
+    metrics.stop_exporter('../data/macys_metrics.prom')
+    metrics.write_json('../data/macys_metrics.json')
 
-        # make the request
-        prod_results = requests.get(url=prod_url, headers=headers).json()
+    # log how many reviews the dedup dropped
+    if dedup is not None:
+        logging.info(f'Dropped {dedup.num_duplicates} of {dedup.num_seen} reviews as near duplicates')
 
-        # get the description
-        results = get_product_data(prod_dict=prod_results, url=url, headers=headers)
+    # log the pace the crawl settled on
+    for host, rate in rate_limiter.get_rates().items():
+        logging.info(f"{host}: {rate['rate']:.2f} requests/sec, {rate['concurrency']} in flight")
 
-        # see what this looks like
-        output_list.append(results)
+    # get the results of this and every previous run
+    output_list = checkpoint.load_results()
+    checkpoint.close()
+    if watermarks is not None:
+        watermarks.close()
+    if sink is not None:
+        sink.close()
 
     # write json out
     with open(output_path, 'w', encoding='utf-8') as fp:
-        json.dump(output_list, fp, indent=4)
\ No newline at end of file
+        json.dump(output_list, fp, indent=4)
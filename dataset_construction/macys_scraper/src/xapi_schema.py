@@ -0,0 +1,91 @@
+import json
+from typing import Any, List, TypedDict
+
+# msgspec is optional, without it the payloads are decoded in full
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# the parts of the product payload get_product_data reads, everything else is skipped while decoding
+class AnalyticsData(TypedDict):
+    t_category_name: List[Any]
+    product_name: List[Any]
+    product_brand: List[Any]
+    product_original_price: List[Any]
+    product_price: List[Any]
+    product_rating: List[Any]
+    product_reviews: List[Any]
+
+
+class Analytics(TypedDict):
+    data: AnalyticsData
+
+
+class Meta(TypedDict):
+    analytics: Analytics
+
+
+class ProductImage(TypedDict):
+    filePath: Any
+
+
+class Imagery(TypedDict):
+    images: List[ProductImage]
+
+
+# not every product has bullets, so the keys of a detail are optional, total=False also works on python 3.8
+class Detail(TypedDict, total=False):
+    description: Any
+    bulletText: Any
+    seoKeywords: Any
+
+
+class Product(TypedDict):
+    id: Any
+    detail: Detail
+    imagery: Imagery
+
+
+class ProductPayload(TypedDict):
+    meta: Meta
+    product: List[Product]
+
+
+# the parts of a review _get_review_data reads, optional since not every review has a title
+class Review(TypedDict, total=False):
+    authorId: Any
+    rating: Any
+    title: Any
+    reviewText: Any
+    totalPositiveFeedbackCount: Any
+    totalNegativeFeedbackCount: Any
+    photos: Any
+
+
+class ReviewWindow(TypedDict):
+    reviews: List[Review]
+
+
+class ReviewPayload(TypedDict):
+    review: ReviewWindow
+
+
+# decoders are built once, they only allocate the declared paths and come back as plain dicts
+if msgspec is not None:
+    PRODUCT_DECODER = msgspec.json.Decoder(ProductPayload)
+    REVIEW_DECODER = msgspec.json.Decoder(ReviewPayload)
+
+
+# decode a raw product payload
+def decode_product(content):
+    if msgspec is None:
+        return json.loads(content)
+    return PRODUCT_DECODER.decode(content)
+
+# decode a raw window of reviews and get the reviews
+def decode_reviews(content):
+    if msgspec is None:
+        return json.loads(content)['review']['reviews']
+    return REVIEW_DECODER.decode(content)['review']['reviews']
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import re
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import pytest
+from dataset_construction.common.src.fetch_policy import FetchPolicy
+from dataset_construction.macys_scraper.src.async_crawl import AsyncCrawler, crawl_products
+
+# headers
+HEADERS = {'user-agent': 'test'}
+
+# number of reviews of each stub product, picked so they span a different number of windows
+NUM_REVIEWS = {'1001': 0, '1002': 29, '1003': 30, '1004': 95, '1005': 61, '1006': 7}
+
+# xapi paths the stub answers
+XAPI_PATTERN = re.compile(r'/xapi/digital/v1/product/(?P<id>\d+)(?P<reviews>/reviews)?$')
+
+
+# product payload with just the fields get_product_data reads
+def product_payload(product_id):
+    return {
+        'meta': {'analytics': {'data': {
+            't_category_name': ['category'],
+            'product_name': [f'product {product_id}'],
+            'product_brand': ['brand'],
+            'product_original_price': ['10.00'],
+            'product_price': ['8.00'],
+            'product_rating': ['4.5'],
+            'product_reviews': [str(NUM_REVIEWS[product_id])]
+        }}},
+        'product': [{
+            'id': int(product_id),
+            'detail': {'description': 'description', 'seoKeywords': ['keyword']},
+            'imagery': {'images': [{'filePath': 'image.jpg'}]}
+        }]
+    }
+
+# window of 30 reviews starting at the offset, the bodies say which product and position they are
+def review_payload(product_id, offset):
+    return {'review': {'reviews': [
+        {'authorId': f'user{i}', 'rating': 5, 'title': f'title {i}', 'reviewText': f'{product_id}:{i}',
+         'totalPositiveFeedbackCount': 1, 'totalNegativeFeedbackCount': 0, 'photos': []}
+        for i in range(offset, min(offset + 30, NUM_REVIEWS[product_id]))
+    ]}}
+
+
+# stub of the macy's xapi, keeps connections alive like the real site
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # keep the test output clean
+    def log_message(self, *args):
+        pass
+
+    # send a json body
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+
+        # count the request
+        with server.lock:
+            server.hits[self.path] += 1
+            num_hits = server.hits[self.path]
+
+        # unknown paths
+        match = XAPI_PATTERN.match(urlsplit(self.path).path)
+        if match is None:
+            return self.send_json(404, {})
+        product_id = match.group('id')
+
+        # flaky paths fail the first few times they're asked for
+        if num_hits <= server.failures.get(product_id, 0):
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # reviews
+        if match.group('reviews'):
+            offset = int(dict(parse_qsl(urlsplit(self.path).query)).get('offset', 0))
+            return self.send_json(200, review_payload(product_id, offset))
+
+        # product
+        return self.send_json(200, product_payload(product_id))
+
+
+# stub server on a free localhost port
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+# counters start from scratch for every test
+@pytest.fixture
+def site_url(server):
+    server.hits = Counter()
+    server.failures = {}
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+# product urls the way they are listed in the input file
+def product_urls(product_ids):
+    return [f'https://www.macys.com/shop/product/item?ID={product_id}' for product_id in product_ids]
+
+# policy that retries right away so the tests stay fast
+def fast_policy(retries=3):
+    return FetchPolicy(retries=retries, backoff=0.01, max_backoff=0.01, total_timeout=10.0)
+
+
+# results come back in input order however the requests finish, and reviews in offset order
+def test_results_in_input_order(site_url):
+
+    # crawl every product, with the slow ones first so they finish last
+    product_ids = ['1004', '1005', '1001', '1006', '1002', '1003']
+    results = crawl_products(product_urls(product_ids), HEADERS, max_in_flight=8, site_url=site_url)
+
+    # one result per url, in input order
+    assert [result['url'] for result in results] == product_urls(product_ids)
+
+    # the reviews of each product are in window order and nothing is repeated or lost
+    for product_id, result in zip(product_ids, results):
+        assert result['number_reviews'] == NUM_REVIEWS[product_id]
+        assert [review['review_body'] for review in result['product_reviews']] == \
+               [f'{product_id}:{i}' for i in range(NUM_REVIEWS[product_id])]
+
+# results are handed off as they finish, and every product exactly once
+def test_on_result_called_once_per_product(site_url):
+
+    # collect the results as they come in
+    finished = []
+    product_ids = list(NUM_REVIEWS)
+    results = crawl_products(product_urls(product_ids), HEADERS, max_in_flight=4, site_url=site_url,
+                             on_result=lambda url, result: finished.append(url))
+
+    # every product once, in whatever order they finished
+    assert sorted(finished) == sorted(product_urls(product_ids))
+    assert len(results) == len(product_ids)
+
+
+# requests share keep-alive connections, capped by the number in flight
+def test_connections_are_pooled(site_url):
+
+    # crawl with the crawler itself so its session can be inspected
+    max_in_flight = 4
+    crawler = AsyncCrawler(HEADERS, max_in_flight=max_in_flight, site_url=site_url)
+    results = asyncio.run(crawler.crawl(product_urls(list(NUM_REVIEWS))))
+    stats = crawler.session.get_stats()[urlsplit(site_url).hostname]
+    crawler.session.close()
+
+    # one product request per product and one per window of reviews
+    num_requests = len(NUM_REVIEWS) + sum((n + 29) // 30 for n in NUM_REVIEWS.values())
+    assert len(results) == len(NUM_REVIEWS)
+    assert stats['requests'] == num_requests
+
+    # never more connections than requests in flight, the rest reused one
+    assert stats['new_connections'] <= max_in_flight
+    assert stats['reused_connections'] == num_requests - stats['new_connections']
+
+
+# 503s are retried by the fetch policy until the product comes through
+def test_retries_recover_flaky_products(site_url, server):
+
+    # the product and review requests of one product fail twice first
+    server.failures = {'1004': 2}
+    results = crawl_products(product_urls(['1003', '1004']), HEADERS, max_in_flight=4, site_url=site_url,
+                             policy=fast_policy())
+
+    # both products made it, with every review
+    assert [result['url'] for result in results] == product_urls(['1003', '1004'])
+    assert len(results[1]['product_reviews']) == NUM_REVIEWS['1004']
+
+    # the product request took three tries
+    assert server.hits['/xapi/digital/v1/product/1004'] == 3
+
+# once the retries run out the product is dropped and the rest of the crawl goes on
+def test_exhausted_retries_drop_the_product(site_url, server):
+
+    # one product keeps failing for longer than the policy retries
+    server.failures = {'1002': 10}
+    results = crawl_products(product_urls(['1001', '1002', '1003']), HEADERS, max_in_flight=4, site_url=site_url,
+                             policy=fast_policy(retries=2))
+
+    # the failing one is gone, the order of the others is kept
+    assert [result['url'] for result in results] == product_urls(['1001', '1003'])
+    assert server.hits['/xapi/digital/v1/product/1002'] == 3
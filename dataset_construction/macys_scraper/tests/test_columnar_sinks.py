@@ -0,0 +1,65 @@
+import pytest
+from lxml.html import fromstring
+from dataset_construction.common.src.sinks import make_sink
+from dataset_construction.macys_scraper.src.scrape_products import scrape_product, to_columnar, get_prod_id
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+# product page with every field the scraper reads
+FULL_PAGE = ('<html><body>'
+             '<div class="product-title"><a data-auto="product-brand">Brand</a><h1>Dress</h1></div>'
+             '<div class="lowest-sale-price"><span>$1,049.99</span></div>'
+             '<p itemprop="description">A dress.</p>'
+             '<ul data-auto="product-description-bullets"><li>Cotton</li><li>Machine wash</li></ul>'
+             '<picture class="main-picture"><img src="https://slimages.macysassets.com/1.jpg"></picture>'
+             '</body></html>')
+
+# product page with none of them, every field comes back as its missing-value sentinel
+EMPTY_PAGE = '<html><body><p>Not found</p></body></html>'
+
+
+# the records the scraper makes out of a mix of full and empty pages
+def scraped_records():
+    pages = [FULL_PAGE, EMPTY_PAGE, EMPTY_PAGE, FULL_PAGE]
+    return [scrape_product(fromstring(page), f'https://www.macys.com/shop/product/item?ID={i}')
+            for i, page in enumerate(pages)]
+
+# read every part file of a table back into one table
+def read_table(path, kind):
+    parts = sorted(path.iterdir())
+    assert len(parts) > 0
+    if kind == 'parquet':
+        return pa.concat_tables([pq.read_table(part) for part in parts], promote_options='permissive')
+    return pa.concat_tables([pa.ipc.open_file(part).read_all() for part in parts], promote_options='permissive')
+
+
+# the sentinels are nulls and empty lists, and prices are floats
+def test_to_columnar_coerces_sentinels():
+    full, empty = scraped_records()[:2]
+    assert empty['price'] == -1 and empty['description']['bullets'] == 'N/A'
+    assert to_columnar(empty)['price'] is None
+    assert to_columnar(empty)['description']['bullets'] == []
+    assert to_columnar(full)['price'] == 1049.99
+    assert to_columnar(full)['description']['bullets'] == ['Cotton', 'Machine wash']
+
+    # the scraped record itself isn't changed
+    assert empty['price'] == -1 and empty['description']['bullets'] == 'N/A'
+
+# real scraper output goes through both columnar sinks whether the batches mix full and empty pages or not
+@pytest.mark.parametrize('kind', ['parquet', 'arrow'])
+@pytest.mark.parametrize('batch_size', [1, 1000])
+def test_scraped_products_write_to_columnar_sinks(tmp_path, kind, batch_size):
+    records = scraped_records()
+
+    # write them the way the runner does
+    sink = make_sink(kind, str(tmp_path / kind), key_func=lambda record: get_prod_id(record['url']),
+                     reviews_field='reviews', batch_size=batch_size)
+    for record in records:
+        sink.write(to_columnar(record))
+    sink.close()
+
+    # no batch was dropped
+    table = read_table(tmp_path / kind / 'products', kind)
+    assert table.num_rows == len(records)
+    assert table.column('price').to_pylist() == [1049.99, None, None, 1049.99]
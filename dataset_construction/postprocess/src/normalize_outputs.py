@@ -0,0 +1,57 @@
+import argparse
+import json
+import logging
+import os
+import time
+from dataset_construction.common.src.checkpoint import load_results
+from dataset_construction.common.src.normalize import ColumnNormalizer
+
+# scraped outputs that get normalized when no paths are given
+DEFAULT_INPUTS = ['../../macys_scraper/data/macys_scraped.json',
+                  '../../bs4/data/bestbuy_scraped.json']
+
+
+# get the path the normalized output is written to, next to the input
+def output_path_of(path, suffix):
+    root, extension = os.path.splitext(path)
+    return f'{root}{suffix}{extension}'
+
+
+# runner
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    # parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='*', default=DEFAULT_INPUTS,
+                        help='scraped outputs to normalize, json lists or json lines')
+    parser.add_argument('--suffix', default='_normalized',
+                        help='added to the name of each input to get its output')
+    args = parser.parse_args()
+
+    # the same normalizer handles both sites
+    normalizer = ColumnNormalizer()
+
+    # iterate over each output
+    for input_path in args.inputs:
+
+        # case when the site wasn't scraped
+        if not os.path.exists(input_path):
+            logging.warning(f'Nothing to normalize at {input_path}')
+            continue
+
+        # normalize it
+        products = load_results(input_path)
+        start = time.perf_counter()
+        normalizer.normalize(products)
+        logging.info(f'Normalized {len(products)} products from {input_path} in {time.perf_counter() - start:.2f}s')
+
+        # write it out the way it was read
+        output_path = output_path_of(input_path, args.suffix)
+        with open(output_path, 'w', encoding='utf-8') as fp:
+            if output_path.endswith('.jsonl'):
+                for product in products:
+                    fp.write(json.dumps(product) + '\n')
+            else:
+                json.dump(products, fp, indent=4)